@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import subprocess
 import sys
 import os
 
+# Add this directory to the Python path so 'handleMetrics' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from handleMetrics.textfileExporter import job_metrics
+from handleTracing.stageTracer import span, start_trace
+
 def list_volumes():
     """
     Returns a list of Docker volume names.
@@ -59,21 +65,33 @@ def backup_volume(volume_name, backup_dir):
         "backup"
     ]
 
-    try:
-        # Open the archive file for writing binary data.
-        with open(archive_path, "wb") as archive_file:
-            # Run the command, writing stdout to the archive file.
-            subprocess.run(command, stdout=archive_file, stderr=subprocess.PIPE, check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Error backing up volume '{volume_name}':", e, file=sys.stderr)
-        sys.exit(1)
+    with span("backup_volume", volume=volume_name) as stage, \
+            job_metrics("docker_volume", repo=os.path.abspath(backup_dir), volume=volume_name) as metrics:
+        try:
+            # Open the archive file for writing binary data.
+            with open(archive_path, "wb") as archive_file:
+                # Run the command, writing stdout to the archive file.
+                subprocess.run(command, stdout=archive_file, stderr=subprocess.PIPE, check=True)
+            stage["bytes"] = os.path.getsize(archive_path)
+            metrics.set(bytes_original=stage["bytes"], files=1)
+        except subprocess.CalledProcessError as e:
+            metrics.exit_code = e.returncode
+            print(f"Error backing up volume '{volume_name}':", e, file=sys.stderr)
+            sys.exit(1)
 
 def main():
+    parser = argparse.ArgumentParser(description="Back up every Docker volume to a tar archive")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile")
+    args = parser.parse_args()
+    start_trace("docker-volumes", profile=args.profile or None)
+
     # Check if any containers are running.
-    check_running_containers()
+    with span("check_running_containers"):
+        check_running_containers()
 
     # List all docker volumes.
-    volumes = list_volumes()
+    with span("list_volumes"):
+        volumes = list_volumes()
     if not volumes:
         print("No Docker volumes found.")
         sys.exit(0)
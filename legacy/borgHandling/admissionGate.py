@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+admissionGate.py
+
+Pre-start gate for scheduled backups. Cron starts backups exactly on the
+minute whatever the host is doing; the gate first checks that the host can
+take a backup and defers the start with exponential backoff while it cannot:
+
+  - load average per CPU and CPU, IO and memory pressure (PSI)
+  - free space in TMPDIR and in the borg cache directory
+  - the repository is reachable (remote repos: an rsh round trip within the limit)
+
+When the conditions are still not met at the deadline the window is skipped:
+the reasons are logged, recorded in STATE_FILE and exported as an `admission`
+metric with a non-zero exit code, and the gate exits with EXIT_SKIPPED.
+
+    backup:
+      admission:
+        max_load_per_cpu: 2.0
+        max_cpu_pressure: 40        # % (avg60)
+        max_io_pressure: 40
+        max_memory_pressure: 20
+        min_free_tmp_gb: 1
+        min_free_cache_gb: 2
+        max_repo_connect_ms: 5000
+        deadline_minutes: 120       # give up on the window after this long
+        initial_delay: 60           # seconds, doubled after every deferral
+        max_delay: 900
+
+Usage (e.g. from crontab):
+    admissionGate.py                     # wait for admission, then run_borg_backup()
+    admissionGate.py -- borg create ...  # wait for admission, then run the command
+    admissionGate.py --check             # evaluate the conditions once and exit
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.hostLoad import load_per_cpu, pressure
+from borgHandling.linkProbe import parse_remote_repo, rsh_command
+from borgHandling.runBorg import run_borg_backup
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/admission.json'
+
+# Exit code of a skipped window, distinct from a failed backup
+EXIT_SKIPPED = 75
+
+# Skipped windows kept in STATE_FILE
+HISTORY_LENGTH = 50
+
+DEFAULT_ADMISSION = {
+    'max_load_per_cpu': 2.0,
+    'max_cpu_pressure': 40,
+    'max_io_pressure': 40,
+    'max_memory_pressure': 20,
+    'min_free_tmp_gb': 1,
+    'min_free_cache_gb': 2,
+    'max_repo_connect_ms': 5000,
+    'deadline_minutes': 120,
+    'initial_delay': 60,
+    'max_delay': 900,
+}
+
+
+def admission_settings(config):
+    return dict(DEFAULT_ADMISSION, **(config['backup'].get('admission') or {}))
+
+
+def borg_cache_dir():
+    """Return the directory borg keeps its chunk caches in."""
+    if os.environ.get('BORG_CACHE_DIR'):
+        return os.environ['BORG_CACHE_DIR']
+    base = os.environ.get('BORG_BASE_DIR') or os.path.expanduser('~')
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(base, '.cache'), 'borg')
+
+
+def free_gb(path):
+    """Return the free space of the filesystem holding path (or its nearest existing parent)."""
+    while not os.path.exists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free / 1024 ** 3
+
+
+def repo_problem(config, max_connect_ms):
+    """Return why the repository cannot be reached, or None."""
+    repo = config['borg']['repo']
+    remote = parse_remote_repo(repo)
+    if not remote:
+        return None if os.path.isdir(repo) else f"repository {repo} is not accessible"
+    destination, port = remote
+    cmd = rsh_command(config) + (['-p', port] if port else []) + [destination, 'true']
+    start = time.monotonic()
+    try:
+        subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       timeout=max(max_connect_ms / 1000 * 3, 10))
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        return f"repository server {destination} unreachable ({type(e).__name__})"
+    elapsed_ms = (time.monotonic() - start) * 1000
+    if elapsed_ms > max_connect_ms:
+        return f"repository server {destination} slow to connect ({elapsed_ms:.0f} ms > {max_connect_ms} ms)"
+    return None
+
+
+def blocking_conditions(config, settings):
+    """Evaluate every condition and return the reasons the backup should not start now."""
+    reasons = []
+    signals = [
+        ('load per cpu', load_per_cpu(), settings['max_load_per_cpu']),
+        ('cpu pressure', pressure('cpu', 'avg60'), settings['max_cpu_pressure']),
+        ('io pressure', pressure('io', 'avg60'), settings['max_io_pressure']),
+        ('memory pressure', pressure('memory', 'avg60'), settings['max_memory_pressure']),
+    ]
+    for name, value, limit in signals:
+        if value is not None and limit and value > limit:
+            reasons.append(f"{name} {value:.2f} > {limit}")
+
+    for name, path, minimum in (('TMPDIR', tempfile.gettempdir(), settings['min_free_tmp_gb']),
+                                ('borg cache', borg_cache_dir(), settings['min_free_cache_gb'])):
+        if minimum and free_gb(path) < minimum:
+            reasons.append(f"{name} {path} has {free_gb(path):.1f} GB free < {minimum} GB")
+
+    problem = repo_problem(config, settings['max_repo_connect_ms'])
+    if problem:
+        reasons.append(problem)
+    return reasons
+
+
+def record_skip(reasons, state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    skipped = state.setdefault('skipped', [])
+    skipped.append({'time': datetime.now().isoformat(timespec='seconds'), 'reasons': reasons})
+    del skipped[:-HISTORY_LENGTH]
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        with open(f"{state_file}.tmp", 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{state_file}.tmp", state_file)
+    except OSError as e:
+        logging.error(f"Failed to record the skipped window: {e}")
+
+
+def wait_for_admission(config, settings=None, sleep=time.sleep):
+    """Block until the host can take a backup. Returns True when admitted, False when the window is skipped."""
+    settings = settings or admission_settings(config)
+    start = time.monotonic()
+    deadline = start + settings['deadline_minutes'] * 60
+    delay = settings['initial_delay']
+
+    with job_metrics('admission', repo=config['borg']['repo']) as metrics:
+        while True:
+            reasons = blocking_conditions(config, settings)
+            now = time.monotonic()
+            if not reasons:
+                metrics.set(admission_wait_seconds=round(now - start))
+                if now - start >= 1:
+                    logging.info(f"Backup admitted after waiting {now - start:.0f}s.")
+                return True
+            if now + 1 >= deadline:
+                metrics.set(admission_wait_seconds=round(now - start))
+                metrics.exit_code = EXIT_SKIPPED
+                logging.error(f"Backup window skipped, conditions not met by the deadline: {'; '.join(reasons)}")
+                print(f"Backup window skipped: {'; '.join(reasons)}")
+                record_skip(reasons)
+                return False
+
+            # Jitter keeps hosts that were deferred together from retrying together
+            wait = min(delay * random.uniform(0.9, 1.1), deadline - now)
+            logging.warning(f"Deferring backup by {wait:.0f}s: {'; '.join(reasons)}")
+            sleep(wait)
+            delay = min(delay * 2, settings['max_delay'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start a backup only when the host can take it")
+    parser.add_argument('--check', action='store_true', help="Evaluate the conditions once and exit")
+    parser.add_argument('--deadline', type=int, metavar='MINUTES', help="Override admission.deadline_minutes")
+    parser.add_argument('--config', default=CONFIG_FILE, help="Path to the Persephone borg config")
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="Command to run once admitted (after --)")
+    args = parser.parse_args()
+    setup_logging(stage='admission')
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    settings = admission_settings(config)
+    if args.deadline is not None:
+        settings['deadline_minutes'] = args.deadline
+
+    if args.check:
+        reasons = blocking_conditions(config, settings)
+        print("Backup would start now." if not reasons else "Backup would be deferred:\n  " + "\n  ".join(reasons))
+        sys.exit(0 if not reasons else 1)
+
+    if not wait_for_admission(config, settings):
+        sys.exit(EXIT_SKIPPED)
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if command:
+        sys.exit(subprocess.run(command).returncode)
+    run_borg_backup(config)
+
+
+if __name__ == "__main__":
+    main()
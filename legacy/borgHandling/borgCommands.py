@@ -0,0 +1,55 @@
+import json
+
+from borgHandling.compressionAnalysis import build_compression_plan
+from borgHandling.linkProbe import choose_compression
+
+
+def compression_plan(config):
+    """Return the list of (compression, paths) runs for this backup."""
+    if config['backup'].get('compression') == 'link-adaptive':
+        return [(choose_compression(config), config['backup']['paths_to_backup'])]
+    return build_compression_plan(config)
+
+
+def single_compression(config):
+    """Return one compression spec for runners that cannot split paths by compression."""
+    plan = compression_plan(config)
+    if len(plan) == 1:
+        return plan[0][0]
+    # Split plans are folded into borg's auto mode, which skips incompressible chunks itself
+    return 'auto,zstd,3'
+
+
+def build_create_cmd(archive_name, paths, compression, patterns_file=None, dryrun=False, checkpoint_interval=None):
+    """Build the borg create command used by every local backup runner."""
+    borg_create_cmd = ['borg', 'create', archive_name] + list(paths) + [
+        '--verbose',
+        '--compression', compression,
+        '--list',
+        '--stats',
+        '--show-rc',
+        '--exclude-caches'
+    ]
+
+    # Commit checkpoints often enough that an interrupted run can resume cheaply
+    if checkpoint_interval:
+        borg_create_cmd += ['--checkpoint-interval', str(checkpoint_interval)]
+
+    # Add exclude/include patterns from config as a compiled patterns file
+    if patterns_file:
+        borg_create_cmd += ['--patterns-from', patterns_file]
+
+    # Add dry-run flag if specified, otherwise ask for machine readable stats
+    if dryrun:
+        borg_create_cmd.append('--dry-run')
+    else:
+        borg_create_cmd.append('--json')
+    return borg_create_cmd
+
+
+def parse_create_stats(output):
+    """Return the archive section of 'borg create --json' output, or an empty dict."""
+    try:
+        return json.loads(output).get('archive', {})
+    except ValueError:
+        return {}
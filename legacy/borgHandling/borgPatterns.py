@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+borgPatterns.py
+
+Compiles `exclude_patterns` (and optional `include_patterns`) from the backup
+config into a borg patterns file used with `--patterns-from`. Patterns are
+normalised (leading slashes, doubled slashes, empty entries, comma separated
+strings) and deduplicated. An exclude that no include can reach is written as
+a `!` rule, so borg does not descend into the excluded directory at all.
+
+Running this file does a dry scan of paths_to_backup and reports how many
+entries and bytes each rule excludes. Rules that match nothing are flagged,
+since they are usually a typo.
+
+Patterns without a style prefix use borg's fm: style, the same as --exclude.
+"""
+
+import fnmatch
+import hashlib
+import logging
+import os
+import re
+import sys
+
+PATTERNS_DIR = '/var/cache/CodeMonkeyCyber/Persephone/patterns'
+
+STYLE_PREFIXES = ('fm:', 'sh:', 're:', 'pp:', 'pf:')
+
+
+def split_style(pattern):
+    """Return (style, pattern), defaulting to fm like borg's --exclude."""
+    for prefix in STYLE_PREFIXES:
+        if pattern.startswith(prefix):
+            return prefix[:-1], pattern[len(prefix):]
+    return 'fm', pattern
+
+
+def normalize_pattern(pattern):
+    """Normalise one pattern, returning it with an explicit style prefix (or None if empty)."""
+    pattern = pattern.strip()
+    if not pattern:
+        return None
+    style, body = split_style(pattern)
+    if style != 're':
+        body = re.sub(r'/{2,}', '/', body)
+        while body.startswith('./'):
+            body = body[2:]
+        body = body.lstrip('/')
+        # 'dir/' means the contents of dir, which is the same as 'dir/*'
+        if style in ('fm', 'sh') and body.endswith('/'):
+            body = body.rstrip('/') + '/*'
+        if not body:
+            return None
+    return f"{style}:{body}"
+
+
+def normalize_patterns(patterns):
+    """Normalise and deduplicate a list (or comma separated string) of patterns, keeping order."""
+    if isinstance(patterns, str):
+        patterns = patterns.split(',')
+    seen = []
+    for pattern in patterns or []:
+        normalized = normalize_pattern(str(pattern))
+        if normalized and normalized not in seen:
+            seen.append(normalized)
+    return seen
+
+
+def literal_prefix(pattern):
+    """Return the part of a pattern before its first wildcard."""
+    style, body = split_style(pattern)
+    if style in ('pp', 'pf'):
+        return body
+    if style == 're':
+        return ''
+    return re.split(r'[*?\[]', body, maxsplit=1)[0]
+
+
+def compile_patterns(exclude_patterns, include_patterns=()):
+    """Return the lines of a borg patterns file for the given rules."""
+    excludes = normalize_patterns(exclude_patterns)
+    includes = normalize_patterns(include_patterns)
+    include_prefixes = [literal_prefix(pattern) for pattern in includes]
+
+    lines = [f"+ {pattern}" for pattern in includes]
+    for pattern in excludes:
+        prefix = literal_prefix(pattern)
+        # Only prune (!) when no include could match something below this exclude
+        reachable = any(inc.startswith(prefix) or prefix.startswith(inc) for inc in include_prefixes)
+        lines.append(f"{'-' if reachable else '!'} {pattern}")
+    return lines
+
+
+def write_patterns_file(backup_config, patterns_dir=PATTERNS_DIR):
+    """Write the patterns file for a backup config section and return its path, or None if there are no rules."""
+    lines = compile_patterns(backup_config.get('exclude_patterns', []), backup_config.get('include_patterns', []))
+    if not lines:
+        return None
+    content = "# Generated by Persephone from exclude_patterns/include_patterns\n" + "\n".join(lines) + "\n"
+    digest = hashlib.sha256(content.encode()).hexdigest()[:16]
+    path = os.path.join(patterns_dir, f"{digest}.patterns")
+    if not os.path.exists(path):
+        os.makedirs(patterns_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    return path
+
+
+def compile_matcher(pattern):
+    """Return a function path -> bool that matches like borg does (paths have no leading slash)."""
+    style, body = split_style(pattern)
+    if style == 'fm':
+        # A pattern matching a directory also matches everything below it
+        prepared = body.rstrip('/') + '/*'
+        return lambda path: fnmatch.fnmatchcase(path + '/', prepared)
+    if style == 'sh':
+        regex = ''
+        i = 0
+        while i < len(body):
+            if body.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif body[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif body[i] == '?':
+                regex += '[^/]'
+                i += 1
+            else:
+                regex += re.escape(body[i])
+                i += 1
+        compiled = re.compile(regex.rstrip('/') + '(?:/.*)?$')
+        return lambda path: compiled.match(path) is not None
+    if style == 're':
+        compiled = re.compile(body)
+        return lambda path: compiled.search(path) is not None
+    if style == 'pp':
+        return lambda path: path == body or path.startswith(body.rstrip('/') + '/')
+    return lambda path: path == body
+
+
+def tree_size(path):
+    """Return (entries, bytes) below and including path, without following symlinks."""
+    entries = 0
+    total = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            st = os.lstat(current)
+        except OSError:
+            continue
+        entries += 1
+        total += st.st_size
+        if os.path.isdir(current) and not os.path.islink(current):
+            try:
+                stack.extend(os.path.join(current, name) for name in os.listdir(current))
+            except OSError:
+                pass
+    return entries, total
+
+
+def dry_scan(paths, lines):
+    """
+    Walk paths and attribute every excluded entry to the first rule matching it.
+    Returns {rule: {'entries': n, 'bytes': n}} in file order.
+    """
+    rules = [(line, line[0], compile_matcher(line[2:])) for line in lines]
+    report = {line: {'entries': 0, 'bytes': 0} for line in lines}
+
+    stack = list(paths)
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    relative = entry.path.lstrip('/')
+                    rule = next((r for r in rules if r[2](relative)), None)
+                    if rule and rule[1] in '-!':
+                        count, size = tree_size(entry.path)
+                        report[rule[0]]['entries'] += count
+                        report[rule[0]]['bytes'] += size
+                        continue
+                    if rule:
+                        report[rule[0]]['entries'] += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError as e:
+            logging.debug(f"Skipping {current} during pattern scan: {e}")
+    return report
+
+
+def print_report(backup_config):
+    """Dry-scan the configured paths and print what each rule excludes."""
+    lines = compile_patterns(backup_config.get('exclude_patterns', []), backup_config.get('include_patterns', []))
+    if not lines:
+        print("No exclude or include patterns configured.")
+        return True
+    report = dry_scan(backup_config.get('paths_to_backup', []), lines)
+    unused = False
+    for line, counts in report.items():
+        note = ''
+        if counts['entries'] == 0:
+            note = '  <- matches nothing, check for a typo'
+            unused = True
+        print(f"{line:50s} {counts['entries']:>10d} entries {counts['bytes'] / 1024 ** 3:>10.2f} GiB{note}")
+    return not unused
+
+
+if __name__ == "__main__":
+    import yaml
+
+    CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+    with open(CONFIG_FILE, 'r') as file:
+        config = yaml.safe_load(file)
+    sys.exit(0 if print_report(config['backup']) else 1)
@@ -0,0 +1,89 @@
+"""
+checkpoints.py
+
+Resume support for interrupted borg create runs.
+
+borg create writes a `<archive>.checkpoint` archive every checkpoint interval,
+so when a run dies (SSH drop, reboot) everything up to the last checkpoint is
+already committed to the repository. A new run deduplicates against those
+chunks and only has to re-read the files, not re-upload them.
+
+Runners use this module to:
+  - pass --checkpoint-interval (backup.checkpoint_interval, in seconds)
+  - find a run of today that left checkpoints but no final archive, and reuse
+    its timestamp so the resumed run replaces it (archives of the run that did
+    complete, e.g. other compression groups, are skipped)
+  - delete leftover checkpoint archives once a run has completed
+
+    backup:
+      checkpoint_interval: 600
+
+Checkpoint archives are only listed with --consider-checkpoints (borg 1.2+).
+"""
+
+import json
+import logging
+import re
+import subprocess
+from datetime import datetime
+
+from handleRetry.retryEngine import run_borg
+
+DEFAULT_CHECKPOINT_INTERVAL = 600
+
+CHECKPOINT_SUFFIX = re.compile(r'\.checkpoint(\.\d+)?$')
+
+
+def checkpoint_interval(settings):
+    """Return the checkpoint interval in seconds from a backup section or backup target."""
+    return int(settings.get('checkpoint_interval') or DEFAULT_CHECKPOINT_INTERVAL)
+
+
+def checkpoint_base(name):
+    """Return the archive name a checkpoint belongs to, or None if name is not a checkpoint."""
+    match = CHECKPOINT_SUFFIX.search(name)
+    return name[:match.start()] if match else None
+
+
+def find_resumable(names, pattern, today=None):
+    """
+    Return (timestamp, completed archive names) of the newest run of today that
+    left checkpoints without finishing, or None. pattern matches an archive name
+    and has a 'timestamp' group starting with the date (YYYY-MM-DD).
+    """
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    finals = {name for name in names if checkpoint_base(name) is None}
+    interrupted = set()
+    for name in names:
+        base = checkpoint_base(name)
+        match = pattern.match(base) if base else None
+        if match and base not in finals and match.group('timestamp').startswith(today):
+            interrupted.add(match.group('timestamp'))
+    if not interrupted:
+        return None
+    timestamp = max(interrupted)
+    completed = {name for name in finals if (match := pattern.match(name)) and match.group('timestamp') == timestamp}
+    return timestamp, completed
+
+
+def leftover_checkpoints(names, pattern):
+    """Return every checkpoint archive whose name matches pattern, for cleanup after a completed run."""
+    return [name for name in names if (base := checkpoint_base(name)) and pattern.match(base)]
+
+
+def list_archive_names(repo, env, glob=None):
+    """Return the names of all archives, including checkpoints."""
+    cmd = ['borg', 'list', '--json', '--consider-checkpoints'] + (['--glob-archives', glob] if glob else []) + [repo]
+    result = run_borg(cmd, 'borg_list', env=env)
+    return [archive['name'] for archive in json.loads(result.stdout).get('archives', [])]
+
+
+def delete_checkpoints(repo, env, names):
+    """Delete checkpoint archives. Failures are logged, a leftover checkpoint is only wasted metadata."""
+    if not names:
+        return
+    try:
+        run_borg(['borg', 'delete', repo] + names, 'borg_delete', env=env)
+        logging.info(f"Deleted {len(names)} stale checkpoint archive(s) from {repo}.")
+    except subprocess.CalledProcessError as e:
+        logging.warning(f"Could not delete checkpoint archives from {repo}: {e.stderr}")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+churnReport.py
+
+Explains what changed between two archives, e.g. why last night's backup was
+40 GB bigger. `borg diff --json-lines` is streamed and the added, removed and
+modified bytes are summed per directory prefix (the first --depth path
+components), so memory only grows with the number of prefixes, not with the
+number of changed files. The top churners are printed and the full result
+can be saved as JSON.
+
+Usage:
+    churnReport.py                              # the newest archive of this host and the one before it
+    churnReport.py ARCHIVE1 ARCHIVE2 --depth 4
+    churnReport.py --glob 'web1-*' --top 30 --json churn.json
+
+For modified files borg reports the bytes of the chunks that were added and
+removed, which is what actually grows the repository.
+
+A run of runBorg.py writes several archives (one per compression group, one
+per dump group), so by default the newest archive is compared with the newest
+archive of an earlier run that has the same suffix, e.g. web1-...-dumps with
+the -dumps archive of the run before.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.tieredRepo import backup_repo
+from handleLogging.persephoneLogging import setup_logging
+from handleRetry.retryEngine import run_borg
+from handleTracing.stageTracer import span, start_trace
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+
+DEFAULT_DEPTH = 3
+DEFAULT_TOP = 20
+
+# <prefix>-<run timestamp>[-<suffix>], the suffix names the compression or dump group
+RUN_ARCHIVE = re.compile(r'^(?P<run>.+?-\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:-(?P<suffix>.+))?$')
+
+COUNTERS = ('added_bytes', 'removed_bytes', 'added_files', 'removed_files', 'modified_files')
+
+
+def run_and_suffix(name):
+    """Split an archive name into its run and its suffix; names without a run timestamp are a run of their own."""
+    match = RUN_ARCHIVE.match(name)
+    return (match['run'], match['suffix'] or '') if match else (name, None)
+
+
+def last_two_archives(repo, env, glob=None):
+    """Return the newest archive and the newest one of an earlier run with the same suffix (older first)."""
+    cmd = ['borg', 'list', '--json'] + (['--glob-archives', glob] if glob else []) + [repo]
+    listing = json.loads(run_borg(cmd, 'borg_list', env=env).stdout)
+    archives = [archive['name'] for archive in listing.get('archives', [])]
+    if archives:
+        newest = archives[-1]
+        run, suffix = run_and_suffix(newest)
+        for name in reversed(archives[:-1]):
+            other_run, other_suffix = run_and_suffix(name)
+            if other_suffix == suffix and other_run != run:
+                return name, newest
+    raise ValueError(f"Need two runs with the same archive suffix in {repo}{f' matching {glob}' if glob else ''}, "
+                     f"found {len(archives)} archive(s).")
+
+
+def diff_entries(repo, archive1, archive2, env, paths=()):
+    """Yield the entries of borg diff --json-lines between two archives."""
+    cmd = ['borg', 'diff', '--json-lines', f"{repo}::{archive1}", archive2] + list(paths)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, env=env) as process:
+        for line in process.stdout:
+            if line.strip():
+                yield json.loads(line)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def prefix_of(path, depth):
+    """The directory prefix a path is counted under: its first depth components, files count under their directory."""
+    parts = path.strip('/').split('/')[:-1]
+    return '/'.join(parts[:depth]) or '.'
+
+
+def aggregate(entries, depth=DEFAULT_DEPTH):
+    """Sum the changes per prefix. Returns ({prefix: counters}, totals)."""
+    prefixes = {}
+    totals = dict.fromkeys(COUNTERS, 0)
+    for entry in entries:
+        counters = prefixes.get(prefix := prefix_of(entry['path'], depth))
+        if counters is None:
+            counters = prefixes[prefix] = dict.fromkeys(COUNTERS, 0)
+        for change in entry.get('changes', []):
+            kind = change.get('type')
+            if kind == 'added':
+                values = {'added_bytes': change.get('size', 0), 'added_files': 1}
+            elif kind == 'removed':
+                values = {'removed_bytes': change.get('size', 0), 'removed_files': 1}
+            elif kind == 'modified':
+                values = {'added_bytes': change.get('added', 0), 'removed_bytes': change.get('removed', 0),
+                          'modified_files': 1}
+            else:
+                # Directories, links, mode, owner and time changes do not move any data
+                continue
+            for key, value in values.items():
+                counters[key] += value
+                totals[key] += value
+    return prefixes, totals
+
+
+def top_churners(prefixes, count=DEFAULT_TOP):
+    return heapq.nlargest(count, prefixes.items(), key=lambda item: item[1]['added_bytes'] + item[1]['removed_bytes'])
+
+
+def human(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def print_report(archive1, archive2, prefixes, totals, count=DEFAULT_TOP):
+    print(f"Churn from {archive1} to {archive2}:")
+    print(f"  added {human(totals['added_bytes'])}, removed {human(totals['removed_bytes'])}, "
+          f"net {human(totals['added_bytes'] - totals['removed_bytes'])}; "
+          f"{totals['added_files']} files added, {totals['removed_files']} removed, {totals['modified_files']} modified")
+    print()
+    print(f"{'added':>10} {'removed':>10} {'net':>10} {'+files':>7} {'-files':>7} {'~files':>7}  prefix")
+    for prefix, counters in top_churners(prefixes, count):
+        print(f"{human(counters['added_bytes']):>10} {human(counters['removed_bytes']):>10} "
+              f"{human(counters['added_bytes'] - counters['removed_bytes']):>10} {counters['added_files']:>7} "
+              f"{counters['removed_files']:>7} {counters['modified_files']:>7}  {prefix}")
+
+
+def save_report(path, repo, archive1, archive2, depth, prefixes, totals):
+    report = {'repo': repo, 'archive1': archive1, 'archive2': archive2, 'depth': depth, 'totals': totals,
+              'prefixes': [dict(counters, prefix=prefix) for prefix, counters in top_churners(prefixes, len(prefixes))]}
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the churn between two borg archives per directory prefix")
+    parser.add_argument('archives', nargs='*', metavar='ARCHIVE',
+                        help="Two archives to compare (default: the last two runs)")
+    parser.add_argument('--glob', help="Pick the last two runs among archives matching this glob (default: HOSTNAME-*)")
+    parser.add_argument('--path', action='append', default=[], help="Only compare this archive path")
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help="Path components per prefix")
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help="Number of prefixes to print")
+    parser.add_argument('--json', metavar='FILE', help="Save the full result as JSON")
+    parser.add_argument('--profile', action='store_true', help="Profile the run with cProfile")
+    args = parser.parse_args()
+    if len(args.archives) not in (0, 2):
+        parser.error("give two archives or none")
+    setup_logging(stage='churn-report')
+    start_trace('churn-report', profile=args.profile or None)
+
+    with open(CONFIG_FILE, 'r') as f:
+        config = yaml.safe_load(f)
+    repo = backup_repo(config)
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+
+    try:
+        if args.archives:
+            archive1, archive2 = args.archives
+        else:
+            archive1, archive2 = last_two_archives(repo, env, args.glob or f"{socket.gethostname()}-*")
+        with span('borg_diff', archive1=archive1, archive2=archive2) as stage:
+            prefixes, totals = aggregate(diff_entries(repo, archive1, archive2, env, args.path), args.depth)
+            stage.update(totals)
+    except (ValueError, subprocess.CalledProcessError) as e:
+        logging.error(f"Churn report failed: {e}")
+        print(f"Churn report failed: {e}")
+        sys.exit(1)
+
+    print_report(archive1, archive2, prefixes, totals, args.top)
+    if args.json:
+        save_report(args.json, repo, archive1, archive2, args.depth, prefixes, totals)
+        print(f"\nSaved the full report to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
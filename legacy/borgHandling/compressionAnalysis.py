@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+compressionAnalysis.py
+
+Estimates how compressible the data under each backup path is, and turns that
+into a borg compression plan. Each path is split into its immediate children
+(e.g. /var -> /var/log, /var/lib, ...). A weighted random sample of files is
+taken from each child. The first bytes of every sampled file are checked
+against well known compressed formats, and a small chunk is compressed with
+zlib to estimate the ratio.
+
+The result is cached in CACHE_FILE and only refreshed once it is older than
+`max_age_hours` or the list of paths changes.
+
+Enable it by setting `compression: adaptive` in the backup section:
+
+    backup:
+      compression: adaptive
+      compression_analysis:
+        mode: auto          # auto -> one run with auto,zstd,N; split -> one run per group
+        depth: 1            # how far below each backup path to analyse
+        max_age_hours: 168
+        compressible_level: 6
+        mixed_level: 3
+"""
+
+import heapq
+import json
+import logging
+import os
+import random
+import time
+import zlib
+
+CACHE_FILE = '/var/cache/CodeMonkeyCyber/Persephone/compressionAnalysis.json'
+
+# Sampling limits per analysed path
+SAMPLE_FILES = 64
+MAX_FILES_VISITED = 20000
+CHUNK_SIZE = 64 * 1024
+
+# Ratio thresholds (compressed size / original size)
+INCOMPRESSIBLE_RATIO = 0.90
+COMPRESSIBLE_RATIO = 0.50
+
+DEFAULT_ANALYSIS = {
+    'mode': 'auto',
+    'depth': 1,
+    'max_age_hours': 168,
+    'compressible_level': 6,
+    'mixed_level': 3,
+}
+
+# File signatures of formats that are already compressed
+COMPRESSED_MAGIC = (
+    b'\x1f\x8b',              # gzip
+    b'PK\x03\x04',            # zip, jar, docx, ...
+    b'\x28\xb5\x2f\xfd',      # zstd
+    b'\xfd7zXZ\x00',          # xz
+    b'BZh',                   # bzip2
+    b'\x04\x22\x4d\x18',      # lz4
+    b'7z\xbc\xaf\x27\x1c',    # 7z
+    b'Rar!',                  # rar
+    b'\x89PNG',               # png
+    b'\xff\xd8\xff',          # jpeg
+    b'GIF8',                  # gif
+    b'OggS',                  # ogg
+    b'fLaC',                  # flac
+    b'ID3',                   # mp3
+    b'\x1a\x45\xdf\xa3',      # mkv, webm
+)
+
+
+def is_compressed_format(header):
+    """Return True if the file header matches a known compressed format."""
+    if header.startswith(COMPRESSED_MAGIC):
+        return True
+    # mp4, mov, heic and friends keep their signature at offset 4
+    return header[4:8] == b'ftyp'
+
+
+def iter_files(path, max_files=MAX_FILES_VISITED):
+    """Yield (file_path, size) for regular files below path, up to max_files."""
+    if os.path.isfile(path) and not os.path.islink(path):
+        yield path, os.path.getsize(path)
+        return
+
+    visited = 0
+    stack = [path]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.path, entry.stat(follow_symlinks=False).st_size
+                            visited += 1
+                            if visited >= max_files:
+                                return
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.debug(f"Skipping {current} during compression sampling: {e}")
+
+
+def weighted_sample(items, count, rng=None):
+    """Pick count (item, size) pairs at random, weighted by size (A-Res reservoir sampling)."""
+    rng = rng or random.Random()
+    reservoir = []
+    for position, (item, size) in enumerate(items):
+        if size == 0:
+            continue
+        key = rng.random() ** (1.0 / size)
+        if len(reservoir) < count:
+            heapq.heappush(reservoir, (key, position, item, size))
+        elif key > reservoir[0][0]:
+            heapq.heapreplace(reservoir, (key, position, item, size))
+    return [(item, size) for _, _, item, size in reservoir]
+
+
+def sample_files(path, count=SAMPLE_FILES, rng=None):
+    """Pick files below path at random, weighted by size."""
+    return weighted_sample(iter_files(path), count, rng)
+
+
+def analyze_path(path, count=SAMPLE_FILES, rng=None):
+    """Estimate the compressibility of the data below path."""
+    rng = rng or random.Random()
+    sampled_bytes = 0
+    compressed_bytes = 0
+    compressed_files = 0
+    samples = sample_files(path, count, rng)
+
+    for file_path, size in samples:
+        try:
+            with open(file_path, 'rb') as f:
+                header = f.read(16)
+                if is_compressed_format(header):
+                    compressed_files += 1
+                    # No need to compress a chunk, count it as incompressible
+                    chunk_len = min(size, CHUNK_SIZE)
+                    sampled_bytes += chunk_len
+                    compressed_bytes += chunk_len
+                    continue
+                if size > CHUNK_SIZE:
+                    f.seek(rng.randrange(0, size - CHUNK_SIZE))
+                else:
+                    f.seek(0)
+                chunk = f.read(CHUNK_SIZE)
+        except OSError as e:
+            logging.debug(f"Could not sample {file_path}: {e}")
+            continue
+        if not chunk:
+            continue
+        sampled_bytes += len(chunk)
+        compressed_bytes += len(zlib.compress(chunk, 6))
+
+    ratio = compressed_bytes / sampled_bytes if sampled_bytes else 1.0
+    return {
+        'ratio': round(min(ratio, 1.0), 4),
+        'sampled_files': len(samples),
+        'sampled_bytes': sampled_bytes,
+        'compressed_format_files': compressed_files,
+    }
+
+
+def analysis_units(paths, depth=1):
+    """Expand each backup path into the entries `depth` levels below it."""
+    units = []
+    for path in paths:
+        level = [path]
+        for _ in range(depth):
+            expanded = []
+            for current in level:
+                if os.path.isdir(current) and not os.path.islink(current):
+                    try:
+                        children = sorted(os.path.join(current, name) for name in os.listdir(current))
+                    except OSError:
+                        children = []
+                    expanded.extend(children or [current])
+                else:
+                    expanded.append(current)
+            level = expanded
+        units.extend(level)
+    return units
+
+
+def load_cache(cache_file=CACHE_FILE):
+    """Load the cached analysis, or None if it is missing or unreadable."""
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cache(analysis, cache_file=CACHE_FILE):
+    """Write the analysis to the cache file."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(analysis, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.error(f"Failed to write compression analysis cache: {e}")
+
+
+def load_analysis(paths, depth=1, max_age_hours=168, cache_file=CACHE_FILE, refresh=False):
+    """Return the per-path analysis, re-sampling only if the cache is stale."""
+    cached = load_cache(cache_file)
+    if (not refresh and cached
+            and cached.get('roots') == sorted(paths)
+            and cached.get('depth') == depth
+            and time.time() - cached.get('generated', 0) < max_age_hours * 3600):
+        logging.info("Using cached compression analysis.")
+        return cached
+
+    logging.info(f"Sampling compressibility of {', '.join(paths)}.")
+    analysis = {
+        'generated': time.time(),
+        'roots': sorted(paths),
+        'depth': depth,
+        'paths': {unit: analyze_path(unit) for unit in analysis_units(paths, depth)},
+    }
+    save_cache(analysis, cache_file)
+    return analysis
+
+
+def compression_for_ratio(ratio, options):
+    """Map a compression ratio to a borg compression spec."""
+    if ratio >= INCOMPRESSIBLE_RATIO:
+        return 'lz4'
+    if ratio <= COMPRESSIBLE_RATIO:
+        return f"zstd,{options['compressible_level']}"
+    return f"auto,zstd,{options['mixed_level']}"
+
+
+def build_compression_plan(config):
+    """
+    Return a list of (compression, paths) runs for the backup.
+    Without `compression: adaptive` this is the configured compression for all paths.
+    """
+    backup = config['backup']
+    paths = backup['paths_to_backup']
+    compression = backup.get('compression', 'zstd')
+    if compression != 'adaptive':
+        return [(compression, paths)]
+
+    options = dict(DEFAULT_ANALYSIS, **(backup.get('compression_analysis') or {}))
+    analysis = load_analysis(paths, options['depth'], options['max_age_hours'])
+    results = analysis['paths']
+
+    if options['mode'] == 'split':
+        # The units are listed fresh on every run, only the ratios come from the cache. Units created
+        # since the analysis (a new home directory) go into the mixed group until the next one.
+        groups = {}
+        for unit in analysis_units(paths, options['depth']):
+            result = results.get(unit)
+            spec = compression_for_ratio(result['ratio'], options) if result else f"auto,zstd,{options['mixed_level']}"
+            groups.setdefault(spec, []).append(unit)
+        return sorted(groups.items())
+
+    # Single run: let borg's auto mode skip incompressible chunks, pick the zstd level from the overall ratio
+    total = sum(result['sampled_bytes'] for result in results.values())
+    ratio = sum(result['ratio'] * result['sampled_bytes'] for result in results.values()) / total if total else 1.0
+    level = options['compressible_level'] if ratio <= COMPRESSIBLE_RATIO else options['mixed_level']
+    return [(f"auto,zstd,{level}", paths)]
+
+
+def print_analysis(config):
+    """Print the current analysis and the plan built from it."""
+    backup = config['backup']
+    options = dict(DEFAULT_ANALYSIS, **(backup.get('compression_analysis') or {}))
+    analysis = load_analysis(backup['paths_to_backup'], options['depth'], options['max_age_hours'], refresh=True)
+    for unit, result in sorted(analysis['paths'].items()):
+        spec = compression_for_ratio(result['ratio'], options)
+        print(f"{unit:40s} ratio {result['ratio']:.2f}  "
+              f"({result['compressed_format_files']}/{result['sampled_files']} already compressed)  -> {spec}")
+
+
+if __name__ == "__main__":
+    import yaml
+
+    CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+    with open(CONFIG_FILE, 'r') as file:
+        print_analysis(yaml.safe_load(file))
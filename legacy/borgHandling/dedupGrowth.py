@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+dedupGrowth.py
+
+Attributes the repository growth of every archive to the backup paths that
+caused it. `borg info` only has whole-archive totals; this walks the chunk
+list of every file with `borg debug dump-archive` (borg list has no format
+key for chunk IDs) and counts a chunk against the file's path the first time
+it is seen. Chunks already stored by an earlier archive cost nothing.
+
+Seen chunk IDs and the per-path series are kept in a SQLite database
+(STATE_DIR/dedupGrowth-<repo>.sqlite). Archives are processed oldest first
+and each one is committed together with its chunks, so every run only reads
+the archives added since the last one and an interrupted run loses nothing.
+Paths are attributed to the entry of backup.paths_to_backup that contains
+them, or to their first --depth components when no entry does.
+
+Bytes are compressed sizes where the archive records them (borg 1.2), so
+they are close to what the repository actually grew by. Chunks removed by
+prune and stored again later are not counted twice.
+
+Usage:
+    dedupGrowth.py                  # process new archives, then print the growth per path
+    dedupGrowth.py --last 14        # report over the 14 newest archives
+    dedupGrowth.py --glob 'web1-*' --json growth.json
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.tieredRepo import backup_repo
+from handleLogging.persephoneLogging import setup_logging
+from handleRetry.retryEngine import run_borg
+from handleTracing.stageTracer import span, start_trace
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_DIR = '/var/lib/CodeMonkeyCyber/Persephone'
+
+READ_SIZE = 1024 * 1024
+DEFAULT_DEPTH = 2
+DEFAULT_LAST = 7
+
+ITEMS_START = re.compile(r'"_items":\s*\[')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS archives (name TEXT PRIMARY KEY, time TEXT, new_bytes INTEGER, new_chunks INTEGER);
+CREATE TABLE IF NOT EXISTS growth (
+    archive TEXT, path TEXT, new_bytes INTEGER, new_chunks INTEGER, files INTEGER,
+    PRIMARY KEY (archive, path)
+);
+"""
+
+
+def database_file(repo, state_dir=STATE_DIR):
+    return os.path.join(state_dir, f"dedupGrowth-{hashlib.sha256(repo.encode()).hexdigest()[:16]}.sqlite")
+
+
+def open_database(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def list_archives(repo, env, glob=None):
+    """Return (name, time) of the archives, oldest first."""
+    cmd = ['borg', 'list', '--json'] + (['--glob-archives', glob] if glob else []) + [repo]
+    archives = json.loads(run_borg(cmd, 'borg_list', env=env).stdout).get('archives', [])
+    return [(archive['name'], archive.get('time') or archive.get('start')) for archive in archives]
+
+
+def dump_items(repo, archive, env):
+    """Yield the items of an archive from borg debug dump-archive, decoding one item at a time."""
+    cmd = ['borg', 'debug', 'dump-archive', f"{repo}::{archive}", '-']
+    decoder = json.JSONDecoder()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, env=env) as process:
+        buffer = ''
+        # Skip the archive metadata in front of the item list
+        while not (match := ITEMS_START.search(buffer)):
+            block = process.stdout.read(READ_SIZE)
+            if not block:
+                break
+            buffer += block
+        position = match.end() if match else len(buffer)
+        while match:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The item continues in the next block
+                block = process.stdout.read(READ_SIZE)
+                if not block:
+                    break
+                buffer = buffer[position:] + block
+                position = 0
+                continue
+            yield item
+            if position > READ_SIZE:
+                buffer = buffer[position:]
+                position = 0
+        process.stdout.read()
+    if process.returncode != 0 or not match:
+        raise subprocess.CalledProcessError(process.returncode or 1, cmd)
+
+
+def path_key(path, roots, depth=DEFAULT_DEPTH):
+    """The backup path an archive path belongs to, or its first depth components."""
+    absolute = '/' + path.lstrip('/')
+    best = None
+    for root in roots:
+        root = root.rstrip('/')
+        if (absolute == root or absolute.startswith(root + '/')) and (best is None or len(root) > len(best)):
+            best = root or '/'
+    return best or '/' + '/'.join(path.strip('/').split('/')[:depth])
+
+
+def chunk_entry(chunk):
+    """Return (id, stored bytes) of a chunk list entry, [id, size, csize] in borg 1.2, [id, size] later."""
+    return chunk[0], chunk[2] if len(chunk) > 2 else chunk[1]
+
+
+def process_archive(db, repo, name, time, env, roots, depth=DEFAULT_DEPTH):
+    """Count the chunks of one archive not seen before against its paths, in one transaction."""
+    growth = {}
+    total_bytes = total_chunks = 0
+    with db:
+        for item in dump_items(repo, name, env):
+            chunks = item.get('chunks')
+            if not chunks:
+                continue
+            entry = growth.setdefault(path_key(item['path'], roots, depth), [0, 0, 0])
+            entry[2] += 1
+            for chunk in chunks:
+                chunk_id, stored = chunk_entry(chunk)
+                if db.execute("INSERT OR IGNORE INTO chunks (id) VALUES (?)", (chunk_id,)).rowcount:
+                    entry[0] += stored
+                    entry[1] += 1
+                    total_bytes += stored
+                    total_chunks += 1
+        db.executemany("INSERT OR REPLACE INTO growth VALUES (?, ?, ?, ?, ?)",
+                       [(name, path, *values) for path, values in growth.items()])
+        db.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)", (name, time, total_bytes, total_chunks))
+    logging.info(f"Dedup growth of {name}: {total_bytes} bytes in {total_chunks} new chunks.")
+    return total_bytes
+
+
+def update(db, repo, env, roots, glob=None, depth=DEFAULT_DEPTH):
+    """Process every archive that is not in the database yet, oldest first."""
+    done = {row[0] for row in db.execute("SELECT name FROM archives")}
+    pending = [(name, time) for name, time in list_archives(repo, env, glob) if name not in done]
+    for position, (name, time) in enumerate(pending, start=1):
+        print(f"[{position}/{len(pending)}] Reading the chunks of {name}...")
+        with span('dump_archive', archive=name) as stage:
+            stage['new_bytes'] = process_archive(db, repo, name, time, env, roots, depth)
+    return len(pending)
+
+
+def series(db, last=DEFAULT_LAST, names=None):
+    """Return (archive names, {path: [new bytes per archive]}) for the last archives processed."""
+    archives = [row[0] for row in db.execute("SELECT name FROM archives ORDER BY time DESC, name DESC")
+                if names is None or row[0] in names][:last][::-1]
+    paths = {}
+    for archive_position, archive in enumerate(archives):
+        for path, new_bytes in db.execute("SELECT path, new_bytes FROM growth WHERE archive = ?", (archive,)):
+            paths.setdefault(path, [0] * len(archives))[archive_position] = new_bytes
+    return archives, paths
+
+
+def print_report(archives, paths):
+    mb = 1024 ** 2
+    if not archives:
+        print("No archives processed yet.")
+        return
+    print(f"Deduplicated growth per path over the last {len(archives)} archives ({archives[0]} .. {archives[-1]}):")
+    print(f"{'total MB':>10} {'avg MB':>9} {'last MB':>9} {'share':>6}  path")
+    grand_total = sum(sum(values) for values in paths.values()) or 1
+    for path, values in sorted(paths.items(), key=lambda item: sum(item[1]), reverse=True):
+        total = sum(values)
+        print(f"{total / mb:10.1f} {total / len(archives) / mb:9.1f} {values[-1] / mb:9.1f} "
+              f"{total * 100 / grand_total:5.1f}%  {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attribute the repository growth of each archive to backup paths")
+    parser.add_argument('--glob', help="Only archives matching this glob")
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help="Components of paths outside paths_to_backup")
+    parser.add_argument('--last', type=int, default=DEFAULT_LAST, help="Archives to report on")
+    parser.add_argument('--no-update', action='store_true', help="Report from the database without reading new archives")
+    parser.add_argument('--json', metavar='FILE', help="Save the series as JSON")
+    parser.add_argument('--profile', action='store_true', help="Profile the run with cProfile")
+    args = parser.parse_args()
+    setup_logging(stage='dedup-growth')
+    start_trace('dedup-growth', profile=args.profile or None)
+
+    with open(CONFIG_FILE, 'r') as f:
+        config = yaml.safe_load(f)
+    repo = backup_repo(config)
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+    roots = config['backup'].get('paths_to_backup', [])
+
+    db = open_database(database_file(repo))
+    names = None
+    try:
+        if not args.no_update:
+            update(db, repo, env, roots, args.glob, args.depth)
+        if args.glob:
+            names = {name for name, _ in list_archives(repo, env, args.glob)}
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Reading archives failed: {e}")
+        print(f"Reading archives failed: {e}")
+        sys.exit(1)
+
+    archives, paths = series(db, args.last, names)
+    print_report(archives, paths)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'repo': repo, 'archives': archives, 'paths': paths}, f, indent=2)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
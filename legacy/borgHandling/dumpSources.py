@@ -0,0 +1,169 @@
+"""
+dumpSources.py
+
+Streams application dumps (pg_dump, mysqldump or any command) into the
+backup run without writing them to disk first. Live database files under
+/var are not consistent, a dump is, and streaming it needs no staging disk
+and no second read pass.
+
+Every dump command writes into its own named pipe in DUMP_DIR and borg create
+reads the pipes with --read-special, so each dump is stored as one archive
+item at a stable path, DUMP_DIR/<name>, and all dumps of a group go into a
+single create. --content-from-command would need one create per dump.
+
+borg reads the pipes one after another and holds the repository lock for the
+whole create, so the dumps run one after another too. A dump is only started
+when borg opens its pipe, so its transaction stays open only while it is
+streamed, not while the dumps before it run. Each group goes into its own
+archive <hostname>-<timestamp>-dumps[-<group>] next to the filesystem
+archive, e.g. to keep the databases of different applications apart.
+
+A dump that exits non-zero would leave a truncated item behind, so its
+archive is deleted and the backup fails.
+
+    backup:
+      dumps:
+        - name: shop.pgdump
+          command: sudo -u postgres pg_dump -Fc shop      # a string runs through sh -c
+        - name: all.sql
+          command: [mysqldump, --single-transaction, --all-databases]
+          group: mysql                                    # optional
+
+Restore a dump with:
+    borg extract --stdout REPO::HOST-TIMESTAMP-dumps var/lib/CodeMonkeyCyber/Persephone/dumps/shop.pgdump | pg_restore -d shop
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.borgCommands import build_create_cmd
+from borgHandling.throttleSupervisor import run_throttled
+
+DUMP_DIR = '/var/lib/CodeMonkeyCyber/Persephone/dumps'
+DEFAULT_GROUP = 'dumps'
+
+# Already compressed dumps (pg_dump -Fc) are detected and stored as they are
+DUMP_COMPRESSION = 'auto,zstd,3'
+
+# Seconds a dump may take to exit after borg read its pipe to the end
+EXIT_TIMEOUT = 60
+
+
+def dump_groups(config):
+    """Return [(group, [dump, ...])] in config order, empty when no dumps are configured."""
+    groups = {}
+    for dump in config['backup'].get('dumps') or []:
+        if not dump.get('name') or '/' in dump['name'] or not dump.get('command'):
+            raise ValueError(f"Dump sources need a name without '/' and a command: {dump}")
+        groups.setdefault(dump.get('group') or DEFAULT_GROUP, []).append(dump)
+    return list(groups.items())
+
+
+def dump_archive_suffix(group):
+    return 'dumps' if group == DEFAULT_GROUP else f"dumps-{group}"
+
+
+def dump_command(dump):
+    command = dump['command']
+    return ['sh', '-c', command] if isinstance(command, str) else [str(arg) for arg in command]
+
+
+class DumpStream:
+    """A dump command that is started, writing straight into its named pipe, once borg opens the pipe."""
+
+    def __init__(self, dump, dump_dir=DUMP_DIR):
+        self.name = dump['name']
+        self.command = dump_command(dump)
+        self.fifo = os.path.join(dump_dir, self.name)
+        self.process = None
+        self.error = None
+        self.cancelled = False
+        os.mkfifo(self.fifo, 0o600)
+        self.stderr = tempfile.TemporaryFile()
+        self.thread = threading.Thread(target=self.stream, name=f"dump-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stream(self):
+        try:
+            # Blocks until borg opens the pipe, so the dump and its transaction only run while borg reads it
+            with open(self.fifo, 'wb') as sink:
+                if self.cancelled:
+                    return
+                self.process = subprocess.Popen(self.command, stdin=subprocess.DEVNULL, stdout=sink,
+                                                stderr=self.stderr)
+            self.process.wait()
+        except OSError as e:
+            self.error = e
+
+    def release(self):
+        """After borg exited: unblock a pipe it never opened, stop a dump that does not finish."""
+        self.cancelled = True
+        while self.thread.is_alive():
+            if self.process is None:
+                reader = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+                self.thread.join(0.1)
+                os.close(reader)
+            else:
+                self.thread.join(EXIT_TIMEOUT)
+                if self.thread.is_alive():
+                    logging.warning(f"Dump {self.name} did not exit after borg finished, terminating it.")
+                    self.process.terminate()
+                    self.thread.join()
+
+    def finish(self):
+        """Wait for the dump and clean up. Returns True when it was streamed completely."""
+        self.release()
+        self.stderr.seek(0)
+        message = self.stderr.read().decode(errors='replace').strip()
+        self.stderr.close()
+        os.unlink(self.fifo)
+        if self.process is None:
+            logging.error(f"Dump {self.name} was not started, borg did not read its pipe: {self.error or ''}")
+            return False
+        if self.process.returncode != 0 or self.error:
+            logging.error(f"Dump {self.name} failed (exit code {self.process.returncode}): {self.error or message}")
+            return False
+        logging.info(f"Dump {self.name} streamed into the archive.")
+        return True
+
+
+def prepare_dump_dir(dump_dir=DUMP_DIR):
+    """Create the pipe directory, removing pipes left by a run that was killed."""
+    os.makedirs(dump_dir, mode=0o700, exist_ok=True)
+    for entry in os.scandir(dump_dir):
+        if entry.is_fifo():
+            os.unlink(entry.path)
+
+
+def run_dump_group(archive_name, dumps, config, env, metrics=None, dryrun=False):
+    """Stream one group of dumps into archive_name. Returns the borg create result (None for a dry run)."""
+    fifos = [os.path.join(DUMP_DIR, dump['name']) for dump in dumps]
+    cmd = build_create_cmd(archive_name, fifos, DUMP_COMPRESSION) + ['--read-special']
+    if dryrun:
+        # A dry run would block on pipes nobody writes to, only show what would run
+        for dump in dumps:
+            print(f"Would stream {' '.join(dump_command(dump))} into {os.path.join(DUMP_DIR, dump['name'])}")
+        print(f"Would run: {' '.join(cmd)}")
+        return None
+
+    prepare_dump_dir()
+    streams = []
+    try:
+        for dump in dumps:
+            streams.append(DumpStream(dump))
+        result = run_throttled(cmd, config, env, metrics)
+    finally:
+        failed = [stream.name for stream in streams if not stream.finish()]
+
+    if failed:
+        # Never keep an archive whose dumps may be truncated
+        subprocess.run(['borg', 'delete', archive_name], env=env, capture_output=True)
+        raise subprocess.CalledProcessError(1, cmd, result.stdout,
+                                            f"Dump(s) {', '.join(failed)} failed, deleted {archive_name}.")
+    return result
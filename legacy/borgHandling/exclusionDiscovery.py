@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+exclusionDiscovery.py
+
+Scans paths_to_backup for data that does not need to be backed up and proposes
+exclude patterns for it, ranked by size and by how much of it changes between
+runs (the part every backup has to re-read and upload).
+
+Categories:
+  known     well known regenerable locations (docker layers, package caches, ...)
+  build     build output next to a project file (node_modules, target, dist, ...)
+  churn     very large directories where most bytes changed since the last scan
+
+Directories tagged with a valid CACHEDIR.TAG are skipped, borg create already
+leaves them out with --exclude-caches, so excluding them saves nothing.
+
+`--apply` (auto mode) adds the known and build proposals to exclude_patterns
+in the config file. Churn candidates are only ever proposed, because a busy
+database directory looks exactly like a cache.
+
+Usage:
+    exclusionDiscovery.py            # print proposals
+    exclusionDiscovery.py --apply    # also write them to the config
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.borgPatterns import compile_matcher, normalize_patterns
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/exclusionDiscovery.json'
+
+CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+# Regenerable directories, as borg fm: patterns (their contents get excluded)
+KNOWN_REGENERABLE = [
+    ('fm:var/lib/docker/overlay2', 'docker image layers, re-pulled from registries'),
+    ('fm:var/lib/containerd/*/snapshots', 'containerd image snapshots'),
+    ('fm:var/cache/apt', 'apt package cache'),
+    ('fm:var/lib/apt/lists', 'apt package lists'),
+    ('fm:var/cache/dnf', 'dnf package cache'),
+    ('fm:var/cache/yum', 'yum package cache'),
+    ('fm:var/lib/snapd/cache', 'snap package cache'),
+    ('fm:var/tmp', 'temporary files'),
+    ('fm:home/*/.cache', 'per-user caches, including browser caches'),
+    ('fm:root/.cache', 'root user cache'),
+    ('fm:home/*/.local/share/Trash', 'desktop trash'),
+    ('fm:home/*/.config/google-chrome/*/Cache', 'chrome cache'),
+    ('fm:home/*/.config/chromium/*/Cache', 'chromium cache'),
+    ('fm:home/*/.npm/_cacache', 'npm cache'),
+    ('fm:home/*/.gradle/caches', 'gradle cache'),
+    ('fm:home/*/.m2/repository', 'maven repository'),
+    ('fm:home/*/.cargo/registry', 'cargo registry'),
+    ('fm:*/node_modules', 'node_modules, reinstalled from package.json'),
+    ('fm:*/__pycache__', 'python bytecode'),
+]
+
+# Build output directories and the project files that must sit next to them
+BUILD_DIRS = {
+    'target': ('Cargo.toml', 'pom.xml'),
+    'build': ('build.gradle', 'setup.py', 'pyproject.toml', 'CMakeLists.txt', 'package.json'),
+    'dist': ('package.json', 'setup.py', 'pyproject.toml'),
+    '.venv': ('pyproject.toml', 'requirements.txt', 'setup.py'),
+    '.tox': ('tox.ini', 'setup.py', 'pyproject.toml'),
+}
+
+# Thresholds for churn candidates
+CHURN_MIN_BYTES = 1024 ** 3
+CHURN_MIN_FRACTION = 0.5
+CHURN_MAX_DEPTH = 4
+
+
+def is_cachedir(path):
+    """Return True if path contains a valid CACHEDIR.TAG."""
+    try:
+        with open(os.path.join(path, 'CACHEDIR.TAG'), 'rb') as f:
+            return f.read(len(CACHEDIR_SIGNATURE)) == CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+def is_build_dir(path):
+    """Return True if path is a build output directory of a project."""
+    markers = BUILD_DIRS.get(os.path.basename(path))
+    if not markers:
+        return False
+    parent = os.path.dirname(path)
+    return any(os.path.exists(os.path.join(parent, marker)) for marker in markers)
+
+
+class Scanner:
+    """Walks the backup paths once, sizing every directory and collecting candidates."""
+
+    def __init__(self, exclude_patterns, since):
+        self.since = since
+        self.excluded = [compile_matcher(pattern) for pattern in normalize_patterns(exclude_patterns)]
+        self.known = [(pattern, reason, compile_matcher(pattern)) for pattern, reason in KNOWN_REGENERABLE]
+        self.candidates = {}
+        self.directories = {}
+
+    def add_candidate(self, category, pattern, reason, size, churn):
+        candidate = self.candidates.setdefault(pattern, {
+            'category': category, 'pattern': pattern, 'reason': reason, 'bytes': 0, 'churn_bytes': 0, 'matches': 0,
+        })
+        candidate['bytes'] += size
+        candidate['churn_bytes'] += churn
+        candidate['matches'] += 1
+
+    def size_tree(self, path):
+        """Return (bytes, bytes changed since self.since) below path."""
+        size = 0
+        churn = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_size, sub_churn = self.size_tree(entry.path)
+                            size += sub_size
+                            churn += sub_churn
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            size += st.st_size
+                            if st.st_mtime >= self.since:
+                                churn += st.st_size
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.debug(f"Skipping {path} during exclusion discovery: {e}")
+        return size, churn
+
+    def scan(self, path, depth=0):
+        """Scan a directory, returning (bytes, churn bytes) of what is still backed up below it."""
+        relative = path.lstrip('/')
+        # A pattern like var/tmp/* excludes the contents but not the directory, so probe a path below it too
+        probe = f"{relative}/persephone-probe"
+        if any(match(relative) or match(probe) for match in self.excluded):
+            return 0, 0
+
+        # --exclude-caches already keeps tagged directories out of every backup
+        if is_cachedir(path):
+            return 0, 0
+        for pattern, reason, match in self.known:
+            if match(relative):
+                self.add_candidate('known', f"{pattern}/*", reason, *self.size_tree(path))
+                return 0, 0
+        if is_build_dir(path):
+            self.add_candidate('build', f"pp:{relative}", 'build output of a project', *self.size_tree(path))
+            return 0, 0
+
+        size = 0
+        churn = 0
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_size, sub_churn = self.scan(entry.path, depth + 1)
+                            size += sub_size
+                            churn += sub_churn
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            size += st.st_size
+                            if st.st_mtime >= self.since:
+                                churn += st.st_size
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.debug(f"Skipping {path} during exclusion discovery: {e}")
+
+        # Backup roots themselves are never proposed
+        if 1 <= depth <= CHURN_MAX_DEPTH:
+            self.directories[path] = (size, churn)
+        return size, churn
+
+    def churn_candidates(self):
+        """Add high-churn directories, preferring the deepest one so parents are not reported twice."""
+        chosen = []
+        for path, (size, churn) in sorted(self.directories.items(), key=lambda item: -item[0].count('/')):
+            if size < CHURN_MIN_BYTES or churn < size * CHURN_MIN_FRACTION:
+                continue
+            if any(other.startswith(path + '/') or path.startswith(other + '/') for other in chosen):
+                continue
+            chosen.append(path)
+            self.add_candidate('churn', f"pp:{path.lstrip('/')}", f"{churn * 100 // size}% changed since last scan",
+                               size, churn)
+
+
+def load_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, state_file=STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, state_file)
+    except OSError as e:
+        logging.error(f"Failed to save exclusion discovery state: {e}")
+
+
+def discover(backup_config, state_file=STATE_FILE):
+    """Scan the backup paths and return the candidates, largest per-run churn first."""
+    state = load_state(state_file)
+    # Churn is measured since the previous scan, or over the last day on the first scan
+    since = state.get('last_scan', time.time() - 86400)
+    scanner = Scanner(backup_config.get('exclude_patterns', []), since)
+    for path in backup_config.get('paths_to_backup', []):
+        scanner.scan(path)
+    scanner.churn_candidates()
+
+    state['last_scan'] = time.time()
+    save_state(state, state_file)
+    return sorted(scanner.candidates.values(), key=lambda c: (-c['churn_bytes'], -c['bytes']))
+
+
+def apply_candidates(config, candidates, config_file=CONFIG_FILE):
+    """Add the safe candidates to exclude_patterns and save the config. Returns the added patterns."""
+    existing = normalize_patterns(config['backup'].get('exclude_patterns', []))
+    added = [c['pattern'] for c in candidates if c['category'] != 'churn' and c['pattern'] not in existing]
+    if added:
+        config['backup']['exclude_patterns'] = list(config['backup'].get('exclude_patterns') or []) + added
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config, f)
+        logging.info(f"Added exclude patterns: {', '.join(added)}")
+    return added
+
+
+def print_candidates(candidates):
+    """Print the candidates with projected savings."""
+    if not candidates:
+        print("No exclusion candidates found.")
+        return
+    print(f"{'category':9s} {'size':>10s} {'per run':>10s}  pattern")
+    for c in candidates:
+        print(f"{c['category']:9s} {c['bytes'] / 1024 ** 3:>8.2f}GB {c['churn_bytes'] / 1024 ** 3:>8.2f}GB  "
+              f"{c['pattern']}  ({c['reason']}, {c['matches']} match{'es' if c['matches'] != 1 else ''})")
+    total = sum(c['churn_bytes'] for c in candidates)
+    print(f"\nProjected savings: {total / 1024 ** 3:.2f} GB less read and uploaded per run (changes since the last scan).")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find cache and regenerable data worth excluding from backups")
+    parser.add_argument('--apply', action='store_true', help="Add the known and build proposals to the config")
+    parser.add_argument('--config', default=CONFIG_FILE, help="Path to the Persephone borg config")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+
+    candidates = discover(config['backup'])
+    print_candidates(candidates)
+    if args.apply:
+        added = apply_candidates(config, candidates, args.config)
+        print(f"Added {len(added)} exclude pattern(s) to {args.config}." if added else "Nothing new to add.")
+
+
+if __name__ == "__main__":
+    main()
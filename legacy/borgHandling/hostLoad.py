@@ -0,0 +1,106 @@
+"""
+hostLoad.py
+
+Readers for the host load signals used to throttle and schedule backups:
+load average, pressure stall information (PSI) and network interface
+counters. Every reader returns None when the kernel does not provide the
+signal (e.g. PSI needs Linux 4.20+ with CONFIG_PSI), so callers can simply
+ignore signals that are not available.
+"""
+
+import os
+
+
+def load_per_cpu():
+    """Return the 1 minute load average divided by the number of CPUs."""
+    try:
+        with open('/proc/loadavg', 'r') as f:
+            return float(f.read().split()[0]) / (os.cpu_count() or 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def pressure(resource, window='avg10'):
+    """Return the 'some' stall percentage of cpu, io or memory over the window."""
+    try:
+        with open(f'/proc/pressure/{resource}', 'r') as f:
+            for line in f:
+                if line.startswith('some '):
+                    fields = dict(field.split('=') for field in line.split()[1:])
+                    return float(fields[window])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def default_interface():
+    """Return the interface of the default route."""
+    try:
+        with open('/proc/net/route', 'r') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == '00000000':
+                    return fields[0]
+    except (OSError, IndexError):
+        pass
+    return None
+
+
+def link_speed_bytes(interface):
+    """Return the link speed of an interface in bytes/s, or None for virtual or unknown links."""
+    try:
+        with open(f'/sys/class/net/{interface}/speed', 'r') as f:
+            mbps = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return mbps * 125000 if mbps > 0 else None
+
+
+def interface_bytes(interface):
+    """Return (received bytes, transmitted bytes) of an interface."""
+    try:
+        with open('/proc/net/dev', 'r') as f:
+            for line in f:
+                name, _, counters = line.partition(':')
+                if name.strip() == interface:
+                    fields = counters.split()
+                    return int(fields[0]), int(fields[8])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def process_tree(pid):
+    """Return pid and the pids of all its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name may contain spaces, the parent pid follows its closing parenthesis
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def written_bytes(pids):
+    """Return the bytes written by the processes (including sockets), from /proc/<pid>/io."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/io', 'r') as f:
+                for line in f:
+                    if line.startswith('wchar:'):
+                        total += int(line.split()[1])
+        except (OSError, ValueError):
+            continue
+    return total
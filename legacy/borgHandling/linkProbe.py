@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+linkProbe.py
+
+Picks the compression level for a remote borg repository from the measured
+bandwidth to the repo server and the local single-core compression speed.
+Borg compresses on one core, so the end-to-end rate of a candidate is
+
+    min(compression speed, bandwidth / compression ratio)
+
+and the candidate with the highest rate wins.
+
+The link is probed with a short timed upload over the same rsh borg uses
+(`cat > /dev/null` on the repo host). After every backup the measured MB/s is
+fed back with record_run(), which corrects the bandwidth or CPU estimate used
+for the next run. Only runs that mostly sent new data are fed back: when most
+chunks deduplicate, borg spends the run reading and hashing files and the
+duration says nothing about the link or the compressor. Tiered runs are not
+fed back either, borg writes them to the local tier. State is kept in
+STATE_FILE.
+
+Enable it with `compression: link-adaptive`:
+
+    backup:
+      compression: link-adaptive
+      link_probe:
+        probe_mb: 8
+        probe_interval_hours: 24
+        candidates: ['lz4', 'zstd,1', 'zstd,3', 'zstd,6', 'zstd,9']
+
+To test without a remote server, point the repo at localhost and throttle the
+link, e.g. `rsh: trickle -s -u 2048 ssh` or a netem qdisc on the loopback.
+"""
+
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import time
+
+from borgHandling.compressionAnalysis import CHUNK_SIZE, sample_files
+
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/linkProbe.json'
+
+SAMPLE_BYTES = 16 * 1024 * 1024
+
+DEFAULT_PROBE = {
+    'probe_mb': 8,
+    'probe_interval_hours': 24,
+    'candidates': ['lz4', 'zstd,1', 'zstd,3', 'zstd,6', 'zstd,9'],
+}
+
+# Typical single-core speeds (bytes/s) and ratios, used when no compressor CLI is available
+FALLBACK_SPEEDS = {
+    'none': (2000e6, 1.0),
+    'lz4': (700e6, 0.55),
+    'zstd,1': (450e6, 0.40),
+    'zstd,3': (300e6, 0.37),
+    'zstd,6': (110e6, 0.35),
+    'zstd,9': (60e6, 0.34),
+    'zstd,12': (25e6, 0.33),
+}
+
+# Weight of the newest measurement when blending estimates between runs
+EWMA_ALPHA = 0.5
+
+# Share of the compressed data that must be new (not deduplicated) for a run to be fed back
+MIN_NEW_FRACTION = 0.5
+
+
+def parse_remote_repo(repo):
+    """Return (destination, port) for a remote repo, or None for a local one."""
+    match = re.match(r'^ssh://([^/:]+)(?::(\d+))?/', repo)
+    if match:
+        return match.group(1), match.group(2)
+    match = re.match(r'^([^/:]+@)?([^/:]+):', repo)
+    if match:
+        return f"{match.group(1) or ''}{match.group(2)}", None
+    return None
+
+
+def remote_repo_path(repo):
+    """Return the path of a remote repository on its server (relative paths are relative to the home directory)."""
+    match = re.match(r'^ssh://[^/]+/(?P<path>.*)$', repo)
+    if match:
+        path = match.group('path')
+        return path[2:] if path.startswith(('./', '~/')) else '/' + path
+    return repo.split(':', 1)[1]
+
+
+def rsh_command(config):
+    """Return the remote shell borg uses, as an argument list."""
+    rsh = config['borg'].get('rsh') or os.environ.get('BORG_RSH', 'ssh')
+    return shlex.split(rsh)
+
+
+def probe_bandwidth(rsh, destination, port=None, probe_mb=8):
+    """Measure upload bandwidth (bytes/s) to destination by timing a transfer over rsh."""
+    base_cmd = rsh + (['-p', port] if port else []) + [destination]
+    payload = os.urandom(probe_mb * 1024 * 1024)
+
+    # Time an empty round trip first so connection setup is not counted as transfer time
+    start = time.monotonic()
+    subprocess.run(base_cmd + ['true'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=120)
+    setup = time.monotonic() - start
+
+    start = time.monotonic()
+    subprocess.run(base_cmd + ['cat > /dev/null'], input=payload, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=600)
+    elapsed = max(time.monotonic() - start - setup, 0.001)
+    return len(payload) / elapsed
+
+
+def build_sample(paths, size=SAMPLE_BYTES):
+    """Collect up to size bytes of real data from the backup paths."""
+    chunks = []
+    collected = 0
+    for path in paths:
+        for file_path, _ in sample_files(path, count=32):
+            try:
+                with open(file_path, 'rb') as f:
+                    chunk = f.read(CHUNK_SIZE * 4)
+            except OSError:
+                continue
+            chunks.append(chunk)
+            collected += len(chunk)
+            if collected >= size:
+                return b''.join(chunks)
+    return b''.join(chunks)
+
+
+def compressor_command(spec):
+    """Return the CLI equivalent of a borg compression spec, or None."""
+    if spec == 'lz4' and shutil.which('lz4'):
+        return ['lz4', '-q', '-1', '-c']
+    if spec.startswith('zstd') and shutil.which('zstd'):
+        level = spec.split(',')[1] if ',' in spec else '3'
+        return ['zstd', '-q', f'-{level}', '-c', '--single-thread']
+    return None
+
+
+def measure_compression(candidates, sample):
+    """Return {spec: (bytes/s, ratio)} for each candidate on the sample data."""
+    results = {}
+    for spec in candidates:
+        cmd = compressor_command(spec)
+        if spec == 'none':
+            results[spec] = FALLBACK_SPEEDS['none']
+            continue
+        if not cmd or not sample:
+            if spec in FALLBACK_SPEEDS:
+                results[spec] = FALLBACK_SPEEDS[spec]
+            continue
+        start = time.monotonic()
+        result = subprocess.run(cmd, input=sample, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        elapsed = max(time.monotonic() - start, 0.001)
+        results[spec] = (len(sample) / elapsed, len(result.stdout) / len(sample))
+    return results
+
+
+def best_candidate(speeds, bandwidth, cpu_scale=1.0):
+    """Return (spec, predicted bytes/s) with the best end-to-end throughput."""
+    best = None
+    for spec, (speed, ratio) in speeds.items():
+        rate = min(speed * cpu_scale, bandwidth / max(ratio, 0.01))
+        # Prefer the better ratio when two candidates are within 5% of each other
+        if best is None or rate > best[1] * 1.05 or (rate >= best[1] * 0.95 and ratio < speeds[best[0]][1]):
+            best = (spec, rate)
+    return best
+
+
+def load_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, state_file=STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, state_file)
+    except OSError as e:
+        logging.error(f"Failed to save link probe state: {e}")
+
+
+def choose_compression(config, state_file=STATE_FILE):
+    """Return the compression spec for this run, probing the link when the estimate is stale."""
+    repo = config['borg']['repo']
+    fallback = 'zstd,3'
+    remote = parse_remote_repo(repo)
+    if not remote:
+        logging.info("Repository is local, link-adaptive compression falls back to zstd,3.")
+        return fallback
+
+    options = dict(DEFAULT_PROBE, **(config['backup'].get('link_probe') or {}))
+    state = load_state(state_file)
+    entry = state.get(repo, {})
+
+    try:
+        if time.time() - entry.get('probed', 0) > options['probe_interval_hours'] * 3600 or 'speeds' not in entry:
+            destination, port = remote
+            bandwidth = probe_bandwidth(rsh_command(config), destination, port, options['probe_mb'])
+            sample = build_sample(config['backup']['paths_to_backup'])
+            entry['speeds'] = measure_compression(options['candidates'], sample)
+            # Blend with the estimate learned from previous runs
+            if entry.get('bandwidth'):
+                bandwidth = EWMA_ALPHA * bandwidth + (1 - EWMA_ALPHA) * entry['bandwidth']
+            entry['bandwidth'] = bandwidth
+            entry['probed'] = time.time()
+            logging.info(f"Measured {bandwidth / 1e6:.1f} MB/s to {destination}.")
+    except (subprocess.SubprocessError, OSError) as e:
+        logging.error(f"Link probe failed, using {entry.get('level', fallback)}: {e}")
+        return entry.get('level', fallback)
+
+    spec, predicted = best_candidate(entry['speeds'], entry['bandwidth'], entry.get('cpu_scale', 1.0))
+    entry.update({'level': spec, 'predicted': predicted})
+    state[repo] = entry
+    save_state(state, state_file)
+    logging.info(f"Link-adaptive compression picked {spec} (predicted {predicted / 1e6:.1f} MB/s).")
+    return spec
+
+
+def record_run(config, stats, duration, state_file=STATE_FILE):
+    """
+    Feed the measured throughput of a finished run back into the estimates.
+    stats are the archive stats borg reported, the deduplicated size is what was sent.
+    """
+    repo = config['borg']['repo']
+    state = load_state(state_file)
+    entry = state.get(repo)
+    if not entry or not entry.get('level') or duration <= 0 or entry['level'] not in entry.get('speeds', {}):
+        return
+    sent_bytes = stats.get('deduplicated_size', 0)
+    new_fraction = sent_bytes / max(stats.get('compressed_size', 0), 1)
+    if new_fraction < MIN_NEW_FRACTION:
+        logging.info(f"Only {new_fraction:.0%} of the backup was new data, not feeding its throughput back.")
+        return
+
+    speed, ratio = entry['speeds'][entry['level']]
+    link_measured = sent_bytes / duration
+    compressed_measured = link_measured / max(ratio, 0.01)
+    cpu_rate = speed * entry.get('cpu_scale', 1.0)
+    link_rate = entry['bandwidth'] / max(ratio, 0.01)
+
+    # Correct whichever side was predicted to be the bottleneck
+    if link_rate <= cpu_rate:
+        entry['bandwidth'] = EWMA_ALPHA * link_measured + (1 - EWMA_ALPHA) * entry['bandwidth']
+    else:
+        entry['cpu_scale'] = EWMA_ALPHA * (compressed_measured / speed) + (1 - EWMA_ALPHA) * entry.get('cpu_scale', 1.0)
+
+    entry['measured'] = compressed_measured
+    state[repo] = entry
+    save_state(state, state_file)
+    logging.info(f"Backup ran at {compressed_measured / 1e6:.1f} MB/s with {entry['level']}.")
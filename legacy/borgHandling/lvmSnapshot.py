@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+"""
+lvmSnapshot.py
+
+Snapshot mode: borg reads read-only LVM snapshots of the logical volumes that
+back paths_to_backup instead of the live filesystems, so the backup is
+consistent per volume while services keep running. The only frozen window is
+lvcreate suspending the volume for the snapshot.
+
+For every path the mount containing it is looked up with findmnt. LV-backed
+mounts, and LV-backed mounts below the paths, get a snapshot which is mounted
+read-only at MOUNT_ROOT/<original mount point>; other mounts below the paths
+(NFS, tmpfs) are bind mounted read-only there and stay live. borg runs in
+MOUNT_ROOT with the paths made relative, so the archive paths are the same as
+without snapshots (/srv/data is stored as srv/data either way) and the
+patterns keep matching. Paths on filesystems that are not LVs are read live.
+Snapshots of different volumes are taken one after another, not atomically.
+
+The copy-on-write space of a (thick) snapshot has to hold everything written
+to the volume while the backup runs. It is sized from the write rate, the
+higher of a short sample of the volume's written sectors and the rate the
+last run's snapshot actually filled up at, times the last run's duration and
+the headroom factor. All snapshots of a volume group together take at most
+max_vg_share of its free space; a volume group too full for min_size_mb per
+snapshot fails the backup. Thin volumes get thin snapshots without a size.
+A snapshot that overflows is invalidated by LVM and the backup fails.
+
+Snapshots are tagged persephone_snapshot and everything is unmounted and
+removed after the run, also when it fails. A run holds LOCK_FILE while its
+snapshots exist; a run that overlaps it fails without touching them, one
+that finds the lock free removes the leftovers of a killed run first.
+btrfs volumes are refused: a snapshot has the same filesystem UUID as its
+origin and cannot be mounted next to it safely.
+
+    backup:
+      snapshots:
+        mode: lvm
+        mount_root: /run/CodeMonkeyCyber/Persephone/snapshots
+        headroom: 2.0               # COW space = write rate x duration x headroom
+        min_size_mb: 256
+        max_vg_share: 0.9           # share of the free extents snapshots may use
+        sample_seconds: 5
+        expected_duration: 3600     # seconds, until a run has been measured
+
+Keep mount_root the same between runs: borg's files cache is keyed by path,
+and the first run from snapshots reads every file once more.
+
+Try it on a loop-device-backed volume group (as root):
+    truncate -s 2G /tmp/persephone-pv.img
+    losetup -f --show /tmp/persephone-pv.img          # prints /dev/loopN
+    pvcreate /dev/loopN && vgcreate persephone-test /dev/loopN
+    lvcreate -L 1G -n data persephone-test && mkfs.ext4 /dev/persephone-test/data
+    mkdir -p /mnt/data && mount /dev/persephone-test/data /mnt/data
+
+Usage:
+    lvmSnapshot.py --plan /mnt/data     # show the volumes and COW sizes
+    lvmSnapshot.py /mnt/data            # snapshot, mount, list the snapshot paths, tear down
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import setup_logging
+from handleTracing.stageTracer import span
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/snapshots.json'
+LOCK_FILE = '/run/CodeMonkeyCyber/Persephone/snapshots.lock'
+
+DEFAULT_SNAPSHOTS = {
+    'mode': None,
+    'mount_root': '/run/CodeMonkeyCyber/Persephone/snapshots',
+    'headroom': 2.0,
+    'min_size_mb': 256,
+    'max_vg_share': 0.9,
+    'sample_seconds': 5,
+    'expected_duration': 3600,
+}
+
+TAG = 'persephone_snapshot'
+SUFFIX = '-persephone'
+SECTOR = 512
+MB = 1024 ** 2
+
+# Snapshots that lived shorter are mostly fixed overhead, their fill rate is not recorded
+MIN_MEASURED_SECONDS = 60
+
+LV_FIELDS = 'vg_name,lv_name,lv_attr,lv_size,vg_free,vg_extent_size,lv_kernel_major,lv_kernel_minor'
+
+
+class SnapshotError(Exception):
+    """The snapshots could not be created or did not stay valid."""
+
+
+def snapshot_settings(config):
+    """Return the snapshot settings, or None when backups read the live filesystems."""
+    snapshots = config['backup'].get('snapshots')
+    if not snapshots or snapshots.get('mode') != 'lvm':
+        return None
+    return dict(DEFAULT_SNAPSHOTS, **snapshots)
+
+
+def run(cmd):
+    return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+
+
+def unescape(value):
+    """Undo the \\xNN escaping of findmnt --raw."""
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), value)
+
+
+def list_mounts():
+    """Return [(source, target, fstype)] of all mounts."""
+    mounts = []
+    for line in run(['findmnt', '-rn', '-o', 'SOURCE,TARGET,FSTYPE']).splitlines():
+        fields = line.split(' ')
+        if len(fields) == 3:
+            mounts.append(tuple(unescape(field) for field in fields))
+    return mounts
+
+
+def is_below(path, directory):
+    return directory == '/' or path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
+def containing_mount(path, mounts):
+    """The mount a path is on: the one with the longest target above it."""
+    candidates = [mount for mount in mounts if is_below(path, mount[1])]
+    return max(candidates, key=lambda mount: len(mount[1])) if candidates else None
+
+
+def logical_volume(source):
+    """Return the lvs fields of the LV behind a device, or None when it is not an LV."""
+    # Bind mounts of a subdirectory show up as /dev/mapper/vg-lv[/dir]
+    if not source.startswith('/dev/') or '[' in source:
+        return None
+    try:
+        output = run(['lvs', '--noheadings', '--nameprefixes', '--units', 'b', '--nosuffix', '-o', LV_FIELDS, source])
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    fields = dict(item.split('=', 1) for item in shlex.split(output.strip()))
+    volume = {key[len('LVM2_'):].lower(): value for key, value in fields.items()}
+    for key in ('lv_size', 'vg_free', 'vg_extent_size', 'lv_kernel_major', 'lv_kernel_minor'):
+        volume[key] = int(volume[key])
+    return volume
+
+
+def sectors_written(volume):
+    """Sectors written to a volume since boot, from its block device statistics."""
+    try:
+        with open(f"/sys/dev/block/{volume['lv_kernel_major']}:{volume['lv_kernel_minor']}/stat", 'r') as f:
+            return int(f.read().split()[6])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def sample_write_rates(volumes, seconds):
+    """Return {key: bytes/s written} over a short sample of all volumes at once."""
+    before = {volume['key']: sectors_written(volume) for volume in volumes}
+    time.sleep(seconds)
+    return {volume['key']: max(0, sectors_written(volume) - before[volume['key']]) * SECTOR / seconds
+            for volume in volumes}
+
+
+def load_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state, state_file=STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        with open(f"{state_file}.tmp", 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{state_file}.tmp", state_file)
+    except OSError as e:
+        logging.warning(f"Could not save the snapshot state: {e}")
+
+
+def plan_sizes(volumes, rates, settings, state):
+    """
+    Return {key: COW bytes} for the thick volumes, scaled down to max_vg_share of
+    each volume group's free space. Raises SnapshotError when a group is too full.
+    """
+    minimum = settings['min_size_mb'] * MB
+    sizes = {}
+    groups = {}
+    for volume in volumes:
+        if not volume['thin']:
+            groups.setdefault(volume['vg_name'], []).append(volume)
+    for vg, members in groups.items():
+        extent = members[0]['vg_extent_size']
+        wanted = {}
+        for volume in members:
+            previous = state.get(volume['key'], {})
+            rate = max(rates.get(volume['key'], 0), previous.get('rate', 0))
+            duration = previous.get('duration') or settings['expected_duration']
+            # Never more than the volume itself, a full copy of it always fits
+            size = min(max(minimum, rate * duration * settings['headroom']), volume['lv_size'])
+            wanted[volume['key']] = math.ceil(size / extent) * extent
+
+        budget = int(members[0]['vg_free'] * settings['max_vg_share'])
+        total = sum(wanted.values())
+        if total > budget:
+            # Every snapshot keeps its minimum, the rest of the budget is shared in proportion to the need
+            floors = {volume['key']: math.ceil(min(minimum, volume['lv_size']) / extent) * extent for volume in members}
+            if sum(floors.values()) > budget:
+                raise SnapshotError(f"Volume group {vg} has {members[0]['vg_free'] // MB} MB free, not enough for "
+                                    f"snapshots of {', '.join(sorted(wanted))}.")
+            logging.warning(f"Snapshots of {vg} would need {total // MB} MB, {budget // MB} MB is available; "
+                            f"sizing them down.")
+            spare = budget - sum(floors.values())
+            extra = total - sum(floors.values())
+            wanted = {key: floors[key] + (size - floors[key]) * spare // extra // extent * extent
+                      for key, size in wanted.items()}
+        sizes.update(wanted)
+    return sizes
+
+
+def stale_cleanup(mount_root):
+    """Unmount and remove what a killed run left behind."""
+    for _, target, _ in sorted(list_mounts(), key=lambda mount: len(mount[1]), reverse=True):
+        if is_below(target, mount_root) and target != mount_root:
+            subprocess.run(['umount', '-l', target], capture_output=True)
+    try:
+        leftovers = run(['lvs', '--noheadings', '-o', 'lv_full_name', f"@{TAG}"]).split()
+    except (subprocess.CalledProcessError, OSError):
+        leftovers = []
+    for name in leftovers:
+        logging.warning(f"Removing snapshot {name} left by an earlier run.")
+        subprocess.run(['lvremove', '-y', name], capture_output=True)
+
+
+class SnapshotSet:
+    """The snapshots and mounts of one backup run."""
+
+    def __init__(self, paths, settings):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.settings = settings
+        self.mount_root = settings['mount_root'].rstrip('/')
+        self.volumes = []
+        self.binds = []
+        self.snapshot_paths = set()
+        self.mounted = []
+        self.created_dirs = []
+        self.created = []
+        self.start = None
+        self.lock = None
+
+    def discover(self):
+        """Find the LV-backed mounts (to snapshot) and other mounts (to bind) the paths need."""
+        mounts = list_mounts()
+        seen = set()
+        for path in self.paths:
+            mount = containing_mount(path, mounts)
+            volume = mount and logical_volume(mount[0])
+            if not volume:
+                logging.warning(f"{path} is not on an LVM logical volume, it is backed up live.")
+                continue
+            self.snapshot_paths.add(path)
+            below = [other for other in mounts if other[1] != mount[1] and is_below(other[1], path)]
+            for source, target, fstype in [mount] + below:
+                if target in seen:
+                    continue
+                seen.add(target)
+                volume = logical_volume(source)
+                if is_below(target, self.mount_root):
+                    continue
+                if volume and fstype == 'btrfs':
+                    raise SnapshotError(f"{target} is btrfs on {source}, an LVM snapshot of it cannot be mounted "
+                                        f"next to the origin safely. Turn snapshot mode off or use btrfs snapshots.")
+                if volume:
+                    volume.update(target=target, fstype=fstype, key=f"{volume['vg_name']}/{volume['lv_name']}",
+                                  thin=volume['lv_attr'].startswith('V'))
+                    self.volumes.append(volume)
+                else:
+                    self.binds.append(target)
+        return self.volumes
+
+    def plan(self):
+        volumes = self.discover()
+        rates = sample_write_rates(volumes, self.settings['sample_seconds']) if volumes else {}
+        return rates, plan_sizes(volumes, rates, self.settings, load_state())
+
+    def mount_point(self, target):
+        return self.mount_root + (target if target != '/' else '')
+
+    def make_dir(self, path):
+        """Create path and its missing parents, remembering them for the teardown."""
+        missing = []
+        while not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            os.mkdir(directory)
+            self.created_dirs.append(directory)
+
+    def acquire_lock(self):
+        """Hold LOCK_FILE while the snapshots exist, so an overlapping run cannot remove them."""
+        os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+        self.lock = open(LOCK_FILE, 'a+')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.seek(0)
+            holder = self.lock.read().strip()
+            self.lock.close()
+            self.lock = None
+            raise SnapshotError(f"Another backup (pid {holder or 'unknown'}) is using the snapshots, not starting.")
+        self.lock.truncate(0)
+        self.lock.write(str(os.getpid()))
+        self.lock.flush()
+
+    def release_lock(self):
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+
+    def create(self):
+        """Snapshot and mount everything. Failures of lvcreate and mount raise SnapshotError."""
+        self.acquire_lock()
+        try:
+            self.create_snapshots()
+        except (subprocess.CalledProcessError, OSError) as e:
+            error = (getattr(e, 'stderr', None) or str(e)).strip()
+            raise SnapshotError(f"Creating the snapshots failed: {error}") from e
+
+    def create_snapshots(self):
+        # Only runs with the lock held, so leftovers cannot belong to a running backup
+        stale_cleanup(self.mount_root)
+        _, sizes = self.plan()
+        self.make_dir(self.mount_root)
+        self.start = time.time()
+        for volume in self.volumes:
+            name = volume['lv_name'] + SUFFIX
+            cmd = ['lvcreate', '--snapshot', '--name', name, '--addtag', TAG]
+            if volume['thin']:
+                # Thin snapshots are skipped at activation unless told otherwise
+                cmd += ['--setactivationskip', 'n']
+            else:
+                cmd += ['--size', f"{sizes[volume['key']]}b"]
+            with span('lvm_snapshot', volume=volume['key']) as stage:
+                frozen = time.time()
+                run(cmd + [volume['key']])
+                stage['frozen_seconds'] = round(time.time() - frozen, 3)
+                stage['cow_bytes'] = sizes.get(volume['key'])
+            self.created.append(dict(volume, snapshot=f"{volume['vg_name']}/{name}",
+                                     device=f"/dev/{volume['vg_name']}/{name}", cow=sizes.get(volume['key'])))
+            cow = 'thin' if volume['thin'] else f"{sizes[volume['key']] // MB} MB COW"
+            logging.info(f"Snapshot {volume['vg_name']}/{name} of {volume['target']} created "
+                         f"({stage['frozen_seconds']}s frozen, {cow}).")
+
+        # Parents first, so nested mounts land inside the snapshot of their parent
+        mounts = [(snapshot['target'], snapshot) for snapshot in self.created]
+        mounts += [(target, None) for target in self.binds]
+        for target, snapshot in sorted(mounts, key=lambda mount: len(mount[0])):
+            mount_point = self.mount_point(target)
+            if not os.path.isdir(mount_point):
+                try:
+                    self.make_dir(mount_point)
+                except OSError:
+                    logging.warning(f"No mount point for {target} in the snapshot, it is not backed up.")
+                    continue
+            if snapshot:
+                options = 'ro,nouuid' if snapshot['fstype'] == 'xfs' else 'ro'
+                run(['mount', '-t', snapshot['fstype'], '-o', options, snapshot['device'], mount_point])
+            else:
+                run(['mount', '-o', 'bind,ro', target, mount_point])
+            self.mounted.append(mount_point)
+
+    def backup_paths(self, paths):
+        """The paths to give borg (running in mount_root): relative for snapshotted paths, absolute otherwise."""
+        translated = []
+        for path in paths:
+            absolute = os.path.abspath(path)
+            translated.append((absolute.lstrip('/') or '.') if absolute in self.snapshot_paths else path)
+        return translated
+
+    def usage(self):
+        """Return {snapshot: (used share of the COW space, invalid)} of the thick snapshots."""
+        usage = {}
+        for snapshot in self.created:
+            if snapshot['thin']:
+                continue
+            try:
+                fields = run(['lvs', '--noheadings', '-o', 'lv_attr,snap_percent', snapshot['snapshot']]).split()
+            except (subprocess.CalledProcessError, OSError):
+                continue
+            invalid = fields[0][4:5] == 'I'
+            used = 1.0 if invalid or len(fields) < 2 else float(fields[1].replace(',', '.')) / 100
+            usage[snapshot['snapshot']] = (used, invalid)
+        return usage
+
+    def teardown(self):
+        """Unmount and remove everything created, logging failures. Returns the snapshots that overflowed."""
+        overflowed = []
+        usage = self.usage()
+        duration = time.time() - self.start if self.start else 0
+        state = load_state()
+        measured = False
+        for snapshot in self.created:
+            if snapshot['snapshot'] not in usage:
+                continue
+            used, invalid = usage[snapshot['snapshot']]
+            logging.info(f"Snapshot {snapshot['snapshot']} used {used:.0%} of its COW space in {duration:.0f}s.")
+            if invalid:
+                overflowed.append(snapshot['snapshot'])
+            if duration >= MIN_MEASURED_SECONDS:
+                # The rate the snapshot actually filled up at seeds the size of the next run's snapshot
+                measured = True
+                state[snapshot['key']] = {'rate': round(used * snapshot['cow'] / duration),
+                                          'duration': round(duration),
+                                          'last_run': datetime.now().isoformat(timespec='seconds')}
+
+        for mount_point in reversed(self.mounted):
+            result = subprocess.run(['umount', mount_point], capture_output=True, text=True)
+            if result.returncode != 0:
+                logging.warning(f"umount {mount_point} failed ({result.stderr.strip()}), detaching it lazily.")
+                subprocess.run(['umount', '-l', mount_point], capture_output=True)
+        for snapshot in reversed(self.created):
+            result = subprocess.run(['lvremove', '-y', snapshot['snapshot']], capture_output=True, text=True)
+            if result.returncode != 0:
+                logging.error(f"Could not remove snapshot {snapshot['snapshot']}: {result.stderr.strip()}")
+        for directory in reversed(self.created_dirs):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+        if measured:
+            save_state(state)
+        self.release_lock()
+        return overflowed
+
+
+@contextmanager
+def lvm_snapshots(config, dryrun=False):
+    """
+    Yield the SnapshotSet of paths_to_backup while the snapshots are mounted, or None
+    when snapshot mode is off. Everything is torn down when the block exits.
+    """
+    settings = snapshot_settings(config)
+    if not settings or dryrun:
+        yield None
+        return
+    snapshots = SnapshotSet(config['backup']['paths_to_backup'], settings)
+    try:
+        with span('create_snapshots'):
+            snapshots.create()
+        yield snapshots
+    finally:
+        with span('remove_snapshots'):
+            overflowed = snapshots.teardown()
+    if overflowed:
+        raise SnapshotError(f"Snapshot(s) {', '.join(overflowed)} ran out of COW space, the backup is not consistent.")
+
+
+def print_plan(snapshots, rates, sizes):
+    for volume in snapshots.volumes:
+        size = 'thin' if volume['thin'] else f"{sizes[volume['key']] // MB} MB"
+        print(f"{volume['key']:30} {volume['target']:25} write rate {rates[volume['key']] / MB:8.2f} MB/s  "
+              f"COW {size:>10}  VG free {volume['vg_free'] // MB} MB")
+    for target in snapshots.binds:
+        print(f"{'(live bind mount)':30} {target}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create, mount and remove LVM snapshots of the backup paths")
+    parser.add_argument('paths', nargs='*', help="Paths to snapshot (default: backup.paths_to_backup)")
+    parser.add_argument('--plan', action='store_true', help="Only show the volumes and COW sizes")
+    parser.add_argument('--config', default=CONFIG_FILE, help="Path to the Persephone borg config")
+    args = parser.parse_args()
+    setup_logging(stage='lvm-snapshot')
+
+    settings = dict(DEFAULT_SNAPSHOTS, mode='lvm')
+    paths = args.paths
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            config = yaml.safe_load(f)
+        settings.update(config['backup'].get('snapshots') or {})
+        paths = paths or config['backup'].get('paths_to_backup', [])
+    if not paths:
+        parser.error("no paths given and none configured")
+
+    snapshots = SnapshotSet(paths, settings)
+    try:
+        if args.plan:
+            print_plan(snapshots, *snapshots.plan())
+            return
+        try:
+            snapshots.create()
+            print(f"Snapshots mounted under {snapshots.mount_root}, borg would read (from there):")
+            for path in snapshots.backup_paths(paths):
+                print(f"  {path}")
+        finally:
+            overflowed = snapshots.teardown()
+            print("Snapshots removed." + (f" Overflowed: {', '.join(overflowed)}" if overflowed else ""))
+    except (SnapshotError, subprocess.CalledProcessError) as e:
+        print(f"Error: {getattr(e, 'stderr', None) or e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,48 @@
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+from datetime import datetime
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.borgCommands import build_create_cmd, compression_plan, parse_create_stats
+from borgHandling.borgPatterns import write_patterns_file
+from borgHandling.checkpoints import (checkpoint_interval, delete_checkpoints, find_resumable,
+                                      leftover_checkpoints, list_archive_names)
+from borgHandling.dumpSources import dump_archive_suffix, dump_groups, run_dump_group
+from borgHandling.linkProbe import record_run
+from borgHandling.lvmSnapshot import SnapshotError, lvm_snapshots
+from borgHandling.shardedBackup import run_sharded_backup
+from borgHandling.throttleSupervisor import run_throttled
+from borgHandling.tieredRepo import backup_repo, start_replication, tiered_settings
+from handleMetrics.textfileExporter import job_metrics
+from handleRepo.capacityForecast import record_capacity
+from handleRetry.retryEngine import retry_call, retry_policy
+from handleTracing.stageTracer import borg_profile_args, span, start_trace
+
 def run_borg_backup(config, dryrun=False):
     """Run the Borg backup using the configuration values."""
+    start_trace('borg-backup')
+
+    # Sharded mode runs one borg create per shard repository in parallel
+    if config['backup'].get('shards'):
+        return run_sharded_backup(config, dryrun)
+
     try:
         # Start status update
         print("Starting Borg backup...")
         logging.info("Starting Borg backup.")
 
+        # Check the dump sources up front, a config error must not surface after the filesystem backup
+        dump_plan = dump_groups(config)
+
         # Extract relevant config details
-        repo = config['borg']['repo']
+        # In tiered mode borg writes to the local tier, which is replicated to borg.repo afterwards
+        repo = backup_repo(config)
         passphrase = config['borg']['passphrase']
-        paths = config['backup']['paths_to_backup']
-        compression = config['backup'].get('compression', 'zstd')  # Default to 'zstd' if not specified
 
         # Set up the environment for the passphrase
         env = os.environ.copy()
@@ -18,39 +51,106 @@ def run_borg_backup(config, dryrun=False):
         # Generate an archive name using the hostname and timestamp
         hostname = socket.gethostname()  # Get the actual hostname of the machine
         timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-        archive_name = f"{repo}::{hostname}-{timestamp}"
-
-        # Build the Borg create command
-        borg_create_cmd = ['borg', 'create', archive_name] + paths + [
-            '--verbose',
-            '--compression', compression,
-            '--list',
-            '--stats',
-            '--show-rc',
-            '--exclude-caches'
-        ]
-
-        # Add exclude patterns from config
-        for pattern in config['backup'].get('exclude_patterns', []):
-            borg_create_cmd += ['--exclude', pattern]
-
-        # Add dry-run flag if specified
-        if dryrun:
-            borg_create_cmd.append('--dry-run')
-
-        # Status update before running the command
-        print("Running Borg backup command...")
-        logging.info("Running Borg backup command.")
-        
-        # Run the Borg create command
-        result = subprocess.run(borg_create_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True)
-        
-        # Success update
-        logging.info(result.stdout)  # Log the output of the command
-        print(f"Borg backup completed successfully!\n{result.stdout}")  # Print the result to console
+
+        # Resume a run of today that was interrupted, reusing its already uploaded chunks
+        run_pattern = re.compile(rf"^{re.escape(hostname)}-(?P<timestamp>\d{{4}}-\d\d-\d\dT\d\d:\d\d:\d\d)(-.+)?$")
+        completed = set()
+        if not dryrun:
+            with span('find_checkpoints'):
+                resumable = find_resumable(list_archive_names(repo, env, f"{hostname}-*"), run_pattern)
+            if resumable:
+                timestamp, completed = resumable
+                print(f"Resuming interrupted backup {hostname}-{timestamp} from its checkpoint...")
+                logging.info(f"Resuming interrupted backup {hostname}-{timestamp}, {len(completed)} archive(s) already complete.")
+
+        # Compile exclude/include patterns once for all runs
+        with span('compile_patterns'):
+            patterns_file = write_patterns_file(config['backup'])
+
+        # One run per compression group ('compression: adaptive' may split the paths)
+        with span('compression_plan', compression=config['backup'].get('compression')):
+            plan = compression_plan(config)
+        # In snapshot mode borg reads read-only LVM snapshots from their mount root, removed again in any case
+        with lvm_snapshots(config, dryrun) as snapshots:
+            cwd = snapshots.mount_root if snapshots else None
+            for compression, group_paths in plan:
+                name = f"{hostname}-{timestamp}"
+                # Every compression group gets its own archive and its own metrics
+                group = compression.replace(',', '-') if len(plan) > 1 else None
+                if group:
+                    name += f"-{group}"
+                if name in completed:
+                    logging.info(f"Archive {name} already completed before the interruption, skipping.")
+                    continue
+                archive_name = f"{repo}::{name}"
+
+                # Build the Borg create command
+                backup_paths = snapshots.backup_paths(group_paths) if snapshots else group_paths
+                borg_create_cmd = build_create_cmd(archive_name, backup_paths, compression, patterns_file, dryrun,
+                                                   checkpoint_interval(config['backup']))
+                borg_create_cmd += borg_profile_args(f"create-{compression.replace(',', '-')}")
+
+                # Status update before running the command
+                print(f"Running Borg backup command (compression: {compression})...")
+                logging.info(f"Running Borg backup command with compression {compression} "
+                             f"for {', '.join(group_paths)}.")
+
+                # Run the Borg create command, recording its metrics for the textfile collector
+                with span('borg_create', repo=repo, compression=compression) as stage, \
+                        job_metrics('borg_create', repo=repo, group=group) as metrics:
+                    # Lock and network failures are retried, a retry resumes from the last checkpoint
+                    result = retry_call(f"borg_create:{name}",
+                                        lambda: run_throttled(borg_create_cmd, config, env, metrics, cwd),
+                                        retry_policy(config), metrics)
+                    archive = parse_create_stats(result.stdout)
+                    metrics.set_archive_stats(archive)
+                    stage.update(archive.get('stats', {}))
+
+                # Success update
+                logging.info(result.stdout)  # Log the output of the command
+                print(f"Borg backup completed successfully!\n{result.stdout}")  # Print the result to console
+
+                # Feed the measured throughput back into the link-adaptive estimates. In tiered mode borg
+                # writes to the local tier, its throughput says nothing about the link to borg.repo
+                if archive and config['backup'].get('compression') == 'link-adaptive' and not tiered_settings(config):
+                    record_run(config, archive['stats'], archive.get('duration', 0))
+
+        # Application dumps are streamed into their own archives of this run, one per dump group
+        for group, dumps in dump_plan:
+            name = f"{hostname}-{timestamp}-{dump_archive_suffix(group)}"
+            if name in completed:
+                logging.info(f"Archive {name} already completed before the interruption, skipping.")
+                continue
+            print(f"Streaming {len(dumps)} dump(s) into {name}...")
+            logging.info(f"Streaming dumps {', '.join(dump['name'] for dump in dumps)} into {name}.")
+            with span('dump_create', repo=repo, group=group) as stage, \
+                    job_metrics('dump_create', repo=repo, group=group) as metrics:
+                result = run_dump_group(f"{repo}::{name}", dumps, config, env, metrics, dryrun)
+                if result:
+                    archive = parse_create_stats(result.stdout)
+                    metrics.set_archive_stats(archive)
+                    stage.update(archive.get('stats', {}))
+            if result:
+                logging.info(result.stdout)
+                print(f"Dumps streamed successfully!\n{result.stdout}")
+
+        # The run completed, checkpoints left by this or earlier interrupted runs are no longer needed
+        if not dryrun:
+            with span('cleanup_checkpoints'):
+                delete_checkpoints(repo, env, leftover_checkpoints(list_archive_names(repo, env, f"{hostname}-*"), run_pattern))
+            # Track the repository filling up for the capacity forecast
+            with span('record_capacity'):
+                record_capacity(config, env)
+
+            # Copy the new archives offsite
+            start_replication(config)
 
     except subprocess.CalledProcessError as e:
         # Failure update
         logging.error(f"Borg backup failed: {e.stderr}")
         print(f"Error: Borg backup failed. {e.stderr}")
         prompt_for_repository_menu()  # Prompt for repository fix if backup fails
+    except (SnapshotError, ValueError, OSError) as e:
+        # ValueError: invalid dump sources, OSError: e.g. the patterns file cannot be written (not root, read-only /var)
+        logging.error(f"Borg backup failed: {e}")
+        print(f"Error: Borg backup failed. {e}")
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+shardedBackup.py
+
+Borg 1.x create runs on a single core, and a repository can only be written
+by one borg process at a time. Sharded mode splits paths_to_backup into
+balanced groups and backs each group up into its own repository with a
+separate borg process, so wall time scales with the number of cores.
+
+    backup:
+      shards:
+        count: 4              # defaults to the number of CPUs
+        repos: []             # optional, defaults to <repo>-shard1 ... <repo>-shardN
+
+Every shard archive of a run is named `<hostname>-<timestamp>-shard<i>of<n>`,
+where i is the shard repository and n the number of shards that had paths
+assigned in that run. A run is complete when n archives share its timestamp.
+Paths stay in the shard they were first assigned to, because moving a path to
+another repository would lose deduplication. Pass --rebalance to recompute the
+assignment from the recorded per-path sizes and churn. Both are measured from
+the file list of borg create (--list): the size of every file borg saw, and of
+the files it reported as added or modified.
+
+Sharded runs back up paths_to_backup only. Dumps (backup.dumps), LVM
+snapshots (backup.snapshots) and tiered repositories (backup.tiered) are not
+supported and a sharded run refuses to start when they are configured. An
+interrupted run is not resumed from its checkpoints and no capacity samples
+are recorded.
+
+Usage:
+    shardedBackup.py                      # run a sharded backup
+    shardedBackup.py --init               # create missing shard repositories
+    shardedBackup.py --list               # list complete and partial runs
+    shardedBackup.py --prune              # prune every shard repository
+    shardedBackup.py --restore TIMESTAMP DEST
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.borgCommands import build_create_cmd, parse_create_stats, single_compression
+from borgHandling.borgPatterns import tree_size, write_patterns_file
+from borgHandling.checkpoints import checkpoint_interval
+from borgHandling.lvmSnapshot import snapshot_settings
+from borgHandling.throttleSupervisor import run_throttled
+from borgHandling.tieredRepo import tiered_settings
+from handleMetrics.textfileExporter import job_metrics
+from handleRetry.retryEngine import retry_call, retry_policy, run_borg
+from handleTracing.stageTracer import borg_profile_args, span, start_trace
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/shards.json'
+
+# Relative cost of stat-ing unchanged bytes compared to reading and uploading changed ones
+SCAN_COST_FACTOR = 0.02
+
+# borg create --list statuses of files whose content was read: added, modified, changed while reading
+CHANGED_STATUSES = ('A', 'M', 'C')
+FILE_STATUSES = CHANGED_STATUSES + ('U',)
+
+ARCHIVE_PATTERN = re.compile(r'^(?P<host>.+)-(?P<timestamp>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)-shard(?P<index>\d+)of(?P<count>\d+)$')
+
+
+def shard_count(config):
+    shards = config['backup'].get('shards') or {}
+    if shards is True:
+        shards = {}
+    return int(shards.get('count') or os.cpu_count() or 1)
+
+
+def shard_repos(config):
+    """Return the repository of every shard."""
+    shards = config['backup'].get('shards') or {}
+    repos = shards.get('repos') if isinstance(shards, dict) else None
+    count = shard_count(config)
+    if repos:
+        if len(repos) != count:
+            raise ValueError(f"shards.repos lists {len(repos)} repositories but shards.count is {count}")
+        return repos
+    repo = config['borg']['repo'].rstrip('/')
+    return [f"{repo}-shard{i}" for i in range(1, count + 1)]
+
+
+def borg_env(config):
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+    return env
+
+
+def load_state(state_file=STATE_FILE):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'assignment': {}, 'paths': {}}
+
+
+def save_state(state, state_file=STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, state_file)
+    except OSError as e:
+        logging.error(f"Failed to save shard state: {e}")
+
+
+def path_cost(path, history):
+    """Estimated cost of backing up path, from recorded bytes and churn or a size scan."""
+    entry = history.get(path)
+    if not entry:
+        _, size = tree_size(path)
+        entry = history[path] = {'bytes': size, 'churn': size}
+    return entry['churn'] + entry['bytes'] * SCAN_COST_FACTOR
+
+
+def split_units(paths, count, history):
+    """Split paths into units small enough to balance, descending into the largest ones."""
+    units = {path: path_cost(path, history) for path in paths}
+    while True:
+        total = sum(units.values())
+        largest = max(units, key=units.get, default=None)
+        if largest is None or units[largest] <= total / count or not os.path.isdir(largest) or os.path.islink(largest):
+            return units
+        try:
+            children = [os.path.join(largest, name) for name in sorted(os.listdir(largest))]
+        except OSError:
+            return units
+        if not children:
+            return units
+        del units[largest]
+        for child in children:
+            units[child] = path_cost(child, history)
+
+
+def uncovered(path, assignment):
+    """Return the entries below path that no assigned unit covers (e.g. directories created since)."""
+    if path in assignment:
+        return []
+    prefix = path.rstrip('/') + '/'
+    if not any(unit.startswith(prefix) for unit in assignment):
+        return [path]
+    try:
+        children = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    except OSError:
+        return []
+    return [entry for child in children for entry in uncovered(child, assignment)]
+
+
+def assign_shards(paths, count, state, rebalance=False):
+    """Return {shard index: [paths]}, keeping existing assignments unless rebalancing."""
+    history = state.setdefault('paths', {})
+    assignment = {} if rebalance else dict(state.get('assignment', {}))
+
+    # Drop assignments for paths that are gone or no longer backed up, or for shards that no longer exist
+    assignment = {unit: shard for unit, shard in assignment.items()
+                  if shard < count and os.path.lexists(unit)
+                  and any(unit == p or unit.startswith(p.rstrip('/') + '/') for p in paths)}
+    new_paths = [path for root in paths for path in uncovered(root, assignment)]
+
+    loads = [0.0] * count
+    for unit, shard in assignment.items():
+        loads[shard] += path_cost(unit, history)
+
+    # Longest processing time first: the biggest unit goes to the least loaded shard
+    for unit, cost in sorted(split_units(new_paths, count, history).items(), key=lambda item: -item[1]):
+        shard = loads.index(min(loads))
+        assignment[unit] = shard
+        loads[shard] += cost
+
+    state['assignment'] = assignment
+    groups = {}
+    for unit, shard in sorted(assignment.items()):
+        groups.setdefault(shard, []).append(unit)
+    return groups
+
+
+def unit_stats(list_output, units):
+    """Return {unit: {'bytes', 'churn'}} from the file list borg create --list printed for the units."""
+    stats = {unit: {'bytes': 0, 'churn': 0} for unit in units}
+    prefixes = sorted(((unit.strip('/') + '/', unit) for unit in units), reverse=True)
+    for line in list_output.splitlines():
+        status, _, path = line.partition(' ')
+        if status not in FILE_STATUSES or not path:
+            continue
+        relative = path.strip('/') + '/'
+        # The longest unit containing the path owns it
+        unit = next((unit for prefix, unit in prefixes if relative.startswith(prefix)), None)
+        if unit is None:
+            continue
+        # Archive paths lose their leading slash, the units keep it
+        local_path = '/' + path.lstrip('/') if unit.startswith('/') else path
+        try:
+            size = os.lstat(local_path).st_size
+        except OSError:
+            continue
+        stats[unit]['bytes'] += size
+        if status in CHANGED_STATUSES:
+            stats[unit]['churn'] += size
+    return stats
+
+
+def record_stats(state, stats):
+    """Record the measured bytes and churn of every unit of a shard."""
+    state.setdefault('paths', {}).update(stats)
+
+
+def run_shard(config, index, count, repo, units, archive_prefix, compression, patterns_file, env, dryrun):
+    """Run borg create for one shard. Returns (index, archive stats, measured stats per unit)."""
+    archive_name = f"{repo}::{archive_prefix}-shard{index + 1}of{count}"
+    cmd = build_create_cmd(archive_name, units, compression, patterns_file, dryrun, checkpoint_interval(config['backup']))
+    cmd += borg_profile_args(f"shard{index + 1}")
+    logging.info(f"Shard {index + 1}/{count}: backing up {', '.join(units)} to {repo}.")
+    start = time.monotonic()
+    with span(f"shard{index + 1}", repo=repo) as stage, \
+            job_metrics('borg_create', repo=repo, shard=f"{index + 1}of{count}") as metrics:
+        result = retry_call(f"borg_create:shard{index + 1}", lambda: run_throttled(cmd, config, env, metrics),
+                            retry_policy(config), metrics)
+        archive = parse_create_stats(result.stdout)
+        metrics.set_archive_stats(archive)
+        stage.update(archive.get('stats', {}))
+    logging.info(f"Shard {index + 1}/{count} finished in {time.monotonic() - start:.0f}s.")
+    # borg create --list prints the file list on stderr
+    return index, archive, unit_stats(result.stderr or '', units)
+
+
+def unsupported_options(config):
+    """Return the configured backup options sharded runs do not support."""
+    unsupported = []
+    if config['backup'].get('dumps'):
+        unsupported.append('dumps')
+    if snapshot_settings(config):
+        unsupported.append('snapshots')
+    if tiered_settings(config):
+        unsupported.append('tiered')
+    return unsupported
+
+
+def run_sharded_backup(config, dryrun=False, rebalance=False, state_file=STATE_FILE):
+    """Back up paths_to_backup with one concurrent borg create per shard repository."""
+    start_trace('sharded-backup')
+    unsupported = unsupported_options(config)
+    if unsupported:
+        message = f"Sharded backups do not support backup.{', backup.'.join(unsupported)}, not starting."
+        logging.error(message)
+        print(f"Error: {message}")
+        return False
+    count = shard_count(config)
+    repos = shard_repos(config)
+    state = load_state(state_file)
+    with span('assign_shards', rebalance=rebalance):
+        groups = assign_shards(config['backup']['paths_to_backup'], count, state, rebalance)
+    with span('compression_plan'):
+        compression = single_compression(config)
+    with span('compile_patterns'):
+        patterns_file = write_patterns_file(config['backup'])
+    env = borg_env(config)
+    archive_prefix = f"{socket.gethostname()}-{datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
+    active = sorted(groups)
+
+    print(f"Starting sharded Borg backup with {len(active)} shards...")
+    logging.info(f"Starting sharded Borg backup {archive_prefix} with {len(active)} of {count} shards.")
+
+    failures = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(active) or 1) as executor:
+            futures = {
+                executor.submit(run_shard, config, index, len(active), repos[index], groups[index],
+                                archive_prefix, compression, patterns_file, env, dryrun): index
+                for index in active
+            }
+            for future, index in futures.items():
+                try:
+                    _, archive, stats = future.result()
+                    if archive:
+                        record_stats(state, stats)
+                except Exception as e:
+                    # One failed shard must not abort the others or lose the stats of those that completed
+                    failures.append(index)
+                    error = getattr(e, 'stderr', None) or e
+                    logging.error(f"Shard {index + 1} of {archive_prefix} failed: {error}")
+                    print(f"Error: shard {index + 1} failed. {error}")
+    finally:
+        save_state(state, state_file)
+    if failures:
+        print(f"Sharded backup {archive_prefix} is incomplete: {len(failures)} of {len(active)} shards failed.")
+        return False
+    print(f"Sharded backup {archive_prefix} completed successfully across {len(active)} shards.")
+    return True
+
+
+def init_shard_repos(config):
+    """Create any shard repository that does not exist yet."""
+    env = borg_env(config)
+    encryption = config['borg'].get('encryption', 'repokey')
+    for repo in shard_repos(config):
+        if subprocess.run(['borg', 'info', repo], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env).returncode == 0:
+            continue
+        print(f"Initialising shard repository {repo}...")
+        subprocess.run(['borg', 'init', '--encryption', encryption, repo], check=True, env=env)
+
+
+def list_runs(config):
+    """Return {timestamp: {'expected': shards in the run, 'shards': {shard index: archive name}}}."""
+    env = borg_env(config)
+    hostname = socket.gethostname()
+    runs = {}
+    for repo in shard_repos(config):
+        result = run_borg(['borg', 'list', '--json', '--glob-archives', f"{hostname}-*", repo], 'borg_list',
+                          retry_policy(config), env=env)
+        for archive in json.loads(result.stdout).get('archives', []):
+            match = ARCHIVE_PATTERN.match(archive['name'])
+            if match and match.group('host') == hostname:
+                run = runs.setdefault(match.group('timestamp'), {'expected': int(match.group('count')), 'shards': {}})
+                run['shards'][int(match.group('index')) - 1] = archive['name']
+    return runs
+
+
+def print_runs(config):
+    for timestamp, run in sorted(list_runs(config).items()):
+        found = len(run['shards'])
+        status = 'complete' if found == run['expected'] else f"partial ({found}/{run['expected']} shards)"
+        print(f"{timestamp}  {status}")
+
+
+def prune_shards(config):
+    """Apply the configured retention to every shard repository."""
+    env = borg_env(config)
+    keep = config['backup'].get('prune', {})
+    cmd = ['borg', 'prune', '--list', '--show-rc', '--glob-archives', f"{socket.gethostname()}-*"]
+    for period in ('daily', 'weekly', 'monthly', 'yearly'):
+        if keep.get(period):
+            cmd += [f"--keep-{period}", str(keep[period])]
+    for repo in shard_repos(config):
+        # prune --list reports on stderr, which is captured to classify failures
+        result = run_borg(cmd + [repo], 'borg_prune', retry_policy(config), stdout=None, env=env)
+        print(result.stderr, end='')
+
+
+def restore_run(config, timestamp, dest):
+    """Extract every shard archive of a run into dest. Shards hold disjoint paths, so they extract in parallel."""
+    run = list_runs(config).get(timestamp)
+    if not run:
+        raise ValueError(f"No sharded run found for {timestamp}")
+    shards = run['shards']
+    count = len(shards)
+    if count != run['expected']:
+        raise ValueError(f"Run {timestamp} has {count} of {run['expected']} shards, refusing a partial restore")
+
+    os.makedirs(dest, exist_ok=True)
+    env = borg_env(config)
+    repos = shard_repos(config)
+    with span('borg_extract', timestamp=timestamp, shards=count), ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(subprocess.run, ['borg', 'extract', f"{repos[index]}::{name}"]
+                                   + borg_profile_args(f"extract-shard{index + 1}"),
+                                   cwd=dest, check=True, env=env)
+                   for index, name in shards.items()]
+        for future in futures:
+            future.result()
+    print(f"Restored {count} shards of {timestamp} into {dest}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded Borg backups across several repositories")
+    parser.add_argument('--init', action='store_true', help="Create missing shard repositories")
+    parser.add_argument('--list', action='store_true', help="List sharded runs")
+    parser.add_argument('--prune', action='store_true', help="Prune every shard repository")
+    parser.add_argument('--restore', nargs=2, metavar=('TIMESTAMP', 'DEST'), help="Restore all shards of a run")
+    parser.add_argument('--rebalance', action='store_true', help="Recompute the path to shard assignment")
+    parser.add_argument('--dry-run', action='store_true', help="Run borg create with --dry-run")
+    parser.add_argument('--profile', action='store_true', help="Profile the run with cProfile and borg --debug-profile")
+    args = parser.parse_args()
+    start_trace('sharded-backup', profile=args.profile or None)
+
+    with span('load_config'):
+        with open(CONFIG_FILE, 'r') as file:
+            config = yaml.safe_load(file)
+
+    if args.init:
+        init_shard_repos(config)
+    elif args.list:
+        print_runs(config)
+    elif args.prune:
+        prune_shards(config)
+    elif args.restore:
+        restore_run(config, args.restore[0], args.restore[1])
+    else:
+        sys.exit(0 if run_sharded_backup(config, args.dry_run, args.rebalance) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+throttleSupervisor.py
+
+Runs borg under a supervisor that backs off when the host gets busy, so
+backups only use spare capacity. Every `interval` seconds it reads the load
+average, CPU and IO pressure (PSI) and the network traffic of everything
+except borg itself, and moves borg between throttle levels:
+
+    0  normal      as started
+    1  background  nice 10, ionice best-effort 7
+    2  idle        nice 19, ionice idle
+    3  paused      SIGSTOP, bounded by max_pause seconds
+
+Any signal above its limit raises the level by one. The level drops by one
+after `calm_samples` samples in a row with every signal below 70% of its
+limit. After a pause reaches max_pause borg is resumed at level 2 and is not
+paused again for another max_pause seconds, so a busy host slows a backup
+down but never stalls it forever.
+
+borg's --upload-ratelimit can only be set when borg starts, so it is picked
+once from the network traffic at start: the lower bound when the link is
+already busy, otherwise the upper bound (0 means unlimited).
+
+    backup:
+      throttle:
+        interval: 5
+        max_load_per_cpu: 1.5
+        max_cpu_pressure: 25        # % of time some task stalled on CPU (avg10)
+        max_io_pressure: 25
+        max_net_utilisation: 0.7    # traffic of other processes / link speed
+        interface: auto
+        link_mbps: null             # set for virtual NICs that do not report a speed
+        max_level: 3                # 2 never pauses borg
+        max_pause: 300
+        calm_samples: 3
+        upload_ratelimit:           # KiB/s
+          min: 10240
+          max: 0
+
+`throttle: true` enables it with these defaults.
+"""
+
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from borgHandling.hostLoad import (default_interface, interface_bytes, link_speed_bytes, load_per_cpu,
+                                   pressure, process_tree, written_bytes)
+
+DEFAULT_THROTTLE = {
+    'interval': 5,
+    'max_load_per_cpu': 1.5,
+    'max_cpu_pressure': 25,
+    'max_io_pressure': 25,
+    'max_net_utilisation': 0.7,
+    'interface': 'auto',
+    'link_mbps': None,
+    'max_level': 3,
+    'max_pause': 300,
+    'calm_samples': 3,
+    'upload_ratelimit': {'min': 0, 'max': 0},
+}
+
+# (name, nice value, ionice arguments) for every level below paused, normal restores the start priority
+LEVELS = [
+    ('normal', None, ['-c', '0']),
+    ('background', 10, ['-c', '2', '-n', '7']),
+    ('idle', 19, ['-c', '3']),
+]
+PAUSED = len(LEVELS)
+
+CALM_FRACTION = 0.7
+
+
+def throttle_settings(config):
+    """Return the throttle settings, or None when throttling is off."""
+    throttle = config['backup'].get('throttle')
+    # `throttle: true` enables it with the defaults
+    if throttle is True:
+        throttle = {}
+    elif not isinstance(throttle, dict) or not throttle.get('enabled', True):
+        return None
+    settings = dict(DEFAULT_THROTTLE, **throttle)
+    settings['upload_ratelimit'] = dict(DEFAULT_THROTTLE['upload_ratelimit'], **(settings['upload_ratelimit'] or {}))
+    return settings
+
+
+class NetworkMeter:
+    """Measures the share of the link used by processes other than the supervised one."""
+
+    def __init__(self, settings):
+        self.interface = settings['interface']
+        if self.interface == 'auto':
+            self.interface = default_interface()
+        self.speed = settings['link_mbps'] * 125000 if settings['link_mbps'] else link_speed_bytes(self.interface)
+        self.last = None
+
+    def utilisation(self, own_written=0):
+        """Return the busiest direction of other traffic as a fraction of the link since the last call."""
+        counters = interface_bytes(self.interface) if self.interface and self.speed else None
+        if counters is None:
+            return None
+        now = time.monotonic()
+        sample = (now, counters, own_written)
+        previous, self.last = self.last, sample
+        if previous is None:
+            return None
+        elapsed = now - previous[0]
+        received = counters[0] - previous[1][0]
+        sent = max(counters[1] - previous[1][1] - (own_written - previous[2]), 0)
+        return max(received, sent) / elapsed / self.speed
+
+    def busy_now(self, seconds=1.0):
+        """Sample the link for a moment, used before borg has started."""
+        self.utilisation()
+        time.sleep(seconds)
+        return self.utilisation()
+
+
+def upload_ratelimit_args(settings, meter):
+    """Pick borg's --upload-ratelimit (KiB/s) from the traffic on the link right now."""
+    limits = settings['upload_ratelimit']
+    if not limits['min'] and not limits['max']:
+        return []
+    busy = meter.busy_now()
+    limit = limits['min'] if busy is not None and busy > settings['max_net_utilisation'] else limits['max']
+    logging.info(f"Starting borg with --upload-ratelimit {limit} KiB/s (link utilisation {busy}).")
+    return ['--upload-ratelimit', str(limit)]
+
+
+class ThrottleSupervisor(threading.Thread):
+    """Watches host load while borg runs and adjusts its priority or pauses it."""
+
+    def __init__(self, process, settings, meter):
+        super().__init__(daemon=True)
+        # The Popen object, not just the pid: once borg is reaped its pid may belong to another process
+        self.process = process
+        self.pid = process.pid
+        self.settings = settings
+        self.meter = meter
+        self.level = 0
+        try:
+            self.base_nice = os.getpriority(os.PRIO_PROCESS, self.pid)
+        except ProcessLookupError:
+            self.base_nice = 0
+        self.calm = 0
+        self.paused_since = None
+        self.no_pause_until = 0
+        self.paused_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.stopping = threading.Event()
+
+    def readings(self):
+        """Return {signal: (value, limit)} for the signals available on this host."""
+        tree = process_tree(self.pid)
+        values = {
+            'load_per_cpu': (load_per_cpu(), self.settings['max_load_per_cpu']),
+            'cpu_pressure': (pressure('cpu'), self.settings['max_cpu_pressure']),
+            'io_pressure': (pressure('io'), self.settings['max_io_pressure']),
+            # borg itself only writes to its rsh pipe, the children (ssh) put the bytes on the wire
+            'net_utilisation': (self.meter.utilisation(written_bytes(tree[1:])), self.settings['max_net_utilisation']),
+        }
+        return {name: reading for name, reading in values.items() if reading[0] is not None and reading[1]}
+
+    def running(self):
+        """Whether borg has not exited yet. poll() reaps it, after that its pid is never signalled again."""
+        return self.process.poll() is None
+
+    def set_level(self, level, reason):
+        if level == self.level or not self.running():
+            return
+        tree = process_tree(self.pid)
+        try:
+            if level == PAUSED:
+                self.process.send_signal(signal.SIGSTOP)
+                self.paused_since = time.monotonic()
+            else:
+                if self.level == PAUSED:
+                    self.process.send_signal(signal.SIGCONT)
+                    self.paused_seconds += time.monotonic() - self.paused_since
+                    self.paused_since = None
+                name, nice, ionice = LEVELS[level]
+                for pid in tree:
+                    apply_priority(pid, self.base_nice if nice is None else max(nice, self.base_nice), ionice)
+        except ProcessLookupError:
+            return
+        logging.info(f"Throttle: borg {self.pid} {level_name(self.level)} -> {level_name(level)} ({reason}).")
+        self.level = level
+
+    def step(self):
+        """Take one sample and move one level if needed."""
+        readings = self.readings()
+        over = [f"{name} {value:.2f} > {limit}" for name, (value, limit) in readings.items() if value > limit]
+        calm = all(value < limit * CALM_FRACTION for value, limit in readings.values())
+        max_level = min(self.settings['max_level'], PAUSED)
+        now = time.monotonic()
+
+        if self.level == PAUSED and now - self.paused_since >= self.settings['max_pause']:
+            self.no_pause_until = now + self.settings['max_pause']
+            self.set_level(PAUSED - 1, f"paused for {self.settings['max_pause']}s, resuming")
+            self.calm = 0
+            return
+        if over:
+            self.calm = 0
+            target = self.level + 1
+            if target == PAUSED and now < self.no_pause_until:
+                return
+            if target <= max_level:
+                self.set_level(target, ', '.join(over))
+        elif calm and self.level > 0:
+            self.calm += 1
+            if self.calm >= self.settings['calm_samples']:
+                self.calm = 0
+                self.set_level(self.level - 1, 'host is calm')
+        else:
+            self.calm = 0
+
+    def run(self):
+        while not self.stopping.wait(self.settings['interval']) and self.running():
+            if self.level > 0:
+                self.throttled_seconds += self.settings['interval']
+            try:
+                self.step()
+            except OSError as e:
+                logging.debug(f"Throttle sample failed: {e}")
+
+    def stop(self):
+        """Stop supervising and make sure borg is never left stopped."""
+        self.stopping.set()
+        self.join()
+        if self.level == PAUSED:
+            if self.running():
+                self.set_level(PAUSED - 1, 'supervisor stopping')
+            else:
+                # borg was killed while stopped, it is gone and must not be signalled
+                self.paused_seconds += time.monotonic() - self.paused_since
+
+
+def level_name(level):
+    return 'paused' if level == PAUSED else LEVELS[level][0]
+
+
+def apply_priority(pid, nice, ionice_args):
+    """Set the CPU and IO priority of one process. Lowering nice again needs root."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, nice)
+    except PermissionError:
+        logging.debug(f"Not allowed to set nice {nice} on {pid}.")
+    except ProcessLookupError:
+        return
+    subprocess.run(['ionice'] + ionice_args + ['-p', str(pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_throttled(cmd, config, env, metrics=None, cwd=None):
+    """
+    Run a borg command like subprocess.run(check=True, capture_output, text) does,
+    supervised by the throttle when backup.throttle is configured.
+    """
+    settings = throttle_settings(config)
+    if not settings:
+        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True,
+                              cwd=cwd)
+
+    meter = NetworkMeter(settings)
+    cmd = list(cmd) + upload_ratelimit_args(settings, meter)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True, cwd=cwd)
+    supervisor = ThrottleSupervisor(process, settings, meter)
+    supervisor.start()
+    try:
+        stdout, stderr = process.communicate()
+    finally:
+        supervisor.stop()
+
+    if metrics:
+        metrics.set(throttled_seconds=round(supervisor.throttled_seconds), paused_seconds=round(supervisor.paused_seconds))
+    logging.info(f"borg ran throttled for {supervisor.throttled_seconds:.0f}s, paused for {supervisor.paused_seconds:.0f}s.")
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+tieredRepo.py
+
+Two-tier backups: borg create writes into a repository on fast local disk,
+so the source is read once at local disk speed, and the local repository is
+then mirrored to borg.repo (the offsite repository) in the background.
+
+Replication copies the repository files with rsync in two passes:
+
+  1. data/ without the repository lock, with --bwlimit and --partial so an
+     interrupted transfer resumes. Segments are never rewritten in place,
+     this moves nearly all bytes while new backups keep running. The first
+     replication copies the whole repository (but the lock) in this pass.
+  2. everything under `borg with-lock` on the local repository, so the
+     mirror gets a consistent state: segments written since pass 1, the
+     index and hints, and --delete-after for segments removed by compaction.
+     --delay-updates puts the changed files in place at the end.
+
+The offsite repository is a copy of the local one (same repository ID and
+key). Prune and compact the local repository, the mirror follows. Use the
+mirror for restores only, anything written to it directly is overwritten by
+the next replication. Replication refuses to overwrite a destination that
+holds a different repository, and any destination it cannot read.
+
+Persephone's own tools (capacity forecast, churn and growth reports, test
+restores, the archive browser) read the local repository. The mirror shares
+its repository ID and lags behind it, so borg's security and cache checks on
+this host reject it (relocation prompt, "Cache is newer than repository").
+To restore from the mirror, e.g. after losing the local disk, give borg its
+own directories:
+
+    BORG_BASE_DIR=/root/.persephone-mirror BORG_RELOCATED_REPO_ACCESS_IS_OK=yes borg list REPO
+
+    backup:
+      tiered:
+        local_repo: /srv/borg-local
+        replicate: background       # background, inline or manual (cron runs tieredRepo.py)
+        bwlimit_kbps: 20000         # 0 means unlimited
+        lock_wait: 600              # seconds pass 2 waits for a running backup
+
+Usage:
+    tieredRepo.py --init            # create the local repository
+    tieredRepo.py                   # replicate now
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import yaml
+
+# Add the parent directory of 'borgHandling' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.linkProbe import parse_remote_repo, remote_repo_path, rsh_command
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+from handleTracing.stageTracer import span
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+STATE_FILE = '/var/lib/CodeMonkeyCyber/Persephone/replication.json'
+
+DEFAULT_TIERED = {
+    'local_repo': None,
+    'replicate': 'background',
+    'bwlimit_kbps': 0,
+    'lock_wait': 600,
+}
+
+# rsync exit code for source files that vanished during the transfer (segments removed by compaction)
+RSYNC_VANISHED = 24
+
+# Printed by the remote check when the offsite path does not exist yet
+ABSENT = 'persephone-mirror-absent'
+
+TRANSFERRED = re.compile(r'Total transferred file size: ([\d,.]+) bytes')
+
+
+def tiered_settings(config):
+    """Return the tiered settings, or None when backups go straight to borg.repo."""
+    tiered = config['backup'].get('tiered')
+    if not tiered or not tiered.get('local_repo'):
+        return None
+    return dict(DEFAULT_TIERED, **tiered)
+
+
+def backup_repo(config):
+    """The repository borg create writes to: the local tier when tiered backups are on."""
+    settings = tiered_settings(config)
+    return settings['local_repo'] if settings else config['borg']['repo']
+
+
+def rsync_destination(config):
+    """Return (rsync destination of the offsite repository, rsync -e argument or None)."""
+    repo = config['borg']['repo']
+    remote = parse_remote_repo(repo)
+    if not remote:
+        return repo.rstrip('/') + '/', None
+    destination, port = remote
+    rsh = rsh_command(config) + (['-p', port] if port else [])
+    return f"{destination}:{remote_repo_path(repo).rstrip('/')}/", ' '.join(rsh)
+
+
+def repository_id(config_text):
+    """Return the id from the text of a borg repository's config file."""
+    parser = configparser.ConfigParser()
+    parser.read_string(config_text)
+    return parser.get('repository', 'id', fallback=None)
+
+
+def offsite_repository_id(config):
+    """
+    Return the repository ID of the offsite repository, or None when it does not exist yet
+    (the path is missing or an empty directory). Raises on any other failure, so an
+    unreachable or unreadable destination is never mistaken for an empty one.
+    """
+    repo = config['borg']['repo']
+    remote = parse_remote_repo(repo)
+    if not remote:
+        if not os.path.exists(repo) or (os.path.isdir(repo) and not os.listdir(repo)):
+            return None
+        with open(os.path.join(repo, 'config'), 'r') as f:
+            text = f.read()
+    else:
+        destination, port = remote
+        path = shlex.quote(remote_repo_path(repo).rstrip('/') or '/')
+        # Only an explicit "absent" counts as a new mirror, ssh and read errors exit non-zero
+        script = (f"if [ ! -e {path} ]; then echo {ABSENT}; "
+                  f"elif listing=$(ls -A {path}) && [ -z \"$listing\" ]; then echo {ABSENT}; "
+                  f"else cat {path}/config; fi")
+        result = subprocess.run(rsh_command(config) + (['-p', port] if port else []) + [destination, script],
+                                capture_output=True, text=True, stdin=subprocess.DEVNULL, timeout=120, check=True)
+        if result.stdout.strip() == ABSENT:
+            return None
+        text = result.stdout
+    repo_id = repository_id(text)
+    if not repo_id:
+        raise ValueError(f"{repo} exists but is not a borg repository")
+    return repo_id
+
+
+def rsync_cmd(config, settings, source, destination, options):
+    _, rsh = rsync_destination(config)
+    cmd = ['rsync', '-a', '--stats'] + options
+    if settings['bwlimit_kbps']:
+        cmd.append(f"--bwlimit={settings['bwlimit_kbps']}")
+    if rsh:
+        cmd += ['-e', rsh]
+    return cmd + [source, destination]
+
+
+def transferred_bytes(output):
+    match = TRANSFERRED.search(output or '')
+    return int(re.sub(r'[,.]', '', match.group(1))) if match else 0
+
+
+def save_state(state, state_file=STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        with open(f"{state_file}.tmp", 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{state_file}.tmp", state_file)
+    except OSError as e:
+        logging.warning(f"Could not save the replication state: {e}")
+
+
+def replicate(config):
+    """Mirror the local repository to the offsite repository. Returns True on success."""
+    settings = tiered_settings(config)
+    local = settings['local_repo'].rstrip('/')
+    destination, _ = rsync_destination(config)
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+
+    start = time.time()
+    with job_metrics('replication', repo=config['borg']['repo']) as metrics:
+        try:
+            with open(os.path.join(local, 'config'), 'r') as f:
+                local_id = repository_id(f.read())
+            offsite_id = offsite_repository_id(config)
+            if offsite_id and offsite_id != local_id:
+                metrics.exit_code = 1
+                logging.error(f"{config['borg']['repo']} holds a different repository ({offsite_id}), "
+                              f"not replicating over it.")
+                print(f"Error: {config['borg']['repo']} is not a mirror of {local}, not replicating.")
+                return False
+
+            # Pass 1: the bulk of the new segments, without holding the lock. The first replication
+            # copies everything but the lock, so pass 2 only has to catch up under the lock.
+            with span('replicate_data', repo=local) as stage:
+                if offsite_id:
+                    source, target = f"{local}/data/", f"{destination}data/"
+                else:
+                    source, target = f"{local}/", destination
+                result = subprocess.run(rsync_cmd(config, settings, source, target,
+                                                  ['--partial', '--exclude=/lock.*']),
+                                        capture_output=True, text=True, env=env)
+                if result.returncode not in (0, RSYNC_VANISHED):
+                    raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+                sent = transferred_bytes(result.stdout)
+                stage['bytes'] = sent
+
+            # Pass 2: a consistent copy of everything while no backup writes to the local repository
+            with span('replicate_locked', repo=local) as stage:
+                rsync = rsync_cmd(config, settings, f"{local}/", destination,
+                                  ['--delete-after', '--delay-updates', '--partial-dir=.rsync-partial',
+                                   '--exclude=/lock.*'])
+                result = subprocess.run(['borg', 'with-lock', '--lock-wait', str(settings['lock_wait']), local] + rsync,
+                                        capture_output=True, text=True, env=env, check=True)
+                stage['bytes'] = transferred_bytes(result.stdout)
+                sent += stage['bytes']
+        except (subprocess.SubprocessError, OSError, ValueError) as e:
+            # OSError: rsync or borg is not installed, or the repositories cannot be read
+            metrics.exit_code = getattr(e, 'returncode', 1)
+            error = getattr(e, 'stderr', None) or e
+            logging.error(f"Replication of {local} to {config['borg']['repo']} failed: {error}")
+            print(f"Error: replication to {config['borg']['repo']} failed. {error}")
+            return False
+        metrics.set(bytes_transferred=sent)
+
+    duration = time.time() - start
+    logging.info(f"Replicated {local} to {config['borg']['repo']}: {sent} bytes in {duration:.0f}s.")
+    save_state({'local_repo': local, 'repo': config['borg']['repo'], 'bytes': sent, 'duration': round(duration),
+                'last_success': datetime.now().isoformat(timespec='seconds')})
+    return True
+
+
+def start_replication(config):
+    """Replicate after a backup, inline or in a detached process as configured."""
+    settings = tiered_settings(config)
+    if not settings or settings['replicate'] == 'manual':
+        return
+    if settings['replicate'] == 'inline':
+        replicate(config)
+        return
+    # The replication outlives this run; it reads the same config file
+    subprocess.Popen([sys.executable, os.path.abspath(__file__)], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    logging.info(f"Started background replication of {settings['local_repo']} to {config['borg']['repo']}.")
+
+
+def init_local_repo(config):
+    settings = tiered_settings(config)
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+    encryption = config['borg'].get('encryption') or 'repokey'
+    subprocess.run(['borg', 'init', '--encryption', encryption, settings['local_repo']], env=env, check=True)
+    print(f"Created the local repository {settings['local_repo']}; "
+          f"the first replication copies it to {config['borg']['repo']}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replicate the local backup tier to the offsite repository")
+    parser.add_argument('--init', action='store_true', help="Create the local repository")
+    parser.add_argument('--config', default=CONFIG_FILE, help="Path to the Persephone borg config")
+    args = parser.parse_args()
+    setup_logging(stage='replication')
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    if not tiered_settings(config):
+        print("backup.tiered.local_repo is not configured.")
+        sys.exit(1)
+    if args.init:
+        init_local_repo(config)
+        return
+    sys.exit(0 if replicate(config) else 1)
+
+
+if __name__ == "__main__":
+    main()
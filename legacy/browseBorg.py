@@ -1,7 +1,13 @@
 import os
 import subprocess
+import sys
 import yaml
 
+# Add this directory to the Python path so 'borgHandling' and 'handleRestore' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from borgHandling.tieredRepo import backup_repo
+from handleRestore.borgDeltaRestore import delta_restore, print_stats
+
 # Path to the YAML configuration file
 CONFIG_FILE_PATH = "/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml"  # Adjust if needed
 
@@ -23,13 +29,21 @@ def show_archive_details(repo_path, archive_name):
     result = subprocess.run(["borg", "info", f"{repo_path}::{archive_name}"], capture_output=True, text=True)
     print(result.stdout)
 
-def extract_from_archive(repo_path, archive_name, extract_path, file_path=None):
+def extract_from_archive(repo_path, archive_name, extract_path, file_path=None, delta=False):
     """
     Extract files or directories from a specified archive.
     - archive_name: Name of the archive to extract from
     - extract_path: Path where the files will be extracted
     - file_path: Optional specific file or directory path to extract
+    - delta: Only extract files that differ from what is already in extract_path
     """
+    if delta:
+        print(f"Restoring changed files from archive: {archive_name} to {extract_path}")
+        try:
+            print_stats(delta_restore(repo_path, archive_name, extract_path, [file_path] if file_path else []))
+        except subprocess.CalledProcessError as e:
+            print(f"Delta restore failed: {e}")
+        return
     borg_command = ["borg", "extract", f"{repo_path}::{archive_name}"]
     if file_path:
         borg_command.append(file_path)
@@ -40,11 +54,11 @@ def extract_from_archive(repo_path, archive_name, extract_path, file_path=None):
 def main():
     # Load configuration
     config = load_config()
-    repo_path = config.get("borg", {}).get("repo")
-
-    if not repo_path:
+    if not config.get("borg", {}).get("repo"):
         print("Repository path not found in configuration file.")
         return
+    # In tiered mode browse the local repository, the offsite mirror is only for disaster restores
+    repo_path = backup_repo(config)
 
     print("Borg Archive Navigation Tool")
     while True:
@@ -67,7 +81,8 @@ def main():
             archive_name = input("Enter the archive name: ")
             extract_path = input("Enter the destination path for extraction: ")
             file_path = input("Enter the specific file or directory path to extract (leave blank for full archive): ")
-            extract_from_archive(repo_path, archive_name, extract_path, file_path if file_path else None)
+            delta = input("Only extract files that differ from the destination? (y/N): ").strip().lower() in ("y", "yes")
+            extract_from_archive(repo_path, archive_name, extract_path, file_path if file_path else None, delta)
         
         elif choice == "4":
             print("Exiting.")
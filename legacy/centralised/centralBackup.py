@@ -1,13 +1,34 @@
+import argparse
+import json
+import re
 import yaml
 import subprocess
 import logging
+import os
+import shlex
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
 import paramiko
 
+# Add the parent directory of 'centralised' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.borgCommands import parse_create_stats
+from borgHandling.borgPatterns import compile_patterns
+from borgHandling.checkpoints import checkpoint_interval, find_resumable, leftover_checkpoints
+from centralised.fleetProgress import FleetProgress, drain_channel
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+from handleRetry.retryEngine import retry_call, retry_policy
+from handleTracing.stageTracer import current_trace, span, start_trace
+
+def run_pattern(name):
+    """Archive names of fleet runs are <target name>-<ISO timestamp of the run>, targets may share a repository."""
+    return re.compile(rf"^{re.escape(name)}-(?P<timestamp>\d{{4}}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?)$")
+
 # Configure logging
-logging.basicConfig(filename="/var/log/cybermonkey/persephone.log", level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s")
+setup_logging("/var/log/cybermonkey/persephone.log", stage="central-backup")
 
 # Error handling decorator
 def error_handler(func):
@@ -23,53 +44,209 @@ def error_handler(func):
 # Load YAML configuration
 @error_handler
 def load_config(file_path):
-    with open(file_path, "r") as file:
+    with span("load_config"), open(file_path, "r") as file:
         return yaml.safe_load(file)
 
 # Run Borg backup command over SSH
 @error_handler
-def run_backup(target):
+def run_backup(target, profile=False, policy=None, progress=None):
+    name = target["name"]
+    host = target["host"]
+    repo_path = target["repo_path"]
+
+    logging.info(f"Starting backup for {name} on {host}...")
+
+    # Record the run for the textfile collector, labelled with the target host
+    with span(f"backup:{name}", host=host), \
+            job_metrics("fleet_backup", host=host, repo=repo_path, target=name) as metrics:
+        # Lock and network failures are retried with backoff, a retry resumes from the last checkpoint
+        try:
+            archive = retry_call(f"fleet_backup:{name}", lambda: backup_attempt(target, profile, progress),
+                                 policy, metrics)
+        except subprocess.CalledProcessError as e:
+            metrics.exit_code = e.returncode
+            logging.error(f"Backup for {name} on {host} failed: {e.stderr}")
+            if progress:
+                progress.phase(name, "failed")
+            return
+        except Exception:
+            if progress:
+                progress.phase(name, "failed")
+            raise
+        metrics.set_archive_stats(archive)
+        if progress:
+            progress.completed(name, archive)
+            progress.phase(name, "done")
+        logging.info(f"Backup for {name} on {host} completed successfully.")
+
+def connect_target(target):
+    """Open an SSH connection to a backup target."""
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(hostname=target["host"], username=target["user"], key_filename=target.get("ssh_key_path"))
+    return ssh
+
+def backup_attempt(target, profile=False, progress=None):
+    """Run borg create on the target once. Returns the archive stats, raises CalledProcessError on failure."""
+    try:
+        return attempt_backup(target, profile, progress)
+    except Exception:
+        # run_backup marks the target failed once the retries are used up
+        if progress:
+            progress.phase(target["name"], "retrying")
+        raise
+
+def attempt_backup(target, profile, progress):
     name = target["name"]
     host = target["host"]
-    user = target["user"]
     paths = " ".join(target["paths"])
     repo_path = target["repo_path"]
-    ssh_key_path = target.get("ssh_key_path")
     compression = target.get("compression", "lz4")
-    exclude_patterns = target.get("exclude_patterns", [])
 
-    # Prepare exclude options
-    exclude_options = " ".join([f"--exclude {pattern}" for pattern in exclude_patterns])
-    borg_cmd = f"borg create --compression {compression} {exclude_options} {repo_path}::'{datetime.now().isoformat()}' {paths}"
+    # Compile exclude/include patterns into a borg patterns file for the remote host
+    pattern_lines = compile_patterns(target.get("exclude_patterns", []), target.get("include_patterns", []))
+    checkpoint_option = f"--checkpoint-interval {checkpoint_interval(target)}"
+    timestamp = datetime.now().isoformat()
 
-    logging.info(f"Starting backup for {name} on {host}...")
+    def set_phase(phase):
+        if progress:
+            progress.phase(name, phase)
 
     # Set up SSH connection
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=host, username=user, key_filename=ssh_key_path)
+    set_phase("connecting")
+    with span("ssh_connect", host=host):
+        ssh = connect_target(target)
 
-    # Run the Borg command
-    stdin, stdout, stderr = ssh.exec_command(borg_cmd)
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status == 0:
-        logging.info(f"Backup for {name} on {host} completed successfully.")
+    remote_dir = None
+    try:
+        set_phase("preparing")
+        # Per-run files live in a private (0700) directory from mktemp, removed after the run
+        remote_dir = make_remote_dir(ssh)
+        remote_patterns_file = f"{remote_dir}/persephone.patterns"
+        patterns_option = f"--patterns-from {shlex.quote(remote_patterns_file)}" if pattern_lines else ""
+        # With --profile, borg writes its own profile on the remote host and it is fetched after the run
+        remote_profile_file = f"{remote_dir}/persephone.pyprof"
+        profile_option = f"--debug-profile {shlex.quote(remote_profile_file)}" if profile else ""
+
+        # Upload the patterns file before starting borg
+        if pattern_lines:
+            with span("upload_patterns", host=host):
+                sftp = ssh.open_sftp()
+                with sftp.open(remote_patterns_file, "w") as patterns_file:
+                    patterns_file.write("\n".join(pattern_lines) + "\n")
+                sftp.close()
+
+        # Resume a run of today that was interrupted, borg dedups against the chunks it already uploaded
+        with span("find_checkpoints", host=host):
+            archive_names = remote_archive_names(ssh, repo_path)
+            resumable = find_resumable(archive_names, run_pattern(name))
+        if resumable:
+            timestamp = resumable[0]
+            logging.info(f"Resuming interrupted backup {timestamp} for {name} on {host} from its checkpoint.")
+        # --progress --log-json makes borg report archive_progress lines on stderr while it runs
+        borg_cmd = (f"borg create --json --progress --log-json {profile_option} {checkpoint_option} --compression {compression} "
+                    f"{patterns_option} {repo_path}::{shlex.quote(f'{name}-{timestamp}')} {paths}")
+
+        # Run the Borg command, draining both streams while it runs so the channel window never fills up
+        set_phase("backing up")
+        with span("borg_create", host=host, repo=repo_path) as stage:
+            stdin, stdout, stderr = ssh.exec_command(borg_cmd)
+            messages = []
+            handler = progress.stderr_handler(name, messages) if progress else lambda line: messages.append(line)
+            exit_status, output = drain_channel(stdout.channel, handler)
+            stage["exit_code"] = exit_status
+            if exit_status != 0:
+                raise subprocess.CalledProcessError(exit_status, borg_cmd, output, "\n".join(messages))
+            archive = parse_create_stats(output)
+            stage.update(archive.get("stats", {}))
+
+        set_phase("cleaning up")
+        with span("cleanup_checkpoints", host=host):
+            delete_remote_checkpoints(ssh, repo_path, leftover_checkpoints(remote_archive_names(ssh, repo_path), run_pattern(name)))
+        return archive
+    finally:
+        if remote_dir:
+            if profile:
+                fetch_profile(ssh, remote_profile_file, name)
+            try:
+                run_remote(ssh, f"rm -rf -- {shlex.quote(remote_dir)}")
+            except (OSError, paramiko.SSHException) as e:
+                logging.warning(f"Could not remove {remote_dir} on {host}: {e}")
+        ssh.close()
+
+def make_remote_dir(ssh):
+    """Create a private temporary directory on the remote host and return its path."""
+    status, output, error = run_remote(ssh, "mktemp -d /tmp/persephone.XXXXXXXXXX")
+    if status != 0 or not output.strip():
+        raise subprocess.CalledProcessError(status or 1, "mktemp -d", output, error)
+    return output.strip()
+
+def run_remote(ssh, command):
+    """Run a short command on the remote host. Returns (exit status, stdout, stderr)."""
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read().decode()
+    error = stderr.read().decode()
+    return stdout.channel.recv_exit_status(), output, error
+
+def remote_archive_names(ssh, repo_path):
+    """List the archives of a target's repository, including checkpoints."""
+    status, output, error = run_remote(ssh, f"borg list --json --consider-checkpoints {repo_path}")
+    if status != 0:
+        logging.warning(f"Could not list archives of {repo_path}: {error}")
+        return []
+    return [archive["name"] for archive in json.loads(output).get("archives", [])]
+
+def delete_remote_checkpoints(ssh, repo_path, names):
+    """Delete checkpoint archives left by interrupted runs."""
+    if not names:
+        return
+    status, _, error = run_remote(ssh, f"borg delete {repo_path} " + " ".join(shlex.quote(n) for n in names))
+    if status == 0:
+        logging.info(f"Deleted {len(names)} stale checkpoint archive(s) from {repo_path}.")
     else:
-        error_message = stderr.read().decode()
-        logging.error(f"Backup for {name} on {host} failed: {error_message}")
+        logging.warning(f"Could not delete checkpoint archives from {repo_path}: {error}")
 
-    ssh.close()
+def fetch_profile(ssh, remote_profile_file, name):
+    """Copy the remote borg profile next to the local trace."""
+    local_file = f"{current_trace().prefix}-borg-{name}.pyprof"
+    try:
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        sftp = ssh.open_sftp()
+        sftp.get(remote_profile_file, local_file)
+        sftp.remove(remote_profile_file)
+        sftp.close()
+    except (OSError, paramiko.SSHException) as e:
+        logging.warning(f"Could not fetch the borg profile from {name}: {e}")
 
-# Main function to run backups sequentially
+# Main function to run backups, sequentially unless parallel is more than 1
 @error_handler
-def perform_backups(config_path):
+def perform_backups(config_path, profile=False, parallel=1, events=None):
     config = load_config(config_path)
     backup_targets = config.get("backup_targets", [])
     
-    for target in backup_targets:
-        run_backup(target)  # Run each backup sequentially
+    policy = retry_policy(config)
+    with FleetProgress(backup_targets, events) as progress:
+        if parallel <= 1:
+            for target in backup_targets:
+                run_backup(target, profile, policy, progress)
+            return
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = [pool.submit(run_backup, target, profile, policy, progress) for target in backup_targets]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    # Already logged by error_handler, the other targets keep running
+                    pass
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run Borg backups on every configured target over SSH")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile and borg --debug-profile")
+    parser.add_argument("--parallel", type=int, default=1, metavar="N", help="Back up N targets at the same time")
+    parser.add_argument("--events", metavar="FILE", help="Append JSON progress events to FILE (- for stdout)")
+    args = parser.parse_args()
+    trace = start_trace("central-backup", profile=args.profile or None)
+
     # Path to your configuration file
     config_path = "/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml"
-    perform_backups(config_path)
+    perform_backups(config_path, trace.profile, args.parallel, args.events)
@@ -0,0 +1,260 @@
+"""
+fleetProgress.py
+
+Live progress of a fleet backup run. centralBackup runs borg create on every
+target with --progress --log-json, drains the remote stdout and stderr while
+borg runs (so a full SSH channel window never stalls the remote borg) and
+feeds the archive_progress lines into a FleetProgress board, which shows per
+host:
+
+    phase       connecting, preparing, backing up, cleaning up, retrying, done, failed
+    MB/s        original bytes read per second over the last few updates
+    files       files processed so far
+    ETA         from the original size of the host's previous archive
+
+On a terminal the board is redrawn in place every second, otherwise one line
+per host is logged every 30 seconds. With an event file every phase change
+and progress update (at most one per host per second) is appended as a JSON
+line, `-` writes the events to stdout:
+
+    {"time": "...", "target": "web1", "host": "10.0.0.5", "phase": "backing up",
+     "bytes": 1234, "files": 56, "rate": 1048576.0, "eta": 120}
+
+The previous original sizes are kept in SIZES_FILE.
+"""
+
+import json
+import logging
+import os
+import select
+import sys
+import threading
+import time
+from datetime import datetime
+
+SIZES_FILE = '/var/lib/CodeMonkeyCyber/Persephone/fleetSizes.json'
+
+READ_SIZE = 65536
+
+# Rate is averaged over this many seconds of progress updates
+RATE_WINDOW = 30
+
+TERMINAL_INTERVAL = 1
+LOG_INTERVAL = 30
+
+
+def load_sizes(sizes_file=SIZES_FILE):
+    try:
+        with open(sizes_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sizes(sizes, sizes_file=SIZES_FILE):
+    try:
+        os.makedirs(os.path.dirname(sizes_file), exist_ok=True)
+        with open(f"{sizes_file}.tmp", 'w') as f:
+            json.dump(sizes, f, indent=2)
+        os.replace(f"{sizes_file}.tmp", sizes_file)
+    except OSError as e:
+        logging.warning(f"Could not save the fleet archive sizes: {e}")
+
+
+def drain_channel(channel, on_stderr_line, timeout=0.5):
+    """
+    Read a paramiko channel's stdout and stderr until the remote command exits,
+    passing every stderr line to on_stderr_line as it arrives. Returns
+    (exit status, stdout text).
+    """
+    stdout_chunks = []
+    pending = b''
+    while True:
+        # The channel's fileno only signals stdout data, the timeout bounds the stderr latency
+        select.select([channel], [], [], timeout)
+        while channel.recv_ready():
+            stdout_chunks.append(channel.recv(READ_SIZE))
+        while channel.recv_stderr_ready():
+            pending += channel.recv_stderr(READ_SIZE)
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                on_stderr_line(line.decode(errors='replace'))
+        if (channel.exit_status_ready() and (channel.eof_received or channel.closed)
+                and not channel.recv_ready() and not channel.recv_stderr_ready()):
+            break
+    if pending:
+        on_stderr_line(pending.decode(errors='replace'))
+    return channel.recv_exit_status(), b''.join(stdout_chunks).decode(errors='replace')
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+
+class HostProgress:
+    """Progress of one target."""
+
+    def __init__(self, name, host, expected=None):
+        self.name = name
+        self.host = host
+        self.expected = expected
+        self.phase = 'waiting'
+        self.bytes = 0
+        self.files = 0
+        self.path = ''
+        self.samples = []
+        self.started = None
+        self.finished = None
+        self.last_event = 0
+
+    def rate(self):
+        if len(self.samples) < 2:
+            return None
+        (first_time, first_bytes), (last_time, last_bytes) = self.samples[0], self.samples[-1]
+        return (last_bytes - first_bytes) / (last_time - first_time) if last_time > first_time else None
+
+    def eta(self):
+        rate = self.rate()
+        if not self.expected or not rate or self.phase != 'backing up':
+            return None
+        return max(self.expected - self.bytes, 0) / rate
+
+    def event(self):
+        rate = self.rate()
+        eta = self.eta()
+        return {'time': datetime.now().isoformat(timespec='seconds'), 'target': self.name, 'host': self.host,
+                'phase': self.phase, 'bytes': self.bytes, 'files': self.files,
+                'rate': round(rate, 1) if rate is not None else None, 'eta': round(eta) if eta is not None else None}
+
+
+class FleetProgress:
+    """Per-host progress board with a terminal view and a JSON event stream."""
+
+    def __init__(self, targets, events=None, stream=sys.stdout, sizes_file=SIZES_FILE):
+        self.sizes_file = sizes_file
+        self.sizes = load_sizes(sizes_file)
+        self.hosts = {target['name']: HostProgress(target['name'], target['host'], self.sizes.get(target['name']))
+                      for target in targets}
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.events = None
+        if events == '-':
+            self.events = sys.stdout
+            # The board and the events cannot share stdout
+            self.interactive = False
+        elif events:
+            self.events = open(events, 'a')
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.renderer = threading.Thread(target=self.render_loop, daemon=True)
+
+    def __enter__(self):
+        self.renderer.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopping.set()
+        self.renderer.join()
+        self.render()
+        if self.events and self.events is not sys.stdout:
+            self.events.close()
+        save_sizes(self.sizes, self.sizes_file)
+
+    def emit(self, progress):
+        if not self.events:
+            return
+        self.events.write(json.dumps(progress.event()) + '\n')
+        self.events.flush()
+
+    def phase(self, name, phase):
+        """Move a target to a new phase."""
+        with self.lock:
+            progress = self.hosts[name]
+            progress.phase = phase
+            now = time.monotonic()
+            if phase == 'connecting' and progress.started is None:
+                progress.started = now
+            if phase == 'backing up':
+                progress.samples = []
+            if phase in ('done', 'failed'):
+                progress.finished = now
+            self.emit(progress)
+
+    def completed(self, name, archive):
+        """Remember the archive's original size for the ETA of the next run."""
+        original_size = archive.get('stats', {}).get('original_size')
+        with self.lock:
+            if original_size:
+                self.sizes[name] = original_size
+                self.hosts[name].bytes = original_size
+            self.hosts[name].files = archive.get('stats', {}).get('nfiles', self.hosts[name].files)
+
+    def stderr_handler(self, name, messages):
+        """
+        Return a callback for the --log-json stderr lines of a target's borg.
+        Progress lines update the board, log messages and anything that is not
+        JSON are appended to messages (used as stderr when borg fails).
+        """
+        def handle(line):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line.strip():
+                    messages.append(line)
+                return
+            if record.get('type') == 'archive_progress':
+                self.update(name, record)
+            elif record.get('type') == 'log_message':
+                messages.append(record.get('message', ''))
+        return handle
+
+    def update(self, name, record):
+        with self.lock:
+            progress = self.hosts[name]
+            # The final archive_progress line only has finished: true
+            if record.get('finished'):
+                return
+            now = time.monotonic()
+            progress.bytes = record.get('original_size', progress.bytes)
+            progress.files = record.get('nfiles', progress.files)
+            progress.path = record.get('path', progress.path)
+            progress.samples.append((now, progress.bytes))
+            while len(progress.samples) > 2 and now - progress.samples[0][0] > RATE_WINDOW:
+                progress.samples.pop(0)
+            if now - progress.last_event >= 1:
+                progress.last_event = now
+                self.emit(progress)
+
+    def lines(self):
+        header = f"{'target':<20} {'phase':<12} {'MB/s':>8} {'files':>10} {'GB':>9} {'ETA':>8}  {'elapsed':>8}"
+        lines = [header]
+        now = time.monotonic()
+        for progress in self.hosts.values():
+            rate = progress.rate()
+            elapsed = (progress.finished or now) - progress.started if progress.started else None
+            lines.append(f"{progress.name[:20]:<20} {progress.phase:<12} "
+                         f"{rate / 1024 ** 2 if rate is not None else 0:8.1f} {progress.files:>10} "
+                         f"{progress.bytes / 1024 ** 3:9.2f} {format_duration(progress.eta()):>8}  "
+                         f"{format_duration(elapsed):>8}")
+        return lines
+
+    def render(self):
+        with self.lock:
+            lines = self.lines()
+        if self.interactive:
+            # Move to the top left and clear the screen before redrawing
+            self.stream.write("\x1b[H\x1b[2J" + "\n".join(lines) + "\n")
+            self.stream.flush()
+        else:
+            for line in lines[1:]:
+                logging.info(f"Fleet progress: {line}")
+
+    def render_loop(self):
+        interval = TERMINAL_INTERVAL if self.interactive else LOG_INTERVAL
+        while not self.stopping.wait(interval):
+            self.render()
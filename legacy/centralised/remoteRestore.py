@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+remoteRestore.py
+
+Restores an archive from the central server onto a backup target without a
+staging directory on either side. `borg export-tar` runs on the central
+server and its tar stream is piped over an SSH channel straight into
+`tar -x` on the target host, so a bare-metal recovery runs at network speed.
+
+With --zstd the stream is compressed on the central server and decompressed
+on the target (the target needs the zstd binary). A progress meter shows the
+bytes restored against the archive's original size.
+
+Usage:
+    remoteRestore.py TARGET DEST                         # latest archive of TARGET into DEST
+    remoteRestore.py TARGET / --archive NAME --zstd 3    # bare-metal restore, compressed stream
+    remoteRestore.py TARGET /srv --path srv/www          # only part of the archive
+
+TARGET is the name of an entry in backup_targets. The repository is opened
+with the target's repo_path and passphrase (falling back to borg.passphrase).
+"""
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import wraps
+
+import paramiko
+import yaml
+
+# Add the parent directory of 'centralised' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+from handleRetry.retryEngine import run_borg
+from handleTracing.stageTracer import span, start_trace
+
+CONFIG_FILE = "/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml"
+
+# Large SSH windows keep the channel busy on high latency links
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+READ_SIZE = 1024 * 1024
+
+# Configure logging
+setup_logging("/var/log/cybermonkey/persephone.log", stage="remote-restore")
+
+# Error handling decorator
+def error_handler(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Error in {func.__name__}: {e}")
+            raise e
+    return wrapper
+
+# Load YAML configuration
+@error_handler
+def load_config(file_path):
+    with open(file_path, "r") as file:
+        return yaml.safe_load(file)
+
+def find_target(config, name):
+    for target in config.get("backup_targets", []):
+        if target["name"] == name:
+            return target
+    raise ValueError(f"No backup target named {name}")
+
+def borg_env(config, target):
+    env = os.environ.copy()
+    passphrase = target.get("passphrase") or config.get("borg", {}).get("passphrase")
+    if passphrase:
+        env["BORG_PASSPHRASE"] = passphrase
+    return env
+
+def archive_info(repo_path, archive_name, env, target_name=None):
+    """Return (archive name, original size). Without a name the newest archive of the target is used."""
+    if not archive_name:
+        glob = ["--glob-archives", f"{target_name}-*"] if target_name else []
+        result = run_borg(["borg", "list", "--last", "1", "--json"] + glob + [repo_path], "borg_list", env=env)
+        archives = json.loads(result.stdout).get("archives", [])
+        if not archives:
+            raise ValueError(f"No archives found in {repo_path}")
+        archive_name = archives[-1]["name"]
+    result = run_borg(["borg", "info", "--json", f"{repo_path}::{archive_name}"], "borg_info", env=env)
+    archive = json.loads(result.stdout)["archives"][0]
+    return archive_name, archive.get("stats", {}).get("original_size", 0)
+
+class Progress:
+    """Prints restored bytes, rate and ETA at most once per second."""
+
+    def __init__(self, total):
+        self.total = total
+        self.restored = 0
+        self.sent = 0
+        self.start = time.monotonic()
+        self.last_print = 0
+
+    def show(self, final=False):
+        now = time.monotonic()
+        if not final and now - self.last_print < 1:
+            return
+        self.last_print = now
+        elapsed = max(now - self.start, 0.001)
+        rate = self.restored / elapsed
+        line = f"{self.restored / 1024 ** 3:8.2f} GB"
+        if self.total:
+            percent = min(self.restored * 100 // self.total, 100)
+            eta = max(self.total - self.restored, 0) / rate if rate else 0
+            line += f" / {self.total / 1024 ** 3:.2f} GB ({percent:3d}%)  ETA {int(eta // 60)}m{int(eta % 60):02d}s"
+        line += f"  {rate / 1024 ** 2:7.1f} MB/s"
+        if self.sent != self.restored:
+            line += f"  sent {self.sent / 1024 ** 3:.2f} GB"
+        print(f"\r{line}", end="\n" if final else "", flush=True)
+
+def pump(source, sink, progress):
+    """Copy the raw tar stream into the compressor, counting restored bytes."""
+    try:
+        while True:
+            block = source.read(READ_SIZE)
+            if not block:
+                break
+            sink.write(block)
+            progress.restored += len(block)
+    except BrokenPipeError:
+        pass
+    finally:
+        sink.close()
+
+@error_handler
+def stream_restore(config, target, dest, archive_name=None, paths=None, zstd_level=None):
+    """Pipe borg export-tar into tar -x on the target host. Returns True on success."""
+    name = target["name"]
+    repo_path = target["repo_path"]
+    env = borg_env(config, target)
+
+    with span("archive_info", repo=repo_path):
+        archive_name, total = archive_info(repo_path, archive_name, env, name)
+
+    remote_cmd = f"mkdir -p {shlex.quote(dest)} && cd {shlex.quote(dest)} && "
+    if zstd_level:
+        remote_cmd += "zstd -dcq | "
+    remote_cmd += "tar -xpf - --numeric-owner"
+
+    logging.info(f"Restoring {repo_path}::{archive_name} to {target['host']}:{dest}...")
+    print(f"Restoring {archive_name} to {target['host']}:{dest}...")
+
+    with span(f"restore:{name}", host=target["host"], archive=archive_name) as stage, \
+            job_metrics("fleet_restore", host=target["host"], repo=repo_path, target=name) as metrics:
+        with span("ssh_connect", host=target["host"]):
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(hostname=target["host"], username=target["user"], key_filename=target.get("ssh_key_path"))
+            channel = ssh.get_transport().open_session(window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE)
+            channel.exec_command(remote_cmd)
+
+        export_cmd = ["borg", "export-tar", f"{repo_path}::{archive_name}", "-"] + list(paths or [])
+        # borg's messages go to a file so a chatty stderr can never stall the stream
+        export_errors = tempfile.TemporaryFile()
+        export = subprocess.Popen(export_cmd, stdout=subprocess.PIPE, stderr=export_errors, env=env)
+        progress = Progress(total)
+        stream = export.stdout
+        compressor = None
+        if zstd_level:
+            compressor = subprocess.Popen(["zstd", "-T0", f"-{zstd_level}", "-cq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            threading.Thread(target=pump, args=(export.stdout, compressor.stdin, progress), daemon=True).start()
+            stream = compressor.stdout
+
+        try:
+            while True:
+                block = stream.read(READ_SIZE)
+                if not block:
+                    break
+                channel.sendall(block)
+                progress.sent += len(block)
+                if not compressor:
+                    progress.restored = progress.sent
+                progress.show()
+        except (OSError, paramiko.SSHException) as e:
+            export.kill()
+            logging.error(f"Streaming to {target['host']} failed: {e}")
+        finally:
+            channel.shutdown_write()
+
+        remote_status = channel.recv_exit_status()
+        remote_error = channel.makefile_stderr("rb").read().decode(errors="replace").strip()
+        export_status = export.wait()
+        export_errors.seek(0)
+        export_error = export_errors.read().decode(errors="replace").strip()
+        export_errors.close()
+        if compressor:
+            compressor.wait()
+        ssh.close()
+        progress.show(final=True)
+
+        stage.update(bytes=progress.restored, sent=progress.sent)
+        metrics.set(bytes_original=progress.restored)
+        metrics.exit_code = export_status or remote_status
+        if export_status != 0:
+            logging.error(f"borg export-tar of {archive_name} failed: {export_error}")
+            print(f"Error: borg export-tar failed. {export_error}")
+            return False
+        if remote_status != 0:
+            logging.error(f"tar on {target['host']} failed: {remote_error}")
+            print(f"Error: extraction on {target['host']} failed. {remote_error}")
+            return False
+
+    logging.info(f"Restored {archive_name} to {target['host']}:{dest} ({progress.restored} bytes).")
+    print(f"Restore of {archive_name} to {target['host']}:{dest} completed successfully.")
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a Borg archive onto a backup target without staging it on disk")
+    parser.add_argument("target", help="Name of the entry in backup_targets")
+    parser.add_argument("dest", help="Directory on the target host to extract into")
+    parser.add_argument("--archive", help="Archive to restore (default: the latest)")
+    parser.add_argument("--path", action="append", dest="paths", help="Only restore this path of the archive (repeatable)")
+    parser.add_argument("--zstd", type=int, nargs="?", const=3, metavar="LEVEL", help="Compress the stream with zstd (default level 3)")
+    parser.add_argument("--config", default=CONFIG_FILE, help="Path to the Persephone config")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile")
+    args = parser.parse_args()
+    start_trace("remote-restore", profile=args.profile or None)
+
+    config = load_config(args.config)
+    target = find_target(config, args.target)
+    sys.exit(0 if stream_restore(config, target, args.dest, args.archive, args.paths, args.zstd) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,17 @@ import yaml
 import logging
 import paramiko
 import os
+import sys
 from functools import wraps
 from datetime import datetime
 
+# Add the parent directory of 'centralised' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import setup_logging
+from handleRetry.retryEngine import retry_call
+
 # Configure logging
-logging.basicConfig(filename="/var/log/cybermonkey/persephone_retrieve.log", level=logging.INFO,
-                    format="%(asctime)s - %(levelname)s - %(message)s")
+setup_logging("/var/log/cybermonkey/persephone_retrieve.log", stage="retrieve-configs")
 
 # Error handling decorator
 def error_handler(func):
@@ -35,25 +40,33 @@ def retrieve_files(target, dest_folder):
     # Define paths to retrieve: repokey and config.yaml files
     files = target.get("files", ["/path/to/.config/borg/keys/<repo_name>", "/path/to/config.yaml"])
 
-    # Set up SSH connection
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=host, username=user, key_filename=ssh_key_path)
+    def connect():
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(hostname=host, username=user, key_filename=ssh_key_path)
+        return ssh
 
-    sftp = ssh.open_sftp()
+    # Every attempt opens its own connection, a reset leaves the previous transport dead
+    def fetch(remote_file, local_file):
+        ssh = connect()
+        try:
+            sftp = ssh.open_sftp()
+            try:
+                sftp.get(remote_file, local_file)
+            finally:
+                sftp.close()
+        finally:
+            ssh.close()
 
     for file in files:
         try:
             remote_file = file
             local_file = os.path.join(dest_folder, f"{host}_{os.path.basename(file)}")
-            sftp.get(remote_file, local_file)
+            retry_call(f"retrieve:{host}:{remote_file}", lambda: fetch(remote_file, local_file))
             logging.info(f"Retrieved {remote_file} from {host} to {local_file}")
         except Exception as e:
             logging.error(f"Failed to retrieve {file} from {host}: {e}")
 
-    sftp.close()
-    ssh.close()
-
 # Main function to run retrievals sequentially
 @error_handler
 def perform_retrievals(config_path):
@@ -1,8 +1,14 @@
 import yaml
 import subprocess
 import os
+import sys
 from datetime import datetime
 
+# Add this directory to the Python path so 'borgHandling' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from borgHandling.borgPatterns import write_patterns_file
+from borgHandling.tieredRepo import backup_repo, start_replication
+
 # Path to the config file
 CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
 
@@ -16,13 +22,13 @@ def create_borg_command():
     config = load_config()
 
     # Extract values from config
-    repo = config['borg'].get('repo')
+    repo = backup_repo(config)
     compression = config['backup'].get('compression', 'none')
     encryption = config['borg'].get('encryption', 'none')
     passphrase = config['borg'].get('passphrase', '')
     rsh = config['borg'].get('rsh', 'ssh')
     paths_to_backup = config['backup'].get('paths_to_backup', [])
-    exclude_patterns = config['backup'].get('exclude_patterns', [])
+    patterns_file = write_patterns_file(config['backup'])
 
     # Generate archive name with date, time, and size
     archive_name = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
@@ -38,9 +44,9 @@ def create_borg_command():
     # Add paths to backup
     cmd.extend(paths_to_backup)
 
-    # Add exclude patterns
-    for pattern in exclude_patterns:
-        cmd.extend(["--exclude", pattern])
+    # Add exclude/include patterns as a compiled patterns file
+    if patterns_file:
+        cmd.extend(["--patterns-from", patterns_file])
 
     # Export passphrase environment variable
     env = os.environ.copy()
@@ -50,7 +56,11 @@ def create_borg_command():
     print("Constructed borg command:", " ".join(cmd))
 
     # Run the borg create command (uncomment to enable execution)
-    subprocess.run(cmd, env=env)
+    result = subprocess.run(cmd, env=env)
+
+    # In tiered mode the archive went to the local repository, copy it offsite
+    if result.returncode == 0:
+        start_replication(config)
 
 # Run the function
 create_borg_command()
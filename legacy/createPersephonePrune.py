@@ -20,6 +20,12 @@ current settings back to ~/.prune_defaults for future runs.
 import os
 import subprocess
 import socket
+import sys
+
+# Add this directory to the Python path so 'handleMetrics' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from handleMetrics.textfileExporter import job_metrics
+from handleTracing.stageTracer import span
 
 CONFIG_FILE = ".persephone.conf"
 
@@ -95,13 +101,15 @@ def main():
         "--keep-last", lt
     ]
     
-    # Execute the restic command.
-    try:
-        subprocess.run(restic_cmd, check=True)
-        print("Restic prune operation completed successfully.")
-    except subprocess.CalledProcessError as e:
-        print("Error running restic command:", e)
-        return
+    # Execute the restic command, recording its metrics for the textfile collector.
+    with span("restic_prune", repo=repo), job_metrics("restic_prune", repo=repo) as metrics:
+        try:
+            subprocess.run(restic_cmd, check=True)
+            print("Restic prune operation completed successfully.")
+        except subprocess.CalledProcessError as e:
+            metrics.exit_code = e.returncode
+            print("Error running restic command:", e)
+            return
 
     # Save the current settings to the configuration file.
     config.update({
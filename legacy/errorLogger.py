@@ -1,7 +1,13 @@
 import logging
+import os
+import sys
 import traceback
 from datetime import datetime
 
+# Add this directory to the Python path so 'handleLogging' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from handleLogging.persephoneLogging import setup_logging
+
 class ErrorLogger:
     def __init__(self, log_file="error_log.log"):
         """
@@ -9,12 +15,7 @@ class ErrorLogger:
         :param log_file: Path to the log file
         """
         self.log_file = log_file
-        logging.basicConfig(
-            filename=self.log_file,
-            level=logging.ERROR,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            datefmt="%Y-%m-%d %H:%M:%S",
-        )
+        setup_logging(self.log_file, level=logging.ERROR)
 
     def log_error(self, error_message):
         """
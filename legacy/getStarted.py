@@ -2,6 +2,7 @@ import yaml
 import os
 import logging
 from utils.checkSudo import checkSudo
+from handleLogging.persephoneLogging import setup_logging
 
 # Ensure the script is running as root
 checkSudo()
@@ -49,7 +50,7 @@ default_config = {
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # Configure logging
-logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging(LOG_FILE, stage='setup')
 
 # Load or create configuration
 def load_config():
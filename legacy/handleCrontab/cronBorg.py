@@ -3,8 +3,13 @@ import subprocess
 import socket
 import logging
 import os
+import sys
 from datetime import datetime
 
+# Add the parent directory of 'handleCrontab' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import setup_logging
+
 
 # Define the log file and directory
 LOG_DIR = '/var/log/CodeMonkeyCyber'
@@ -14,11 +19,14 @@ LOG_FILE = f'{LOG_DIR}/Persephone.log'
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # Configure logging
-logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging(LOG_FILE, level=logging.DEBUG, stage='crontab')
 
 # Path to the config file
 CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
 
+# Scheduled runs wait for the admission gate before borg starts
+ADMISSION_GATE = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "borgHandling", "admissionGate.py"))
+
 # Load configuration from YAML file
 def load_config():
     with open(CONFIG_FILE, 'r') as file:
@@ -70,7 +78,7 @@ def add_borg_to_crontab(config):
 
         # Command to run Borg backup using the current configuration
         borg_backup_command = (
-            f"sh -c 'borg create {config['borg']['repo']}::{socket.gethostname()}-$(date +\\%Y-\\%m-\\%dT\\%H:\\%M:\\%S) "
+            f"python3 {ADMISSION_GATE} -- sh -c 'borg create {config['borg']['repo']}::{socket.gethostname()}-$(date +\\%Y-\\%m-\\%dT\\%H:\\%M:\\%S) "
             f"{' '.join(config['backup']['paths_to_backup'])} "
             f"--compression {config['backup'].get('compression', 'zstd')} "
             f"--exclude-caches' "
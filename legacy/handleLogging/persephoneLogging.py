@@ -0,0 +1,169 @@
+"""
+persephoneLogging.py
+
+One logging setup for every Persephone script. Records are put on a queue by
+a QueueHandler and written by a single QueueListener thread, so callers never
+block on disk I/O and concurrent jobs (e.g. fleet backups running in threads)
+never interleave partial lines.
+
+The log file rotates when it reaches `max_bytes` or at midnight, whichever
+comes first, and rotated files are gzip compressed. With json_lines=True (or
+PERSEPHONE_LOG_JSON=1) every record is written as one JSON object carrying
+run_id, host and stage.
+
+Usage:
+    from handleLogging.persephoneLogging import setup_logging, set_stage
+    setup_logging(stage='backup')
+    set_stage('prune')                # per thread, e.g. per fleet host
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+
+LOG_DIR = '/var/log/CodeMonkeyCyber'
+LOG_FILE = f'{LOG_DIR}/Persephone.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Shared by every process started from the same run (e.g. cron wrappers exporting it)
+RUN_ID = os.environ.get('PERSEPHONE_RUN_ID') or uuid.uuid4().hex[:12]
+HOSTNAME = socket.gethostname()
+
+_context = threading.local()
+_default_stage = 'main'
+_listener = None
+_queue_handler = None
+
+
+def set_stage(stage):
+    """Set the stage recorded on log records from the calling thread."""
+    _context.stage = stage
+
+
+def get_stage():
+    return getattr(_context, 'stage', _default_stage)
+
+
+class RunContextFilter(logging.Filter):
+    """Adds run_id, host and stage to every record. Runs in the calling thread."""
+
+    def filter(self, record):
+        record.run_id = RUN_ID
+        record.host = HOSTNAME
+        record.stage = get_stage()
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record as a single line of JSON."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'run_id': getattr(record, 'run_id', RUN_ID),
+            'host': getattr(record, 'host', HOSTNAME),
+            'stage': getattr(record, 'stage', _default_stage),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotates on size like RotatingFileHandler, and also once the current day is over."""
+
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.rollover_at = self.next_midnight()
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = self.compress
+
+    @staticmethod
+    def next_midnight():
+        now = datetime.now()
+        return time.mktime(now.replace(hour=0, minute=0, second=0, microsecond=0).timetuple()) + 86400
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self.next_midnight()
+
+
+def setup_logging(log_file=LOG_FILE, level=logging.INFO, stage=None, json_lines=None,
+                  console_level=None, max_bytes=50 * 1024 * 1024, backup_count=14):
+    """
+    Route the root logger through a background writer. Safe to call more than once;
+    later calls only update the stage, the level set by the first call stays (like basicConfig).
+    """
+    global _listener, _queue_handler, _default_stage
+
+    if stage:
+        _default_stage = stage
+    root = logging.getLogger()
+    if _listener:
+        return root
+    root.setLevel(level)
+
+    if json_lines is None:
+        json_lines = os.environ.get('PERSEPHONE_LOG_JSON') == '1'
+    formatter = JsonLinesFormatter() if json_lines else logging.Formatter(LOG_FORMAT)
+
+    handlers = []
+    try:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        file_handler = SizeAndTimeRotatingFileHandler(log_file, max_bytes, backup_count)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    except OSError as e:
+        print(f"Warning: cannot write to {log_file}, logging to the console only. {e}")
+        console_level = console_level or level
+    if console_level is not None:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(console_level)
+        console_handler.setFormatter(formatter)
+        handlers.append(console_handler)
+
+    log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    _queue_handler.addFilter(RunContextFilter())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return root
+
+
+def shutdown_logging():
+    """Flush queued records and stop the background writer."""
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -1,12 +1,11 @@
-# Set up logging to output to both a file and the console
-file_handler = logging.FileHandler("/var/log/eos.log")
-file_handler.setLevel(logging.DEBUG)  # Log all levels to the log file
+import logging
+import os
+import sys
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.ERROR)  # Only log errors or higher to the console
+# Add the parent directory of 'handleLogging' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import setup_logging
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Overall log level
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[file_handler, console_handler]
-)
+# Set up logging to output to both a file and the console
+# All levels go to the log file, only errors or higher to the console
+setup_logging("/var/log/eos.log", level=logging.DEBUG, console_level=logging.ERROR)
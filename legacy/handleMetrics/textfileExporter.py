@@ -0,0 +1,146 @@
+"""
+textfileExporter.py
+
+Writes job metrics for the node_exporter textfile collector. Each combination
+of job and labels gets its own .prom file, written to a temporary file and
+renamed so node_exporter never reads a half written file. Jobs that run more
+than once per backup label each run (group, shard), so the runs do not
+overwrite each other's metrics.
+
+Usage:
+    from handleMetrics.textfileExporter import job_metrics
+
+    with job_metrics('borg_create', repo=repo) as metrics:
+        ...
+        metrics.set(bytes_original=..., files=...)
+
+The block's duration, exit code and (on success) the last success timestamp
+are recorded automatically. A CalledProcessError raised inside the block
+records its return code; any other exception records exit code 1.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import socket
+import subprocess
+import time
+
+TEXTFILE_DIR = os.environ.get('PERSEPHONE_TEXTFILE_DIR', '/var/lib/node_exporter/textfile_collector')
+
+METRICS = {
+    'last_success_timestamp_seconds': 'Unix time of the last successful run.',
+    'last_run_timestamp_seconds': 'Unix time the last run finished.',
+    'duration_seconds': 'Duration of the last run.',
+    'exit_code': 'Exit code of the last run (0 is success).',
+    'bytes_original': 'Original size of the data processed by the last run.',
+    'bytes_compressed': 'Compressed size of the data processed by the last run.',
+    'bytes_deduplicated': 'Deduplicated size added to the repository by the last run.',
+    'files': 'Number of files processed by the last run.',
+    'lock_wait_seconds': 'Time the last run spent backing off between retries because the repository was locked.',
+    'throttled_seconds': 'Time the last run spent at a lowered priority because the host was busy.',
+    'paused_seconds': 'Time the last run spent paused because the host was busy.',
+    'admission_wait_seconds': 'Time the last scheduled run waited for the host to admit it.',
+    'verify_mismatches': 'Files whose restored content did not match the unchanged live file.',
+    'repo_size_bytes': 'Size of the repository on disk.',
+    'repo_unique_csize_bytes': 'Unique compressed size of all archives in the repository.',
+    'fs_free_bytes': 'Free space of the filesystem holding the repository.',
+    'days_until_full': 'Days until the repository filesystem or quota is forecast to be full.',
+    'bytes_transferred': 'Bytes sent to the offsite repository by the last replication.',
+}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def metrics_path(job, labels, textfile_dir=TEXTFILE_DIR):
+    key = ','.join(f"{k}={labels[k]}" for k in sorted(labels))
+    digest = hashlib.sha1(key.encode()).hexdigest()[:10]
+    return os.path.join(textfile_dir, f"persephone_{re.sub(r'[^a-zA-Z0-9_]', '_', job)}_{digest}.prom")
+
+
+def previous_value(path, name):
+    """Read a metric value back from an existing .prom file, e.g. to carry over the last success."""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith(f"persephone_{name}{{"):
+                    return float(line.rsplit(' ', 1)[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def write_job_metrics(job, labels, values, textfile_dir=TEXTFILE_DIR):
+    """Atomically write the metrics of one job run."""
+    labels = dict(labels, job=job)
+    path = metrics_path(job, labels, textfile_dir)
+    if 'last_success_timestamp_seconds' not in values:
+        last_success = previous_value(path, 'last_success_timestamp_seconds')
+        if last_success is not None:
+            values = dict(values, last_success_timestamp_seconds=last_success)
+
+    label_text = ','.join(f'{k}="{escape_label(v)}"' for k, v in sorted(labels.items()))
+    lines = []
+    for name, value in values.items():
+        if value is None:
+            continue
+        lines.append(f"# HELP persephone_{name} {METRICS.get(name, name)}")
+        lines.append(f"# TYPE persephone_{name} gauge")
+        lines.append(f"persephone_{name}{{{label_text}}} {value}")
+
+    try:
+        os.makedirs(textfile_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"Failed to write metrics for {job}: {e}")
+
+
+class JobMetrics:
+    """Collects the metrics of one job run and writes them when the run ends."""
+
+    def __init__(self, job, textfile_dir=TEXTFILE_DIR, **labels):
+        self.job = job
+        self.textfile_dir = textfile_dir
+        self.labels = {'host': socket.gethostname(), **{k: v for k, v in labels.items() if v is not None}}
+        self.values = {}
+        self.exit_code = None
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def set_archive_stats(self, archive):
+        """Record the stats section of 'borg create --json' output."""
+        stats = archive.get('stats', {})
+        self.set(bytes_original=stats.get('original_size'), bytes_compressed=stats.get('compressed_size'),
+                 bytes_deduplicated=stats.get('deduplicated_size'), files=stats.get('nfiles'))
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.exit_code is None:
+            if exc is None:
+                self.exit_code = 0
+            elif isinstance(exc, subprocess.CalledProcessError):
+                self.exit_code = exc.returncode
+            else:
+                self.exit_code = 1
+        now = time.time()
+        values = dict(self.values, duration_seconds=round(now - self.start, 3),
+                      exit_code=self.exit_code, last_run_timestamp_seconds=int(now))
+        if self.exit_code == 0:
+            values['last_success_timestamp_seconds'] = int(now)
+        write_job_metrics(self.job, self.labels, values, self.textfile_dir)
+        return False
+
+
+def job_metrics(job, **labels):
+    """Context manager recording the metrics of one job run."""
+    return JobMetrics(job, **labels)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+capacityForecast.py
+
+Watches the repository server filling up. After every backup run the
+collector records, in HISTORY_FILE:
+
+  - the repository size on disk (du) and borg's unique compressed size
+  - the size and free space of the filesystem holding the repository,
+    read over the borg rsh for remote repositories
+
+and exports them as a `capacity` metric. The forecast fits a linear trend
+plus a day-of-week seasonal component to the daily samples of the last
+history_days and finds the first day the filesystem (less min_free_percent,
+borg needs room to compact) or the repository quota would be full. A warning
+is logged when that day is less than warn_days away, an error below
+critical_days.
+
+A proposed retention is compared with backup.prune by simulating borg's
+prune rules on daily archives: every archive more (or less) in the steady
+state costs the median deduplicated size of the recent archives, which
+shifts the forecast. This ignores chunks shared only between pruned archives,
+so it underestimates what a shorter retention frees.
+
+    backup:
+      capacity:
+        history_days: 90
+        min_free_percent: 5
+        warn_days: 30
+        critical_days: 7
+        quota_bytes: null       # borg storage quota of the repository, if any
+
+Usage:
+    capacityForecast.py --record                        # collect a sample (runBorg does this after every run)
+    capacityForecast.py                                 # forecast
+    capacityForecast.py --retention daily=7,weekly=4,monthly=6
+"""
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+from datetime import date, datetime, timedelta
+
+import yaml
+
+# Add the parent directory of 'handleRepo' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.linkProbe import parse_remote_repo, remote_repo_path, rsh_command
+from borgHandling.tieredRepo import backup_repo
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+from handleRetry.retryEngine import run_borg
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+HISTORY_FILE = '/var/lib/CodeMonkeyCyber/Persephone/capacityHistory.jsonl'
+
+DEFAULT_CAPACITY = {
+    'history_days': 90,
+    'min_free_percent': 5,
+    'warn_days': 30,
+    'critical_days': 7,
+    'quota_bytes': None,
+}
+
+# Fewer daily samples than this do not make a trend
+MIN_SAMPLES = 5
+# The seasonal component needs two full weeks
+SEASONAL_MIN_DAYS = 14
+HORIZON_DAYS = 3 * 365
+
+RETENTION_PERIODS = [('daily', '%Y-%m-%d'), ('weekly', '%G-%V'), ('monthly', '%Y-%m'), ('yearly', '%Y')]
+
+
+def capacity_settings(config):
+    return dict(DEFAULT_CAPACITY, **(config['backup'].get('capacity') or {}))
+
+
+def filesystem_usage(config):
+    """Return (filesystem size, free bytes, repository size on disk) of the repository."""
+    repo = backup_repo(config)
+    remote = parse_remote_repo(repo)
+    if not remote:
+        usage = shutil.disk_usage(repo)
+        result = subprocess.run(['du', '-sb', repo], capture_output=True, text=True, check=True)
+        return usage.total, usage.free, int(result.stdout.split()[0])
+
+    destination, port = remote
+    path = shlex.quote(remote_repo_path(repo))
+    cmd = rsh_command(config) + (['-p', port] if port else []) + [destination, f"df -P -B1 {path} && du -sb {path}"]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True, stdin=subprocess.DEVNULL, timeout=600)
+    lines = result.stdout.strip().splitlines()
+    df_fields = lines[1].split()
+    return int(df_fields[1]), int(df_fields[3]), int(lines[2].split()[0])
+
+
+def repository_stats(repo, env):
+    """Return borg's repository-wide cache stats (total and unique sizes)."""
+    result = run_borg(['borg', 'info', '--json', repo], 'borg_info', env=env)
+    return json.loads(result.stdout).get('cache', {}).get('stats', {})
+
+
+def load_history(repo, history_file=HISTORY_FILE):
+    entries = []
+    try:
+        with open(history_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('repo') == repo:
+                    entries.append(entry)
+    except OSError:
+        pass
+    return entries
+
+
+def append_history(entry, history_file=HISTORY_FILE):
+    os.makedirs(os.path.dirname(history_file), exist_ok=True)
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def daily_samples(history, key, since=None):
+    """Return (day ordinal, value) with the last value of every day, oldest first."""
+    days = {}
+    for entry in history:
+        if entry.get(key) is not None and (since is None or entry['time'][:10] >= since):
+            days[entry['time'][:10]] = entry[key]
+    return [(date.fromisoformat(day).toordinal(), value) for day, value in sorted(days.items())]
+
+
+def fit(samples):
+    """Least squares trend plus the mean residual of every weekday. Returns (intercept, slope per day, seasonal)."""
+    days = [day for day, _ in samples]
+    values = [value for _, value in samples]
+    mean_day = statistics.fmean(days)
+    mean_value = statistics.fmean(values)
+    variance = sum((day - mean_day) ** 2 for day in days)
+    slope = sum((day - mean_day) * (value - mean_value) for day, value in samples) / variance if variance else 0.0
+    intercept = mean_value - slope * mean_day
+    seasonal = [0.0] * 7
+    if days[-1] - days[0] >= SEASONAL_MIN_DAYS:
+        residuals = {}
+        for day, value in samples:
+            residuals.setdefault(date.fromordinal(day).weekday(), []).append(value - intercept - slope * day)
+        for weekday, values_of_day in residuals.items():
+            seasonal[weekday] = statistics.fmean(values_of_day)
+    return intercept, slope, seasonal
+
+
+def forecast(samples, limit, shift=0, today=None):
+    """
+    Forecast when the series reaches limit, with shift bytes added to every
+    prediction. Returns {'slope', 'full_date', 'days_left'}; full_date is None
+    when the series is not growing towards the limit within the horizon.
+    """
+    if len(samples) < MIN_SAMPLES or not limit:
+        return None
+    intercept, slope, seasonal = fit(samples)
+    result = {'slope': slope, 'full_date': None, 'days_left': None}
+    start = (today or date.today()).toordinal()
+    for day in range(start, start + HORIZON_DAYS):
+        if intercept + slope * day + seasonal[date.fromordinal(day).weekday()] + shift >= limit:
+            result['full_date'] = date.fromordinal(day)
+            result['days_left'] = day - start
+            break
+    return result
+
+
+def kept_archives(keep):
+    """Number of archives borg prune keeps in the steady state of one archive per day."""
+    span_days = sum((keep.get(rule) or 0) * length for rule, length in
+                    (('daily', 1), ('weekly', 7), ('monthly', 31), ('yearly', 366))) + 1
+    archives = [date.today() - timedelta(days=offset) for offset in range(span_days)]
+    kept = set()
+    for rule, period_format in RETENTION_PERIODS:
+        count = keep.get(rule) or 0
+        kept_by_rule = 0
+        last = None
+        for archive in archives if count else []:
+            period = archive.strftime(period_format)
+            if period != last:
+                last = period
+                if archive not in kept:
+                    kept.add(archive)
+                    kept_by_rule += 1
+                    if kept_by_rule == count:
+                        break
+    return len(kept)
+
+
+def archive_cost(repo, env, glob=None, last=30):
+    """Median deduplicated size of the recent archives, i.e. what one archive more or less costs."""
+    cmd = ['borg', 'info', '--json', '--last', str(last)] + (['--glob-archives', glob] if glob else []) + [repo]
+    archives = json.loads(run_borg(cmd, 'borg_info', env=env).stdout).get('archives', [])
+    sizes = [archive['stats']['deduplicated_size'] for archive in archives if 'stats' in archive]
+    return statistics.median(sizes) if sizes else 0
+
+
+def parse_retention(text):
+    """Parse daily=7,weekly=4,... into a prune section."""
+    keep = {}
+    for part in text.split(','):
+        rule, _, count = part.partition('=')
+        if rule.strip() not in dict(RETENTION_PERIODS):
+            raise ValueError(f"Unknown retention rule {rule!r}, use daily, weekly, monthly or yearly.")
+        keep[rule.strip()] = int(count)
+    return keep
+
+
+def configured_retention(prune):
+    """Return backup.prune with int counts, editYamlMenu.py stores them as strings."""
+    keep = {}
+    for rule, _ in RETENTION_PERIODS:
+        count = str((prune or {}).get(rule) or '').strip()
+        keep[rule] = int(count) if count else 0
+    return keep
+
+
+def forecasts(config, history, shift=0):
+    """Forecast the filesystem and (with a quota) the repository. Returns {name: forecast}."""
+    settings = capacity_settings(config)
+    since = (date.today() - timedelta(days=settings['history_days'])).isoformat()
+    results = {}
+    latest = history[-1] if history else {}
+    if latest.get('fs_total_bytes'):
+        limit = latest['fs_total_bytes'] * (1 - settings['min_free_percent'] / 100)
+        results['filesystem'] = forecast(daily_samples(history, 'fs_used_bytes', since), limit, shift)
+    if settings['quota_bytes']:
+        results['repository'] = forecast(daily_samples(history, 'repo_size_bytes', since), settings['quota_bytes'], shift)
+    return {name: result for name, result in results.items() if result}
+
+
+def check_forecasts(config, results):
+    """Log a warning or error for every forecast that runs out of space soon. Returns the fewest days left."""
+    settings = capacity_settings(config)
+    repo = backup_repo(config)
+    days_left = [result['days_left'] for result in results.values() if result['days_left'] is not None]
+    for name, result in results.items():
+        if result['days_left'] is None:
+            continue
+        message = (f"The {name} of {repo} is forecast to be full on {result['full_date']} "
+                   f"({result['days_left']} days, growing {result['slope'] / 1024 ** 3:.2f} GB/day).")
+        if result['days_left'] <= settings['critical_days']:
+            logging.error(message)
+        elif result['days_left'] <= settings['warn_days']:
+            logging.warning(message)
+    return min(days_left) if days_left else None
+
+
+def record_capacity(config, env, history_file=HISTORY_FILE):
+    """Collect a capacity sample after a run. Never raises, a failed sample must not fail the backup."""
+    repo = backup_repo(config)
+    try:
+        with job_metrics('capacity', repo=repo) as metrics:
+            fs_total, fs_free, repo_size = filesystem_usage(config)
+            stats = repository_stats(repo, env)
+            entry = {'time': datetime.now().isoformat(timespec='seconds'), 'repo': repo,
+                     'repo_size_bytes': repo_size, 'unique_csize_bytes': stats.get('unique_csize'),
+                     'total_size_bytes': stats.get('total_size'), 'fs_total_bytes': fs_total,
+                     'fs_free_bytes': fs_free, 'fs_used_bytes': fs_total - fs_free}
+            append_history(entry, history_file)
+            days_left = check_forecasts(config, forecasts(config, load_history(repo, history_file)))
+            metrics.set(repo_size_bytes=repo_size, repo_unique_csize_bytes=stats.get('unique_csize'),
+                        fs_free_bytes=fs_free, days_until_full=days_left)
+        return entry
+    except (OSError, ValueError, IndexError, subprocess.SubprocessError) as e:
+        logging.warning(f"Could not record the capacity of {repo}: {e}")
+        return None
+
+
+def print_forecast(results, label=""):
+    for name, result in results.items():
+        when = f"full on {result['full_date']} ({result['days_left']} days)" if result['full_date'] \
+            else "not filling up within the horizon"
+        print(f"  {name:<11}{label} growing {result['slope'] / 1024 ** 3:7.2f} GB/day, {when}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Forecast when the backup repository runs out of space")
+    parser.add_argument('--record', action='store_true', help="Collect a capacity sample first")
+    parser.add_argument('--retention', metavar='RULES', help="Estimate a proposed retention, e.g. daily=7,weekly=4")
+    parser.add_argument('--config', default=CONFIG_FILE, help="Path to the Persephone borg config")
+    args = parser.parse_args()
+    setup_logging(stage='capacity')
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    repo = backup_repo(config)
+    env = os.environ.copy()
+    env['BORG_PASSPHRASE'] = config['borg']['passphrase']
+
+    if args.record and not record_capacity(config, env):
+        sys.exit(1)
+
+    history = load_history(repo)
+    results = forecasts(config, history)
+    if not results:
+        print(f"Not enough capacity samples for {repo} yet (need {MIN_SAMPLES} days).")
+        return
+    latest = history[-1]
+    print(f"Capacity of {repo}: {latest['fs_free_bytes'] / 1024 ** 3:.1f} GB free of "
+          f"{latest['fs_total_bytes'] / 1024 ** 3:.1f} GB, repository {latest['repo_size_bytes'] / 1024 ** 3:.1f} GB")
+    print_forecast(results)
+    check_forecasts(config, results)
+
+    if args.retention:
+        try:
+            current = configured_retention(config['backup'].get('prune'))
+            proposed = parse_retention(args.retention)
+        except ValueError as e:
+            parser.error(str(e))
+        if not any(current.get(rule) for rule, _ in RETENTION_PERIODS):
+            print("\nbackup.prune has no retention configured, nothing to compare the proposal with.")
+            return
+        cost = archive_cost(repo, env, f"{socket.gethostname()}-*")
+        extra = kept_archives(proposed) - kept_archives(current)
+        shift = extra * cost
+        print(f"\nRetention {args.retention} keeps {extra:+d} archives compared to the current retention, "
+              f"about {shift / 1024 ** 3:+.1f} GB at {cost / 1024 ** 3:.2f} GB per archive:")
+        print_forecast(forecasts(config, history, shift), " (proposed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,14 @@
+import logging
+import os
+import subprocess
+import sys
+
+# Add the parent directory of 'handleRepo' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleMetrics.textfileExporter import job_metrics
+from handleRetry.retryEngine import retry_policy, run_borg
+from handleTracing.stageTracer import borg_profile_args, span
+
 # Check the repository
 def check_repo(config):
     """Check repository health with 'borg check'."""
@@ -7,12 +18,14 @@ def check_repo(config):
     env = os.environ.copy()
     env['BORG_PASSPHRASE'] = passphrase
 
-    try:
-        result = subprocess.run(['borg', 'check', repo], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, text=True)
-        logging.info(result.stdout)
-        print(f"Repository check passed for {repo}.")  # Success message
-        return True  # Indicate success
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Repository check failed: {e.stderr}")
-        print(f"Error: Repository check failed for {repo}. {e.stderr}")  # Failure message
-        return False  # Indicate failure
+    with span('borg_check', repo=repo), job_metrics('borg_check', repo=repo) as metrics:
+        try:
+            result = run_borg(['borg', 'check'] + borg_profile_args('check') + [repo], 'borg_check', retry_policy(config), metrics, env=env)
+            logging.info(result.stdout)
+            print(f"Repository check passed for {repo}.")  # Success message
+            return True  # Indicate success
+        except subprocess.CalledProcessError as e:
+            metrics.exit_code = e.returncode
+            logging.error(f"Repository check failed: {e.stderr}")
+            print(f"Error: Repository check failed for {repo}. {e.stderr}")  # Failure message
+            return False  # Indicate failure
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+borgDeltaRestore.py
+
+Restores a borg archive onto a tree that is mostly intact, e.g. when rolling
+a server back a few hours, by only extracting what differs.
+
+The archive's metadata is streamed with `borg list --json-lines` and every
+item is compared with the target: missing paths, a different type, and files
+whose size, mtime (or with --hash, sha256 content) or mode differ are
+selected. Only those items are extracted, selected exactly with a pf:
+patterns file, so the restore is bounded by the change size instead of the
+data size.
+
+With --delete, files inside the archive's directories that are not in the
+archive are removed first (mount points are never crossed). Directories whose
+contents were excluded from the backup (caches, logs) lose those contents too,
+so limit --delete to the paths you are rolling back.
+
+Usage:
+    borgDeltaRestore.py ARCHIVE [PATH ...] [--dest /] [--hash] [--delete] [--dry-run]
+
+The repository is $BORG_REPO, or the one backups write to from the Persephone
+config (the local repository in tiered mode).
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+import yaml
+
+# Add the parent directory of 'handleRestore' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.tieredRepo import backup_repo
+from handleLogging.persephoneLogging import setup_logging
+from handleMetrics.textfileExporter import job_metrics
+from handleTracing.stageTracer import borg_profile_args, span, start_trace
+
+CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+
+READ_SIZE = 1024 * 1024
+
+
+def archive_items(repo, archive, paths=(), with_hash=False, env=None):
+    """Yield the items of an archive (optionally only under paths) as borg list --json-lines prints them."""
+    # Keys referenced by --format are added to the JSON lines, {sha256} makes borg read the file contents
+    cmd = ['borg', 'list', '--json-lines'] + (['--format', '{sha256}'] if with_hash else []) + [f"{repo}::{archive}"]
+    with subprocess.Popen(cmd + list(paths), stdout=subprocess.PIPE, text=True, env=env) as process:
+        for line in process.stdout:
+            yield json.loads(line)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(READ_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def differs(item, local_path, with_hash=False):
+    """Return why the item has to be extracted, or None when the target already matches it."""
+    try:
+        st = os.lstat(local_path)
+    except OSError:
+        # Also NotADirectoryError, when a parent of the path is a file in dest
+        return 'missing'
+    mode = stat.filemode(st.st_mode)
+    # Hardlinks after the first are listed with type and mode 'h', on disk they are regular files
+    item_type = '-' if item['type'] == 'h' else item['type']
+    if mode[0] != item_type:
+        return 'type'
+    if item_type == 'd':
+        # Directory metadata is not worth an extract, its files are compared one by one
+        return None
+    if item_type == 'l':
+        return 'link' if os.readlink(local_path) != item.get('linktarget', item.get('source')) else None
+    if mode[1:] != item['mode'][1:]:
+        return 'mode'
+    if item_type != '-':
+        return None
+    archived_mtime = datetime.fromisoformat(item['mtime']).timestamp()
+    if st.st_size != item['size'] or abs(st.st_mtime - archived_mtime) >= 0.001:
+        return 'changed'
+    if with_hash and item.get('sha256') and file_sha256(local_path) != item['sha256']:
+        return 'content'
+    return None
+
+
+def plan_delta(items, dest, with_hash=False, track_paths=False):
+    """
+    Compare archive items with dest. Returns (paths to extract, stats, archive paths,
+    archive directories); the last two are only collected with track_paths (for --delete).
+    """
+    selected = []
+    stats = {'items': 0, 'bytes': 0, 'extract_items': 0, 'extract_bytes': 0, 'reasons': {}}
+    archive_paths = set()
+    archive_dirs = []
+    for item in items:
+        path = item['path']
+        stats['items'] += 1
+        stats['bytes'] += item.get('size', 0)
+        if track_paths:
+            archive_paths.add(path)
+            if item['type'] == 'd':
+                archive_dirs.append(path)
+        reason = differs(item, os.path.join(dest, path), with_hash)
+        if reason:
+            selected.append(path)
+            stats['extract_items'] += 1
+            stats['extract_bytes'] += item.get('size', 0)
+            stats['reasons'][reason] = stats['reasons'].get(reason, 0) + 1
+    return selected, stats, archive_paths, archive_dirs
+
+
+def stale_paths(dest, archive_paths, archive_dirs):
+    """Yield the paths inside the archive's directories that the archive does not have."""
+    for directory in archive_dirs:
+        local_dir = os.path.join(dest, directory)
+        try:
+            device = os.lstat(local_dir).st_dev
+            entries = list(os.scandir(local_dir))
+        except OSError:
+            continue
+        for entry in entries:
+            path = os.path.join(directory, entry.name)
+            if path in archive_paths:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_dev != device:
+                    continue
+            except OSError:
+                continue
+            yield path
+
+
+def delete_stale(dest, paths, dry_run=False):
+    deleted = 0
+    for path in paths:
+        local_path = os.path.join(dest, path)
+        if dry_run:
+            print(f"would delete {local_path}")
+        elif os.path.isdir(local_path) and not os.path.islink(local_path):
+            shutil.rmtree(local_path)
+        else:
+            os.unlink(local_path)
+        deleted += 1
+    return deleted
+
+
+def extract_paths(repo, archive, dest, paths, env=None):
+    """Extract exactly these archive paths into dest."""
+    with tempfile.NamedTemporaryFile('w', prefix='persephone-delta-', suffix='.patterns') as patterns:
+        for path in paths:
+            patterns.write(f"+ pf:{path}\n")
+        patterns.write("- fm:*\n")
+        patterns.flush()
+        subprocess.run(['borg', 'extract', '--patterns-from', patterns.name] + borg_profile_args('delta-extract')
+                       + [f"{repo}::{archive}"], cwd=dest, env=env, check=True)
+
+
+def delta_restore(repo, archive, dest='/', paths=(), with_hash=False, delete=False, dry_run=False, env=None):
+    """Bring dest in line with the archive, extracting only what differs. Returns the stats."""
+    os.makedirs(dest, exist_ok=True)
+    with span('delta_plan', archive=archive) as stage:
+        selected, stats, archive_paths, archive_dirs = plan_delta(
+            archive_items(repo, archive, paths, with_hash, env), dest, with_hash, track_paths=delete)
+        stage.update(items=stats['items'], extract_items=stats['extract_items'])
+    logging.info(f"Delta restore of {archive}: {stats['extract_items']} of {stats['items']} items differ "
+                 f"({stats['extract_bytes']} of {stats['bytes']} bytes) {stats['reasons']}.")
+
+    stats['deleted'] = 0
+    if delete:
+        with span('delta_delete', archive=archive):
+            stats['deleted'] = delete_stale(dest, list(stale_paths(dest, archive_paths, archive_dirs)), dry_run)
+
+    if dry_run:
+        for path in selected:
+            print(f"would extract {path}")
+    elif selected:
+        with span('delta_extract', archive=archive, items=len(selected)):
+            extract_paths(repo, archive, dest, selected, env)
+    return stats
+
+
+def print_stats(stats):
+    mb = 1024 ** 2
+    print(f"{stats['items']} items in the archive ({stats['bytes'] / mb:.1f} MB), "
+          f"{stats['extract_items']} extracted ({stats['extract_bytes'] / mb:.1f} MB), {stats['deleted']} deleted.")
+    for reason, count in sorted(stats['reasons'].items()):
+        print(f"  {reason:8} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Restore a borg archive by extracting only what differs")
+    parser.add_argument('archive', help="Archive to restore")
+    parser.add_argument('paths', nargs='*', help="Only restore these archive paths")
+    parser.add_argument('--dest', default='/', help="Directory to restore into (default: /)")
+    parser.add_argument('--hash', action='store_true', help="Also compare sha256 of files whose size and mtime match")
+    parser.add_argument('--delete', action='store_true', help="Delete files that are not in the archive")
+    parser.add_argument('--dry-run', action='store_true', help="Only show what would be extracted and deleted")
+    parser.add_argument('--profile', action='store_true', help="Profile the run with cProfile and borg --debug-profile")
+    args = parser.parse_args()
+    setup_logging(stage='delta-restore')
+    start_trace('delta-restore', profile=args.profile or None)
+
+    repo = os.environ.get('BORG_REPO')
+    if not repo:
+        with open(CONFIG_FILE, 'r') as f:
+            repo = backup_repo(yaml.safe_load(f))
+
+    with job_metrics('delta_restore', repo=repo) as metrics:
+        try:
+            stats = delta_restore(repo, args.archive, args.dest, args.paths, args.hash, args.delete, args.dry_run)
+        except subprocess.CalledProcessError as e:
+            metrics.exit_code = e.returncode
+            print(f"Delta restore failed: {e}")
+            sys.exit(1)
+        metrics.set(files=stats['extract_items'], bytes_original=stats['extract_bytes'])
+    print_stats(stats)
+
+
+if __name__ == "__main__":
+    main()
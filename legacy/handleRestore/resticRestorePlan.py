@@ -0,0 +1,182 @@
+"""
+resticRestorePlan.py
+
+Plans a restic restore before it runs. A rollback usually only needs a few
+files back, so instead of rewriting the whole snapshot the restore is limited
+to the chosen subtrees (--include/--exclude) and run with
+`--overwrite if-changed`, which leaves files that already match the snapshot
+alone. --delete additionally removes files that are not in the snapshot.
+
+The preflight walks the snapshot listing (`restic ls --json --recursive`,
+only the included subtrees) and compares every file with the target by size
+and mtime, giving the files and bytes that will actually be written. A full
+restore with --overwrite always is sized with `restic stats --mode
+restore-size` instead. The bytes to write are checked against the free space
+of the target filesystem.
+
+--overwrite and --delete need restic 0.17 or later. Older versions always
+overwrite every file, so with them the flag is left out, the restore is sized
+as --overwrite always and --delete is refused.
+
+Usage:
+    plan = plan_restore(repo_file, pass_file, snapshot_id, "/", includes=["/etc"], excludes=["*.log"])
+    print_plan(plan)
+    subprocess.run(restic_cmd(...) + ["restore", snapshot_id] + restore_args(plan))
+"""
+
+import fnmatch
+import json
+import os
+import re
+import shutil
+import subprocess
+from datetime import datetime
+
+from handleRestore.resticSnapshots import restic_cmd
+
+OVERWRITE_MODES = ("always", "if-changed", "if-newer", "never")
+
+# First restic version with restore --overwrite and --delete
+OVERWRITE_VERSION = (0, 17)
+
+# Free space kept in reserve on the target filesystem
+FREE_SPACE_MARGIN = 0.05
+
+FRACTION = re.compile(r'(\.\d{6})\d+')
+
+
+def restic_version():
+    """Return the installed restic version as (major, minor), or None when it cannot be read."""
+    try:
+        result = subprocess.run(["sudo", "restic", "version"], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r'restic (\d+)\.(\d+)', result.stdout)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def parse_mtime(value):
+    """Parse a restic RFC 3339 time, which has nanoseconds, into a timestamp."""
+    try:
+        return datetime.fromisoformat(FRACTION.sub(r'\1', value).replace('Z', '+00:00')).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def excluded(path, excludes):
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in excludes)
+
+
+def included(path, includes):
+    return not includes or any(path == include or path.startswith(include.rstrip('/') + '/') for include in includes)
+
+
+def needs_writing(node, local_path, overwrite):
+    """Whether restic will write this file, judged by size and mtime like --overwrite does."""
+    try:
+        stat = os.lstat(local_path)
+    except OSError:
+        return True
+    if overwrite == "always":
+        return True
+    if overwrite == "never":
+        return False
+    mtime = parse_mtime(node.get("mtime"))
+    if overwrite == "if-newer":
+        return mtime is not None and mtime > stat.st_mtime
+    return stat.st_size != node.get("size", 0) or mtime is None or int(mtime) != int(stat.st_mtime)
+
+
+def free_bytes(path):
+    """Free space of the filesystem holding path (or its nearest existing parent)."""
+    while not os.path.exists(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def snapshot_size(repo_file, pass_file, snapshot_id):
+    result = subprocess.run(restic_cmd(repo_file, pass_file, "stats", "--json", "--mode", "restore-size", snapshot_id),
+                            capture_output=True, text=True, check=True)
+    stats = json.loads(result.stdout)
+    return stats.get("total_file_count", 0), stats.get("total_size", 0)
+
+
+def walk_snapshot(repo_file, pass_file, snapshot_id, includes):
+    """Yield the file nodes of the snapshot under the included paths."""
+    cmd = restic_cmd(repo_file, pass_file, "ls", "--json", "--recursive", snapshot_id, *includes)
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        for line in process.stdout:
+            node = json.loads(line)
+            if node.get("struct_type", "node") == "node" and node.get("type") == "file":
+                yield node
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def plan_restore(repo_file, pass_file, snapshot_id, target="/", includes=(), excludes=(), overwrite="if-changed",
+                 delete=False):
+    """
+    Estimate what a restore will write. Returns the plan, including the options it was made for.
+    Raises ValueError for --delete with a restic older than 0.17.
+    """
+    version = restic_version()
+    overwrite_flag = version is None or version >= OVERWRITE_VERSION
+    if not overwrite_flag:
+        if delete:
+            raise ValueError(f"--delete needs restic 0.17 or later, restic {version[0]}.{version[1]} is installed.")
+        # Older restic versions overwrite every file
+        overwrite = "always"
+    plan = {"snapshot": snapshot_id, "target": target, "includes": list(includes), "excludes": list(excludes),
+            "overwrite": overwrite, "overwrite_flag": overwrite_flag, "delete": delete,
+            "files": 0, "bytes": 0, "write_files": 0, "write_bytes": 0}
+    if overwrite == "always" and not includes and not excludes:
+        plan["files"], plan["bytes"] = snapshot_size(repo_file, pass_file, snapshot_id)
+        plan["write_files"], plan["write_bytes"] = plan["files"], plan["bytes"]
+    else:
+        for node in walk_snapshot(repo_file, pass_file, snapshot_id, includes):
+            path = node["path"]
+            if not included(path, includes) or excluded(path, excludes):
+                continue
+            size = node.get("size", 0)
+            plan["files"] += 1
+            plan["bytes"] += size
+            if needs_writing(node, os.path.join(target, path.lstrip('/')), overwrite):
+                plan["write_files"] += 1
+                plan["write_bytes"] += size
+    plan["free_bytes"] = free_bytes(target)
+    plan["fits"] = plan["write_bytes"] <= plan["free_bytes"] * (1 - FREE_SPACE_MARGIN)
+    return plan
+
+
+def restore_args(plan):
+    """restic restore options for the plan."""
+    args = ["--target", plan["target"]]
+    if plan["overwrite_flag"]:
+        args += ["--overwrite", plan["overwrite"]]
+    for include in plan["includes"]:
+        args += ["--include", include]
+    for exclude in plan["excludes"]:
+        args += ["--exclude", exclude]
+    if plan["delete"]:
+        args.append("--delete")
+    return args
+
+
+def print_plan(plan):
+    gb = 1024 ** 3
+    scope = ", ".join(plan["includes"]) or "the whole snapshot"
+    print(f"Restore plan for snapshot {plan['snapshot']} into {plan['target']} ({scope}):")
+    if plan["excludes"]:
+        print(f"  excluding:        {', '.join(plan['excludes'])}")
+    print(f"  in snapshot:      {plan['files']} files, {plan['bytes'] / gb:.2f} GB")
+    mode = f"--overwrite {plan['overwrite']}" if plan["overwrite_flag"] else "this restic overwrites every file"
+    print(f"  to be written:    {plan['write_files']} files, {plan['write_bytes'] / gb:.2f} GB ({mode})")
+    if plan["delete"]:
+        print("  files not in the snapshot will be deleted from the restored paths")
+    print(f"  free on target:   {plan['free_bytes'] / gb:.2f} GB")
+    if not plan["fits"]:
+        print("  NOT ENOUGH FREE SPACE for this restore.")
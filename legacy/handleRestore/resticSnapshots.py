@@ -0,0 +1,169 @@
+"""
+resticSnapshots.py
+
+Snapshot listing for restic restores that stays fast on shared repositories
+with tens of thousands of snapshots.
+
+A local index (CACHE_DIR/<repo>.json) maps snapshot IDs to their metadata.
+The menu runs as the invoking user (only restic goes through sudo), so the
+index lives in the user's cache directory ($XDG_CACHE_HOME or ~/.cache).
+It is refreshed incrementally: `restic list snapshots` only lists the IDs,
+and only snapshots that are not in the index yet are fetched with
+`restic snapshots --json ID...`; snapshots that were forgotten are dropped.
+A cold index, or more than FETCH_BATCH new snapshots, is filled with one
+`restic snapshots --json` call instead. Filters are then applied to the
+index locally.
+
+Without the cache the host, path, tag and latest filters are pushed down to
+restic (--host, --path, --tag, --latest) and only the time range is applied
+locally, restic has no option for it.
+
+Filters:
+    hosts    snapshot hostname is one of these
+    paths    snapshot contains all of these paths
+    tags     snapshot has every tag of at least one entry ("a,b" means a and b)
+    latest   only the N newest snapshots of each host and path set
+    since    snapshots taken on or after this date/time (ISO, e.g. 2024-05-01)
+    until    snapshots taken before this date/time
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'CodeMonkeyCyber', 'Persephone', 'resticSnapshots')
+
+# Snapshot IDs per `restic snapshots` call, keeps the command line short. With more new
+# snapshots than this, one call listing all of them is cheaper.
+FETCH_BATCH = 200
+
+
+def restic_cmd(repo_file, pass_file, *args):
+    return ["sudo", "restic", "--repository-file", repo_file, "--password-file", pass_file, "--no-lock"] + list(args)
+
+
+def cache_file(repo_file, cache_dir=CACHE_DIR):
+    """The repository file is only readable by root, so the index is keyed by its path."""
+    return os.path.join(cache_dir, hashlib.sha256(os.path.abspath(repo_file).encode()).hexdigest()[:16] + '.json')
+
+
+def load_index(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index, path):
+    try:
+        # Snapshot metadata lists hosts and paths, keep it private to the user
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(index, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.warning(f"Could not save the snapshot index {path}: {e}")
+
+
+def snapshot_ids(repo_file, pass_file):
+    result = subprocess.run(restic_cmd(repo_file, pass_file, "list", "snapshots"),
+                            capture_output=True, text=True, check=True)
+    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+
+def all_snapshots(repo_file, pass_file):
+    result = subprocess.run(restic_cmd(repo_file, pass_file, "snapshots", "--json"),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout) or []
+
+
+def fetch_snapshots(repo_file, pass_file, ids):
+    snapshots = []
+    for start in range(0, len(ids), FETCH_BATCH):
+        result = subprocess.run(restic_cmd(repo_file, pass_file, "snapshots", "--json", *ids[start:start + FETCH_BATCH]),
+                                capture_output=True, text=True, check=True)
+        snapshots.extend(json.loads(result.stdout) or [])
+    return snapshots
+
+
+def refresh_index(repo_file, pass_file, cache_dir=CACHE_DIR):
+    """Bring the local index in line with the repository. Returns {id: snapshot}."""
+    path = cache_file(repo_file, cache_dir)
+    index = load_index(path)
+    ids = snapshot_ids(repo_file, pass_file)
+    current = set(ids)
+    forgotten = [snapshot_id for snapshot_id in index if snapshot_id not in current]
+    new = [snapshot_id for snapshot_id in ids if snapshot_id not in index]
+    if len(new) > FETCH_BATCH:
+        # Cold index or a large gap: rebuild it from a single listing
+        index = {snapshot["id"]: snapshot for snapshot in all_snapshots(repo_file, pass_file)}
+    else:
+        for snapshot_id in forgotten:
+            del index[snapshot_id]
+        for snapshot in fetch_snapshots(repo_file, pass_file, new):
+            index[snapshot["id"]] = snapshot
+    if new or forgotten:
+        logging.info(f"Snapshot index: {len(new)} new, {len(forgotten)} forgotten, {len(index)} total.")
+        save_index(index, path)
+    return index
+
+
+def filter_args(filters):
+    """restic snapshots options for the filters restic can apply itself."""
+    args = []
+    for host in filters.get("hosts") or []:
+        args += ["--host", host]
+    for path in filters.get("paths") or []:
+        args += ["--path", path]
+    for tags in filters.get("tags") or []:
+        args += ["--tag", tags]
+    if filters.get("latest"):
+        args += ["--latest", str(filters["latest"])]
+    return args
+
+
+def in_time_range(snapshot, since=None, until=None):
+    # restic times are ISO 8601 in the snapshot's local zone, close enough for picking a restore point
+    taken = snapshot.get("time", "")
+    return (not since or taken >= since) and (not until or taken < until)
+
+
+def matches(snapshot, filters):
+    if filters.get("hosts") and snapshot.get("hostname") not in filters["hosts"]:
+        return False
+    if filters.get("paths") and not set(filters["paths"]) <= set(snapshot.get("paths") or []):
+        return False
+    if filters.get("tags"):
+        tags = set(snapshot.get("tags") or [])
+        if not any(set(t for t in entry.split(",") if t) <= tags for entry in filters["tags"]):
+            return False
+    return in_time_range(snapshot, filters.get("since"), filters.get("until"))
+
+
+def latest_per_group(snapshots, count):
+    """Keep the count newest snapshots of every host and path set, like restic --latest."""
+    groups = {}
+    for snapshot in sorted(snapshots, key=lambda s: s.get("time", ""), reverse=True):
+        group = groups.setdefault((snapshot.get("hostname"), tuple(sorted(snapshot.get("paths") or []))), [])
+        if len(group) < count:
+            group.append(snapshot)
+    return [snapshot for group in groups.values() for snapshot in group]
+
+
+def find_snapshots(repo_file, pass_file, filters, use_cache=True, refresh=True, cache_dir=CACHE_DIR):
+    """Return the snapshots matching the filters, newest first."""
+    if use_cache:
+        index = refresh_index(repo_file, pass_file, cache_dir) if refresh else load_index(cache_file(repo_file, cache_dir))
+        snapshots = [snapshot for snapshot in index.values() if matches(snapshot, filters)]
+        if filters.get("latest"):
+            snapshots = latest_per_group(snapshots, filters["latest"])
+    else:
+        result = subprocess.run(restic_cmd(repo_file, pass_file, "snapshots", "--json", *filter_args(filters)),
+                                capture_output=True, text=True, check=True)
+        snapshots = [snapshot for snapshot in json.loads(result.stdout) or []
+                     if in_time_range(snapshot, filters.get("since"), filters.get("until"))]
+    return sorted(snapshots, key=lambda s: s.get("time", ""), reverse=True)
@@ -1,11 +1,51 @@
 #!/usr/bin/env python3
+"""
+testRestore.py
 
+Tests that archives in $BORG_REPO can be restored. Without $BORG_REPO the
+repository backups write to is taken from the Persephone config (the local
+repository in tiered mode).
+
+Without options the archive is fully extracted into a directory. With
+--sample N a size weighted random sample of N files is streamed out of the
+archive with 'borg extract --stdout' and hashed in memory, so nothing is
+written to disk. Files whose size and mtime are unchanged on the live
+filesystem must hash identically; any mismatch fails the run.
+
+Usage:
+    testRestore.py                                # full extract, prompts for archive and directory
+    testRestore.py --sample 200                   # verify 200 files of the latest archive
+    testRestore.py --sample 200 --archive NAME
+    testRestore.py --delta                        # full restore, only rewriting files that differ
+"""
+
+import argparse
+import hashlib
+import json
 import os
 import subprocess
 import sys
+import time
+from datetime import datetime
 
+import yaml
+
+# Add the parent directory of 'handleRestore' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from borgHandling.compressionAnalysis import weighted_sample
+from borgHandling.tieredRepo import backup_repo
+from handleMetrics.textfileExporter import job_metrics
+from handleRestore.borgDeltaRestore import delta_restore, print_stats
+from handleRetry.retryEngine import run_borg
+from handleTracing.stageTracer import borg_profile_args, span, start_trace
+
+CONFIG_FILE = "/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml"
 LOGFILE = "restore.log"
 
+# Files above this size are left out of samples so one disk image cannot dominate a run
+MAX_SAMPLE_FILE_BYTES = 1024 ** 3
+READ_SIZE = 1024 * 1024
+
 def log_message(message):
     """Log a message to the console and a log file."""
     print(message)
@@ -24,14 +64,142 @@ def check_borg_installed():
     except FileNotFoundError:
         error_exit("BorgBackup is not installed. Please install it before running this script.")
 
-def test_restore():
-    """Test the restore operation using Borg."""
-    check_borg_installed()
+def latest_archive(borg_repo):
+    """Return the name of the newest archive in the repository."""
+    result = run_borg(["borg", "list", "--last", "1", "--json", borg_repo], "borg_list")
+    archives = json.loads(result.stdout).get("archives", [])
+    if not archives:
+        error_exit(f"No archives found in {borg_repo}.")
+    return archives[-1]["name"]
+
+def archive_files(borg_repo, archive_name, max_file_bytes):
+    """Yield (item, size) for the regular files of an archive, in archive order."""
+    with subprocess.Popen(["borg", "list", "--json-lines", f"{borg_repo}::{archive_name}"],
+                          stdout=subprocess.PIPE, text=True) as process:
+        for position, line in enumerate(process.stdout):
+            item = json.loads(line)
+            if item.get("type") == "-" and 0 < item.get("size", 0) <= max_file_bytes:
+                item["position"] = position
+                yield item, item["size"]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, "borg list")
+
+def hash_stream(stream, size):
+    """Hash exactly size bytes from stream."""
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining:
+        block = stream.read(min(READ_SIZE, remaining))
+        if not block:
+            raise EOFError(f"stream ended {remaining} bytes early")
+        digest.update(block)
+        remaining -= len(block)
+    return digest.hexdigest()
+
+def extract_hashes(borg_repo, archive_name, items):
+    """
+    Stream the sampled files out of the archive with one 'borg extract --stdout'
+    and return their hashes. borg writes the files back to back in archive order,
+    so the stream is split using the sizes from the archive listing.
+    """
+    cmd = ["borg", "extract", "--stdout"] + borg_profile_args("extract-sample") + [f"{borg_repo}::{archive_name}"]
+    cmd += [f"pp:{item['path']}" for item in items]
+    hashes = {}
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+        for item in items:
+            hashes[item["path"]] = hash_stream(process.stdout, item["size"])
+        trailing = process.stdout.read(1)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, "borg extract --stdout")
+    if trailing:
+        raise EOFError("borg extract returned more data than the archive listing announced")
+    return hashes
+
+def unchanged_on_disk(item):
+    """Return True if the live file still has the size and mtime recorded in the archive."""
+    try:
+        st = os.stat(os.path.join("/", item["path"]))
+    except OSError:
+        return False
+    archived_mtime = datetime.fromisoformat(item["mtime"]).timestamp()
+    return st.st_size == item["size"] and abs(st.st_mtime - archived_mtime) < 0.001
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hash_stream(f, os.fstat(f.fileno()).st_size)
+
+def verify_sample(borg_repo, archive_name, count, max_file_bytes=MAX_SAMPLE_FILE_BYTES):
+    """Verify a weighted random sample of the archive's files. Returns the number of mismatches."""
+    with span("sample_files", archive=archive_name):
+        sample = [item for item, _ in weighted_sample(archive_files(borg_repo, archive_name, max_file_bytes), count)]
+    if not sample:
+        error_exit(f"Archive {archive_name} has no files to sample.")
+    sample.sort(key=lambda item: item["position"])
+    total_bytes = sum(item["size"] for item in sample)
+    log_message(f"Verifying {len(sample)} files ({total_bytes / 1024 ** 2:.1f} MB) of {archive_name}")
+
+    start = time.monotonic()
+    with span("borg_extract_stdout", archive=archive_name, files=len(sample), bytes=total_bytes):
+        hashes = extract_hashes(borg_repo, archive_name, sample)
+    elapsed = time.monotonic() - start
+
+    verified = changed = 0
+    mismatches = []
+    with span("compare_live"):
+        for item in sample:
+            if not unchanged_on_disk(item):
+                changed += 1
+            elif hash_file(os.path.join("/", item["path"])) == hashes[item["path"]]:
+                verified += 1
+            else:
+                mismatches.append(item["path"])
+
+    for path in mismatches:
+        log_message(f"MISMATCH: /{path} differs from the archive although size and mtime are unchanged")
+    log_message(f"Sample verification of {archive_name}: {verified} matched, {len(mismatches)} mismatched, "
+                f"{changed} changed or missing on disk (extracted and hashed only). "
+                f"Read {total_bytes / 1024 ** 2:.1f} MB in {elapsed:.1f}s "
+                f"({total_bytes / 1024 ** 2 / max(elapsed, 0.001):.1f} MB/s).")
+    return len(mismatches)
+
+def configured_repo():
+    """The repository backups write to, from the Persephone config, or None."""
+    try:
+        with open(CONFIG_FILE, "r") as f:
+            return backup_repo(yaml.safe_load(f))
+    except (OSError, KeyError, TypeError):
+        return None
+
+def test_sampled_restore(count, archive_name=None, max_file_bytes=MAX_SAMPLE_FILE_BYTES):
+    """Verify a sample of an archive (the latest by default) without writing to disk."""
+    with span("check_borg_installed"):
+        check_borg_installed()
+
+    borg_repo = os.getenv("BORG_REPO") or configured_repo()
+    if not borg_repo:
+        error_exit("BORG_REPO is not set and no repository is configured. Exiting.")
+
+    with job_metrics("restore_verify", repo=borg_repo) as metrics:
+        try:
+            archive_name = archive_name or latest_archive(borg_repo)
+            mismatches = verify_sample(borg_repo, archive_name, count, max_file_bytes)
+        except (subprocess.CalledProcessError, EOFError, ValueError) as e:
+            metrics.exit_code = getattr(e, "returncode", 1)
+            error_exit(f"Sample verification failed: {e}")
+        metrics.set(verify_mismatches=mismatches)
+        metrics.exit_code = 1 if mismatches else 0
+    if mismatches:
+        sys.exit(1)
+
+def test_restore(delta=False):
+    """Test the restore operation using Borg. With delta, files already in the destination are only rewritten if they differ."""
+    with span("check_borg_installed"):
+        check_borg_installed()
 
-    # Check if BORG_REPO is set
-    borg_repo = os.getenv("BORG_REPO")
+    # Check if BORG_REPO is set, or a repository configured
+    borg_repo = os.getenv("BORG_REPO") or configured_repo()
     if not borg_repo:
-        error_exit("BORG_REPO is not set. Exiting.")
+        error_exit("BORG_REPO is not set and no repository is configured. Exiting.")
 
     # Prompt user for inputs
     archive_name = input("Enter the archive name to restore: ")
@@ -41,10 +209,29 @@ def test_restore():
 
     # Run the Borg extract command
     try:
-        subprocess.run(["borg", "extract", f"{borg_repo}::{archive_name}", dest_dir], check=True)
+        os.makedirs(dest_dir, exist_ok=True)
+        if delta:
+            print_stats(delta_restore(borg_repo, archive_name, dest_dir))
+            log_message("Restore operation completed.")
+            return
+        with span("borg_extract", archive=archive_name):
+            subprocess.run(["borg", "extract"] + borg_profile_args("extract") + [f"{borg_repo}::{archive_name}"],
+                           cwd=dest_dir, check=True)
         log_message("Restore operation completed.")
     except subprocess.CalledProcessError as e:
         error_exit(f"Restore operation failed: {e}")
 
 if __name__ == "__main__":
-    test_restore()
+    parser = argparse.ArgumentParser(description="Test restoring a Borg archive")
+    parser.add_argument("--sample", type=int, metavar="N", help="Verify N sampled files without writing to disk")
+    parser.add_argument("--archive", help="Archive to verify (default: the latest)")
+    parser.add_argument("--max-file-size", type=int, default=MAX_SAMPLE_FILE_BYTES // 1024 ** 2, metavar="MB",
+                        help="Leave larger files out of the sample")
+    parser.add_argument("--delta", action="store_true", help="Only extract files that differ from the destination")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile and borg --debug-profile")
+    args = parser.parse_args()
+    start_trace("test-restore", profile=args.profile or None)
+    if args.sample:
+        test_sampled_restore(args.sample, args.archive, args.max_file_size * 1024 ** 2)
+    else:
+        test_restore(args.delta)
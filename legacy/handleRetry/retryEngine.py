@@ -0,0 +1,218 @@
+"""
+retryEngine.py
+
+Shared retry layer for borg commands and SSH operations. A failure is
+classified from its exit code, stderr or exception type:
+
+    lock     the repository is locked by another borg process       retried
+    network  SSH resets, DNS failures, timeouts, closed connections  retried
+    auth     wrong passphrase, rejected SSH key                      never retried
+    data     integrity errors, missing objects                       never retried
+    unknown  anything else                                           never retried
+
+Retryable classes have their own attempt budget and back off exponentially
+with full jitter (a random delay between 0 and the current cap), so hosts that
+failed together do not come back together and storm the repo server. Every
+failed attempt is logged and appended to HISTORY_FILE.
+
+    retry:
+      max_total_seconds: 3600     # never back off longer than this in total for one operation
+      lock:
+        attempts: 6
+        base_delay: 30
+        max_delay: 600
+      network:
+        attempts: 5
+        base_delay: 15
+        max_delay: 300
+
+Usage:
+    from handleRetry.retryEngine import retry_call, run_borg, retry_policy
+
+    result = run_borg(['borg', 'check', repo], 'borg_check', policy=retry_policy(config), env=env)
+    ssh = retry_call(f"connect:{host}", lambda: connect(host))
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+HISTORY_FILE = '/var/lib/CodeMonkeyCyber/Persephone/retryHistory.jsonl'
+HISTORY_MAX_BYTES = 5 * 1024 * 1024
+
+RETRYABLE = ('lock', 'network')
+
+DEFAULT_POLICY = {
+    'max_total_seconds': 3600,
+    'lock': {'attempts': 6, 'base_delay': 30, 'max_delay': 600},
+    'network': {'attempts': 5, 'base_delay': 15, 'max_delay': 300},
+}
+
+# borg 1.4 exit codes; older versions exit with 2 and are classified from stderr.
+# -1 is what paramiko reports when the SSH transport is lost before the remote command exits.
+EXIT_CODES = {
+    'lock': {70, 71, 72, 73, 74, 75},
+    'network': {-1, 80, 81, 255},
+    'auth': {51, 52, 53},
+    'data': {40, 41, 42, 43, 44, 45, 46, 47, 48, 49},
+}
+
+STDERR_PATTERNS = [
+    ('lock', re.compile(r'Failed to create/acquire the lock|LockTimeout|lock\.exclusive|Repository is already locked', re.I)),
+    ('auth', re.compile(r'passphrase supplied in BORG_PASSPHRASE.*incorrect|PassphraseWrong|Permission denied \(|'
+                        r'Authentication failed|Host key verification failed', re.I)),
+    ('data', re.compile(r'IntegrityError|Data integrity error|checksum mismatch|ObjectNotFound|'
+                        r'Repository .* does not exist|is not a valid repository', re.I)),
+    ('network', re.compile(r'Connection (closed|reset|refused|timed out)|Broken pipe|Could not resolve hostname|'
+                           r'Temporary failure in name resolution|Name or service not known|No route to host|'
+                           r'Network is unreachable|ssh: connect to host|ConnectionClosed|Remote: .*(EOF|timeout)', re.I)),
+]
+
+# Exception classes, by name so paramiko does not have to be imported here
+EXCEPTION_CLASSES = {
+    'AuthenticationException': 'auth',
+    'BadHostKeyException': 'auth',
+    'PermissionError': 'auth',
+    'NoValidConnectionsError': 'network',
+    'SSHException': 'network',
+    'gaierror': 'network',
+    'ConnectionError': 'network',
+    'TimeoutError': 'network',
+    'timeout': 'network',
+    'EOFError': 'network',
+    'TimeoutExpired': 'network',
+}
+
+_history_lock = threading.Lock()
+
+
+def retry_policy(config=None):
+    """Return the retry policy from the config's retry section, merged over the defaults."""
+    overrides = (config or {}).get('retry') or {}
+    policy = dict(DEFAULT_POLICY, **{k: v for k, v in overrides.items() if not isinstance(v, dict)})
+    for failure_class in RETRYABLE:
+        policy[failure_class] = dict(DEFAULT_POLICY[failure_class], **(overrides.get(failure_class) or {}))
+    return policy
+
+
+def classify(returncode, stderr):
+    """Classify a failed command from its exit code and stderr."""
+    for failure_class, pattern in STDERR_PATTERNS:
+        if stderr and pattern.search(stderr):
+            return failure_class
+    for failure_class, codes in EXIT_CODES.items():
+        if returncode in codes:
+            return failure_class
+    return 'unknown'
+
+
+def classify_exception(error):
+    """
+    Classify an exception raised by a command or an SSH operation.
+
+    >>> classify_exception(subprocess.CalledProcessError(-1, 'borg create'))
+    'network'
+    >>> classify_exception(subprocess.CalledProcessError(73, 'borg create'))
+    'lock'
+    """
+    if isinstance(error, subprocess.CalledProcessError):
+        stderr = error.stderr.decode(errors='replace') if isinstance(error.stderr, bytes) else error.stderr
+        return classify(error.returncode, stderr or '')
+    for cls in type(error).__mro__:
+        if cls.__name__ in EXCEPTION_CLASSES:
+            return EXCEPTION_CLASSES[cls.__name__]
+    return 'unknown'
+
+
+def error_summary(error):
+    stderr = getattr(error, 'stderr', None)
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors='replace')
+    text = (stderr or str(error)).strip().splitlines()
+    return text[-1][:300] if text else type(error).__name__
+
+
+def record_attempt(entry, history_file=HISTORY_FILE):
+    """Append one attempt to the history file, keeping it below HISTORY_MAX_BYTES."""
+    with _history_lock:
+        try:
+            os.makedirs(os.path.dirname(history_file), exist_ok=True)
+            if os.path.exists(history_file) and os.path.getsize(history_file) > HISTORY_MAX_BYTES:
+                with open(history_file, 'r') as f:
+                    lines = f.readlines()
+                with open(history_file, 'w') as f:
+                    f.writelines(lines[len(lines) // 2:])
+            with open(history_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            logging.debug(f"Could not record retry history: {e}")
+
+
+def backoff(failure_policy, attempt):
+    """Full jitter: a random delay up to base_delay * 2^(attempt-1), capped at max_delay."""
+    cap = min(failure_policy['max_delay'], failure_policy['base_delay'] * 2 ** (attempt - 1))
+    return random.uniform(0, cap)
+
+
+def retry_call(operation, func, policy=None, metrics=None, sleep=time.sleep):
+    """
+    Call func() until it succeeds or fails with a class that is not retryable or
+    has used up its budget, then re-raise the last error. With metrics, the time
+    spent backing off on lock failures is recorded as lock_wait_seconds.
+    """
+    policy = policy or retry_policy()
+    # Only the backoff counts against max_total_seconds: a long borg create that fails late
+    # must still be retried, it resumes from its checkpoint
+    waited = 0.0
+    attempts = {}
+    lock_wait = 0.0
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = func()
+            if attempt > 1:
+                logging.info(f"{operation} succeeded on attempt {attempt}.")
+                record_attempt({'time': datetime.now().isoformat(timespec='seconds'), 'operation': operation,
+                                'attempt': attempt, 'class': None, 'outcome': 'success'})
+            return result
+        except Exception as e:
+            failure_class = classify_exception(e)
+            attempts[failure_class] = attempts.get(failure_class, 0) + 1
+            failure_policy = policy.get(failure_class) if failure_class in RETRYABLE else None
+            delay = backoff(failure_policy, attempts[failure_class]) if failure_policy else 0
+            give_up = (not failure_policy or attempts[failure_class] >= failure_policy['attempts']
+                       or waited + delay > policy['max_total_seconds'])
+
+            record_attempt({'time': datetime.now().isoformat(timespec='seconds'), 'operation': operation,
+                            'attempt': attempt, 'class': failure_class, 'returncode': getattr(e, 'returncode', None),
+                            'error': error_summary(e), 'outcome': 'failed' if give_up else 'retry',
+                            'delay': None if give_up else round(delay, 1)})
+            if give_up:
+                logging.error(f"{operation} failed ({failure_class}) on attempt {attempt}, giving up: {error_summary(e)}")
+                if metrics and lock_wait:
+                    metrics.set(lock_wait_seconds=round(lock_wait, 1))
+                raise
+            logging.warning(f"{operation} failed ({failure_class}) on attempt {attempt}, "
+                            f"retrying in {delay:.0f}s: {error_summary(e)}")
+            sleep(delay)
+            waited += delay
+            if failure_class == 'lock':
+                lock_wait += delay
+                if metrics:
+                    metrics.set(lock_wait_seconds=round(lock_wait, 1))
+
+
+def run_borg(cmd, operation=None, policy=None, metrics=None, **kwargs):
+    """subprocess.run(cmd, check=True) with retries. stderr is captured to classify failures."""
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    kwargs.setdefault('text', True)
+    operation = operation or ' '.join(cmd[:2])
+    return retry_call(operation, lambda: subprocess.run(cmd, check=True, **kwargs), policy, metrics)
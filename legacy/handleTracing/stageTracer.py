@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+stageTracer.py
+
+Stage level timing for backup and restore runs. Every stage of a run (config
+loading, SSH connect, borg create, prune, ...) is wrapped in a span, and the
+spans of a run are written as one Chrome trace file, which can be opened in
+chrome://tracing or https://ui.perfetto.dev, or summarised on the host with:
+
+    stageTracer.py /var/log/CodeMonkeyCyber/traces/<trace>.json
+
+With profiling enabled (--profile on the entry point scripts, or
+PERSEPHONE_PROFILE=1), the Python orchestration runs under cProfile and borg
+commands get --debug-profile. Both profiles are written next to the trace and
+can be read with `python3 -m pstats <file>`.
+
+Usage:
+    from handleTracing.stageTracer import span, start_trace, borg_profile_args
+
+    start_trace('borg-backup', profile=args.profile)
+    with span('borg_create', repo=repo):
+        subprocess.run(cmd + borg_profile_args('create'), ...)
+
+Spans opened before start_trace() start a trace named after the script.
+The trace is written when the process exits, or earlier with finish_trace().
+"""
+
+import atexit
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# Add the parent directory of 'handleTracing' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from handleLogging.persephoneLogging import RUN_ID, set_stage, get_stage
+
+TRACE_DIR = os.environ.get('PERSEPHONE_TRACE_DIR', '/var/log/CodeMonkeyCyber/traces')
+
+# Trace and profile files older than this are removed when a new trace is written
+KEEP_DAYS = 14
+
+_lock = threading.Lock()
+_trace = None
+
+
+class Trace:
+    """The spans of one run, kept in memory until the run ends."""
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+        self.events = []
+        self.threads = {}
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.prefix = os.path.join(TRACE_DIR, f"{name}-{datetime.now().strftime('%Y%m%dT%H%M%S')}-{RUN_ID}")
+        self.profiler = cProfile.Profile() if profile else None
+
+    def add(self, name, start, end, args):
+        thread = threading.current_thread()
+        with _lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append({
+                'name': name,
+                'cat': self.name,
+                'ph': 'X',
+                'ts': round((start - self.origin) * 1e6),
+                'dur': round((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args,
+            })
+
+    def to_json(self):
+        thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                        for tid, name in self.threads.items()]
+        return {
+            'traceEvents': thread_names + self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'run_id': RUN_ID, 'name': self.name, 'started': datetime.fromtimestamp(self.started).isoformat(),
+                          'argv': sys.argv},
+        }
+
+
+def profiling_requested(profile=None):
+    """Resolve the --profile switch, falling back to PERSEPHONE_PROFILE."""
+    if profile is not None:
+        return profile
+    return os.environ.get('PERSEPHONE_PROFILE') == '1'
+
+
+def start_trace(name=None, profile=None):
+    """Start the trace of this run. Later calls return the trace already running."""
+    global _trace
+    with _lock:
+        if _trace:
+            return _trace
+        _trace = Trace(name or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'persephone',
+                       profiling_requested(profile))
+    if _trace.profiler:
+        # cProfile only sees the thread that enabled it, i.e. the orchestration itself
+        _trace.profiler.enable()
+        logging.info(f"Profiling enabled, profiles are written to {_trace.prefix}.*")
+    atexit.register(finish_trace)
+    return _trace
+
+
+def current_trace():
+    return _trace or start_trace()
+
+
+@contextmanager
+def span(name, **args):
+    """Time a stage of the run. The stage is also set on log records from this thread."""
+    trace = current_trace()
+    previous_stage = get_stage()
+    set_stage(name)
+    start = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        end = time.perf_counter()
+        set_stage(previous_stage)
+        trace.add(name, start, end, {k: v for k, v in args.items() if v is not None})
+        logging.debug(f"Stage {name} took {end - start:.3f}s.")
+
+
+def borg_profile_args(label):
+    """Return the borg options writing a --debug-profile for this command, if profiling is on."""
+    trace = current_trace()
+    if not trace.profile:
+        return []
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    # The .pyprof suffix makes borg write a pstats compatible file
+    return ['--debug-profile', f"{trace.prefix}-borg-{label}.pyprof"]
+
+
+def remove_old_traces(trace_dir=TRACE_DIR, keep_days=KEEP_DAYS):
+    cutoff = time.time() - keep_days * 86400
+    try:
+        with os.scandir(trace_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+    except OSError as e:
+        logging.debug(f"Could not clean up old traces: {e}")
+
+
+def finish_trace():
+    """Write the trace (and the Python profile) of this run. Returns the trace file path."""
+    global _trace
+    with _lock:
+        trace, _trace = _trace, None
+    if not trace:
+        return None
+    if trace.profiler:
+        trace.profiler.disable()
+
+    trace_file = f"{trace.prefix}.json"
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        remove_old_traces()
+        with open(f"{trace_file}.tmp", 'w') as f:
+            json.dump(trace.to_json(), f)
+        os.replace(f"{trace_file}.tmp", trace_file)
+        if trace.profiler:
+            trace.profiler.dump_stats(f"{trace.prefix}.pstats")
+    except OSError as e:
+        logging.error(f"Failed to write trace {trace_file}: {e}")
+        return None
+
+    slowest = summarize(trace.events)[:3]
+    if slowest:
+        logging.info(f"Trace written to {trace_file}. Slowest stages: "
+                     + ", ".join(f"{name} {total:.1f}s" for name, total, _, _ in slowest))
+    return trace_file
+
+
+def summarize(events):
+    """Return [(stage, total seconds, count, longest seconds)] sorted by total time."""
+    stages = {}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        total, count, longest = stages.get(event['name'], (0, 0, 0))
+        seconds = event['dur'] / 1e6
+        stages[event['name']] = (total + seconds, count + 1, max(longest, seconds))
+    return sorted(((name, *values) for name, values in stages.items()), key=lambda s: -s[1])
+
+
+def print_summary(trace_file):
+    with open(trace_file, 'r') as f:
+        trace = json.load(f)
+    info = trace.get('otherData', {})
+    print(f"{info.get('name', '')} run {info.get('run_id', '')} started {info.get('started', '')}")
+    print(f"{'stage':30s} {'total':>10s} {'count':>6s} {'longest':>10s}")
+    for name, total, count, longest in summarize(trace.get('traceEvents', [])):
+        print(f"{name:30s} {total:>9.2f}s {count:>6d} {longest:>9.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} TRACE_FILE")
+        sys.exit(1)
+    print_summary(sys.argv[1])
@@ -5,8 +5,9 @@ import subprocess
 import sys
 
 # Add the parent directory of 'utils' to the Python path
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from utils.checkSudo import checkSudo
+from handleLogging.persephoneLogging import setup_logging
 checkSudo()
 
 # Define the log file and directory
@@ -17,7 +18,7 @@ LOG_FILE = f'{LOG_DIR}/Persephone.log'
 os.makedirs(LOG_DIR, exist_ok=True)
 
 # Configure logging
-logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+setup_logging(LOG_FILE, level=logging.DEBUG, stage='config')
 
 # Path to the config file
 CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
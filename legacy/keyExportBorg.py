@@ -1,9 +1,40 @@
+"""
+keyExportBorg.py
+
+Exports Borg repository keys.
+
+Without options the key of the local repository is exported interactively.
+With --escrow the key of every repository in backup_targets is exported
+concurrently into a content addressed escrow store:
+
+    /var/lib/CodeMonkeyCyber/Persephone/keyEscrow/
+        objects/<sha256>.key    exported keys, one file per distinct key
+        index.json              repo -> current fingerprint, history and timestamps
+
+The fingerprint is the sha256 of the exported key, so repos whose key has not
+changed are only checked, not written again. A coverage report lists every
+target and whether its current key is in escrow.
+
+Usage:
+    keyExportBorg.py                     # interactive export of the local key
+    keyExportBorg.py --escrow            # escrow every backup target's key
+    keyExportBorg.py --escrow --workers 16
+"""
+
+import argparse
+import hashlib
+import json
+import logging
 import yaml
 import subprocess
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 # Path to the config file
 CONFIG_FILE = '/etc/CodeMonkeyCyber/Persephone/borgConfig.yaml'
+ESCROW_DIR = '/var/lib/CodeMonkeyCyber/Persephone/keyEscrow'
+DEFAULT_WORKERS = 8
 
 # Load configuration
 def load_config():
@@ -43,6 +74,115 @@ def export_borg_key():
     except subprocess.CalledProcessError as e:
         print("Error exporting encryption key:", e)
 
+# Export one target's key to memory. Returns (status, key, error)
+def export_target_key(config, target):
+    env = os.environ.copy()
+    passphrase = target.get('passphrase') or config.get('borg', {}).get('passphrase')
+    if passphrase:
+        env['BORG_PASSPHRASE'] = passphrase
+    # Never wait for an answer to one of borg's questions in batch mode
+    env['BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK'] = 'no'
+    env['BORG_RELOCATED_REPO_ACCESS_IS_OK'] = 'no'
+
+    # Without a path, borg key export writes the key to stdout
+    result = subprocess.run(['borg', 'key', 'export', target['repo_path']],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    if result.returncode == 0:
+        return 'exported', result.stdout, None
+    error = result.stderr.decode(errors='replace').strip()
+    if 'not encrypted' in error:
+        return 'unencrypted', None, None
+    return 'failed', None, error or f"borg exited with {result.returncode}"
+
+def load_index(escrow_dir=ESCROW_DIR):
+    try:
+        with open(os.path.join(escrow_dir, 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_index(index, escrow_dir=ESCROW_DIR):
+    index_file = os.path.join(escrow_dir, 'index.json')
+    with open(f"{index_file}.tmp", 'w') as f:
+        json.dump(index, f, indent=2)
+    os.chmod(f"{index_file}.tmp", 0o600)
+    os.replace(f"{index_file}.tmp", index_file)
+
+# Store a key under its sha256 and return the fingerprint
+def store_key(key, escrow_dir=ESCROW_DIR):
+    fingerprint = hashlib.sha256(key).hexdigest()
+    object_file = os.path.join(escrow_dir, 'objects', f"{fingerprint}.key")
+    if not os.path.exists(object_file):
+        fd = os.open(f"{object_file}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{object_file}.tmp", object_file)
+    return fingerprint
+
+# Export every backup target's key concurrently into the escrow store
+def escrow_keys(config, workers=DEFAULT_WORKERS, escrow_dir=ESCROW_DIR):
+    targets = config.get('backup_targets', [])
+    os.makedirs(os.path.join(escrow_dir, 'objects'), mode=0o700, exist_ok=True)
+    index = load_index(escrow_dir)
+    now = datetime.now().isoformat(timespec='seconds')
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exports = list(executor.map(lambda target: export_target_key(config, target), targets))
+
+    results = []
+    for target, (status, key, error) in zip(targets, exports):
+        repo = target['repo_path']
+        entry = index.setdefault(repo, {'target': target['name'], 'history': []})
+        entry['target'] = target['name']
+        entry['last_checked'] = now
+        if status == 'exported':
+            fingerprint = store_key(key, escrow_dir)
+            if fingerprint == entry.get('fingerprint'):
+                status = 'unchanged'
+            else:
+                if entry.get('fingerprint'):
+                    entry['history'].append({'fingerprint': entry['fingerprint'], 'until': now})
+                entry['fingerprint'] = fingerprint
+                entry['exported'] = now
+            entry['last_verified'] = now
+        elif status == 'unencrypted':
+            entry['unencrypted'] = True
+        else:
+            logging.error(f"Key export for {target['name']} ({repo}) failed: {error}")
+        results.append({'target': target['name'], 'repo': repo, 'status': status, 'error': error,
+                        'fingerprint': entry.get('fingerprint'), 'last_verified': entry.get('last_verified')})
+
+    save_index(index, escrow_dir)
+    return results
+
+# Print which targets have their current key in escrow
+def print_coverage(results):
+    print(f"{'target':24s} {'status':12s} {'fingerprint':14s} last verified")
+    for r in sorted(results, key=lambda r: (r['status'] != 'failed', r['target'])):
+        fingerprint = (r['fingerprint'] or '-')[:12]
+        print(f"{r['target']:24s} {r['status']:12s} {fingerprint:14s} {r['last_verified'] or 'never'}")
+        if r['error']:
+            print(f"{'':24s} {r['error']}")
+
+    encrypted = [r for r in results if r['status'] != 'unencrypted']
+    covered = [r for r in encrypted if r['status'] in ('exported', 'unchanged')]
+    counts = {status: sum(1 for r in results if r['status'] == status)
+              for status in ('exported', 'unchanged', 'unencrypted', 'failed')}
+    print(f"\nKey escrow coverage: {len(covered)}/{len(encrypted)} encrypted repositories "
+          f"({', '.join(f'{count} {status}' for status, count in counts.items())}).")
+    return len(covered) == len(encrypted)
+
 # Run the export function
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Borg repository keys")
+    parser.add_argument('--escrow', action='store_true', help="Escrow the key of every repository in backup_targets")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Number of concurrent key exports")
+    parser.add_argument('--escrow-dir', default=ESCROW_DIR, help="Escrow store directory")
+    args = parser.parse_args()
+
+    if args.escrow:
+        results = escrow_keys(load_config(), args.workers, args.escrow_dir)
+        raise SystemExit(0 if print_coverage(results) else 1)
     export_borg_key()
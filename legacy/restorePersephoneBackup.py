@@ -7,17 +7,43 @@ from .persephone_backup.conf (which should define REPO_FILE and PASS_FILE),
 lists available snapshots by calling Restic (parsing its JSON output), prompts
 the user to select a snapshot, and then performs the restore.
 
+Snapshots are listed from a local index that is refreshed incrementally (see
+handleRestore/resticSnapshots.py) and can be narrowed down before the menu
+opens; the menu shows one page at a time, newest first:
+
+    restorePersephoneBackup.py --host web1 --path /etc --since 2024-05-01
+    restorePersephoneBackup.py --tag daily --latest 5
+    restorePersephoneBackup.py --no-cache          # query restic directly, filters pushed down
+
+Restores only write what differs from the snapshot (--overwrite if-changed)
+and can be limited to subtrees. The files and bytes to be written are
+estimated and checked against the free space before anything is restored
+(see handleRestore/resticRestorePlan.py):
+
+    restorePersephoneBackup.py --include /etc/nginx --include /srv/www --exclude '*.log'
+    restorePersephoneBackup.py --include /srv/www --delete      # roll the subtree back exactly
+
 Note: This script requires that Restic is installed and available on the system.
 It uses sudo to run Restic commands.
 """
 
+import argparse
 import os
 import subprocess
 import json
 import sys
 
+# Add this directory to the Python path so 'handleTracing' can be imported
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from handleRestore.resticRestorePlan import OVERWRITE_MODES, plan_restore, print_plan, restore_args
+from handleRestore.resticSnapshots import find_snapshots
+from handleTracing.stageTracer import span, start_trace
+
 CONFIG_FILE = ".persephone_backup.conf"
 
+# Snapshots shown per page of the menu
+PAGE_SIZE = 20
+
 def load_config(config_file):
     """
     Loads configuration from the given file.
@@ -41,21 +67,13 @@ def load_config(config_file):
         sys.exit(1)
     return config
 
-def list_snapshots(repo_file, pass_file):
+def list_snapshots(repo_file, pass_file, filters=None, use_cache=True, refresh=True):
     """
-    Calls restic to list snapshots in JSON format and returns a list of snapshot dictionaries.
+    Returns the snapshots matching the filters as a list of dictionaries, newest first.
     Each dictionary is expected to have at least keys: 'short_id', 'time', and 'paths'.
     """
     try:
-        result = subprocess.run(
-            ["sudo", "restic",
-             "--repository-file", repo_file,
-             "--password-file", pass_file,
-             "snapshots", "--json"],
-            capture_output=True, text=True, check=True
-        )
-        snapshots = json.loads(result.stdout)
-        return snapshots
+        return find_snapshots(repo_file, pass_file, filters or {}, use_cache, refresh)
     except subprocess.CalledProcessError as e:
         print("Error retrieving snapshots:", e)
         sys.exit(1)
@@ -63,35 +81,46 @@ def list_snapshots(repo_file, pass_file):
         print("Error parsing JSON output from restic:", e)
         sys.exit(1)
 
-def display_snapshots(snapshots):
+def display_snapshots(snapshots, page=0):
     """
-    Displays a numbered list of snapshots. For each snapshot, shows:
-      short_id, time, and the first path from the list of paths.
-    Returns a list of snapshot short_ids corresponding to the displayed order.
+    Displays one page of the numbered list of snapshots. For each snapshot, shows:
+      short_id, time, host, and the first path from the list of paths.
+    Returns a list of snapshot short_ids corresponding to the full list.
     """
     if not snapshots:
         print("No snapshots found.")
         sys.exit(1)
-    snapshot_ids = []
-    print("Available Snapshots:")
+    pages = (len(snapshots) + PAGE_SIZE - 1) // PAGE_SIZE
+    first = page * PAGE_SIZE
+    print(f"Available Snapshots (page {page + 1} of {pages}, {len(snapshots)} snapshots):")
     print("-------------------")
-    for idx, snap in enumerate(snapshots, start=1):
+    for idx, snap in enumerate(snapshots[first:first + PAGE_SIZE], start=first + 1):
         short_id = snap.get("short_id", "unknown")
-        snap_time = snap.get("time", "unknown")
+        snap_time = snap.get("time", "unknown")[:19]
+        host = snap.get("hostname", "")
         paths = snap.get("paths", [])
         path_display = paths[0] if paths else "N/A"
-        print(f"{idx:3d}) {short_id} {snap_time} {path_display}")
-        snapshot_ids.append(short_id)
+        print(f"{idx:5d}) {short_id} {snap_time} {host} {path_display}")
     print()
-    return snapshot_ids
+    return [snap.get("short_id", "unknown") for snap in snapshots]
 
-def select_snapshot(snapshot_ids):
+def select_snapshot(snapshots):
     """
-    Prompts the user to select a snapshot number from the provided list.
+    Shows the snapshots page by page and prompts the user to select a snapshot number.
     Returns the snapshot short_id corresponding to the user's choice.
     """
+    page = 0
+    pages = (len(snapshots) + PAGE_SIZE - 1) // PAGE_SIZE
+    snapshot_ids = display_snapshots(snapshots, page)
     while True:
-        selection = input("Enter the number of the snapshot you want to restore: ").strip()
+        selection = input("Enter the number of the snapshot to restore (n/p for next/previous page, q to quit): ").strip().lower()
+        if selection in ("n", "p"):
+            page = min(page + 1, pages - 1) if selection == "n" else max(page - 1, 0)
+            display_snapshots(snapshots, page)
+            continue
+        if selection == "q":
+            print("Restoration canceled.")
+            sys.exit(0)
         if selection.isdigit():
             index = int(selection)
             if 1 <= index <= len(snapshot_ids):
@@ -100,32 +129,74 @@ def select_snapshot(snapshot_ids):
                 return selected_snapshot
         print(f"Invalid selection. Please enter a number between 1 and {len(snapshot_ids)}.")
 
-def restore_snapshot(repo_file, pass_file, snapshot_id):
+def restore_snapshot(repo_file, pass_file, snapshot_id, target="/", includes=(), excludes=(),
+                     overwrite="if-changed", delete=False, force=False):
     """
-    Prompts the user for confirmation and then runs the restic restore command for the selected snapshot.
+    Sizes the restore, prompts the user for confirmation and then runs the restic restore
+    command for the selected snapshot.
     """
     print(f"Starting restoration process for snapshot {snapshot_id}...")
+    try:
+        with span("plan_restore", snapshot=snapshot_id) as stage:
+            plan = plan_restore(repo_file, pass_file, snapshot_id, target, includes, excludes, overwrite, delete)
+            stage.update(write_files=plan["write_files"], write_bytes=plan["write_bytes"])
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        print("Error sizing the restore:", e)
+        sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print_plan(plan)
+    if not plan["fits"] and not force:
+        print("Restoration canceled, free up space on the target or use --force.")
+        sys.exit(1)
+    if plan["write_files"] == 0 and not delete:
+        print("Nothing to restore, the target already matches the snapshot.")
+        return
+
     confirm = input("Are you sure you want to restore this snapshot? This may overwrite existing files. (y/N): ").strip().lower()
     if confirm not in ["y", "yes"]:
         print("Restoration canceled.")
         sys.exit(0)
 
     try:
-        subprocess.run(
-            ["sudo", "restic",
-             "--repository-file", repo_file,
-             "--password-file", pass_file,
-             "restore", snapshot_id, "--target", "/"],
-            check=True
-        )
+        with span("restic_restore", snapshot=snapshot_id):
+            subprocess.run(
+                ["sudo", "restic",
+                 "--repository-file", repo_file,
+                 "--password-file", pass_file,
+                 "restore", snapshot_id] + restore_args(plan),
+                check=True
+            )
         print(f"Restoration of snapshot {snapshot_id} completed successfully.")
     except subprocess.CalledProcessError as e:
         print("Error during restoration:", e)
         sys.exit(1)
 
 def main():
+    parser = argparse.ArgumentParser(description="Restore a Restic backup snapshot")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile")
+    parser.add_argument("--host", action="append", dest="hosts", metavar="HOST", help="Only snapshots of this host")
+    parser.add_argument("--path", action="append", dest="paths", metavar="PATH", help="Only snapshots containing this path")
+    parser.add_argument("--tag", action="append", dest="tags", metavar="TAG[,TAG]", help="Only snapshots with these tags")
+    parser.add_argument("--latest", type=int, metavar="N", help="Only the N newest snapshots of each host and path set")
+    parser.add_argument("--since", help="Only snapshots taken on or after this date (YYYY-MM-DD[THH:MM])")
+    parser.add_argument("--until", help="Only snapshots taken before this date")
+    parser.add_argument("--no-cache", action="store_true", help="Query restic directly instead of the snapshot index")
+    parser.add_argument("--offline", action="store_true", help="Use the snapshot index without refreshing it")
+    parser.add_argument("--target", default="/", help="Directory to restore into (default: /)")
+    parser.add_argument("--include", action="append", default=[], metavar="PATH", help="Only restore this subtree")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN", help="Do not restore matching files")
+    parser.add_argument("--overwrite", choices=OVERWRITE_MODES, default="if-changed",
+                        help="Which existing files to overwrite (default: if-changed)")
+    parser.add_argument("--delete", action="store_true", help="Delete files in the restored paths that are not in the snapshot")
+    parser.add_argument("--force", action="store_true", help="Restore even if the target looks too small")
+    args = parser.parse_args()
+    start_trace("restic-restore", profile=args.profile or None)
+
     # Load configuration
-    config = load_config(CONFIG_FILE)
+    with span("load_config"):
+        config = load_config(CONFIG_FILE)
     repo_file = config.get("REPO_FILE")
     pass_file = config.get("PASS_FILE")
     if not repo_file or not pass_file:
@@ -135,12 +206,15 @@ def main():
     print("Checking Restic backup and snapshots...\n")
 
     # List snapshots and prompt for selection.
-    snapshots = list_snapshots(repo_file, pass_file)
-    snapshot_ids = display_snapshots(snapshots)
-    selected_snapshot = select_snapshot(snapshot_ids)
+    filters = {"hosts": args.hosts, "paths": args.paths, "tags": args.tags, "latest": args.latest,
+               "since": args.since, "until": args.until}
+    with span("list_snapshots"):
+        snapshots = list_snapshots(repo_file, pass_file, filters, use_cache=not args.no_cache, refresh=not args.offline)
+    selected_snapshot = select_snapshot(snapshots)
     
     # Restore the selected snapshot.
-    restore_snapshot(repo_file, pass_file, selected_snapshot)
+    restore_snapshot(repo_file, pass_file, selected_snapshot, args.target, args.include, args.exclude,
+                     args.overwrite, args.delete, args.force)
     print("Restic restore process complete.")
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
+import os
 import subprocess
 import re
 
+# Scheduled runs wait for the admission gate before the backup starts
+ADMISSION_GATE = os.path.abspath(os.path.join(os.path.dirname(__file__), "borgHandling", "admissionGate.py"))
+
 def get_backup_time():
     """Ask the user for the backup time."""
     print("Enter the time of day you want the backup to run (HH:MM, 24-hour format).")
@@ -56,7 +60,7 @@ def troubleshoot():
 def main():
     backup_time = get_backup_time()
     cron_format = convert_to_crontab_format(backup_time)
-    command = "sudo python3 /home/henry/Eos/scripts/borgWrapper.py --backup"
+    command = f"sudo python3 {ADMISSION_GATE} -- python3 /home/henry/Eos/scripts/borgWrapper.py --backup"
     
     # Append to crontab
     crontab_entry = f"{cron_format} {command}"